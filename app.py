@@ -13,14 +13,18 @@ from datetime import datetime
 from functools import wraps
 from operator import itemgetter
 
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response, \
+    send_from_directory
 from setuptools.errors import PlatformError
 from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
 
-DATABASE = 'data/uploads.db'
-DIRDATABASE = 'data/directories.db'
-TERMDATABASE = 'data/terminal_output.db'
+from utils.database_utils import get_connection, fetch_stage_timings, fetch_stage_totals, \
+    fetch_upload_status_counts, fetch_terminal_logs, fetch_terminal_jobs, fetch_progress, fetch_resource_usage
+from utils.concurrency_utils import start_controller
+from utils.eta_utils import queue_eta
+from utils.profile_utils import PROFILE_DIR
+from utils.source_index_utils import start_indexer
 
 # Set the custom location for __pycache__
 os.environ['PYTHONPYCACHEPREFIX'] = 'tmp/'
@@ -102,25 +106,14 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-# Initialize database only if it doesn't exist
+# Create or migrate the database, returns True if no directories have been loaded into it yet
 def init_db():
     logging.debug('Checking if the database needs initialization...')
-    if not os.path.exists(DIRDATABASE):
-        logging.info(f'{DIRDATABASE} does not exist. Initializing the database.')
-        conn = sqlite3.connect(DIRDATABASE)
-        c = conn.cursor()
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS directories (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT UNIQUE,
-                status TEXT,
-                creation_date TEXT
-            )
-        ''')
-        conn.commit()
-        conn.close()
-        logging.debug('Database initialized.')
-        # If DB didn't exist, load all directories
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute('SELECT COUNT(*) FROM directories')
+    if c.fetchone()[0] == 0:
+        logging.info('No directories in the database yet. Loading all directories.')
         return True
     else:
         logging.info('Database already exists. No need to reload all directories.')
@@ -137,7 +130,7 @@ def cleanup_orphaned_directories():
             return
         logging.info("Starting cleanup of orphaned directories...")
         # Connect to the SQLite database
-        conn = sqlite3.connect(DIRDATABASE)
+        conn = get_connection()
         c = conn.cursor()
 
         # Get all directory names from the database
@@ -157,10 +150,9 @@ def cleanup_orphaned_directories():
                 logging.info(f"Removing orphaned directory: {directory} from database")
                 c.execute('DELETE FROM directories WHERE name = ?', (directory,))
 
-                # Commit changes and close the database connection
+                # Commit changes
                 conn.commit()
 
-        conn.close()
         logging.info("Cleanup of orphaned directories completed.")
 
         # Sleep for 5 minutes before running the check again
@@ -225,7 +217,7 @@ def load_directories_into_db(data_dir=None, single_directory=None):
             return
         directories_to_load = os.scandir(data_dir)
 
-    conn = sqlite3.connect(DIRDATABASE)
+    conn = get_connection()
     c = conn.cursor()
 
     directory_count = 0  # To count how many directories are being loaded
@@ -280,7 +272,6 @@ def load_directories_into_db(data_dir=None, single_directory=None):
             directory_count += 1
 
     conn.commit()
-    conn.close()
 
     logging.info(f'{directory_count} directories processed in the database.')
 
@@ -341,11 +332,10 @@ class RootDirectoryEventHandler(FileSystemEventHandler):
         if event.is_directory:
             dir_name = os.path.basename(event.src_path)
             logging.debug(f'Directory deleted: {dir_name}')
-            conn = sqlite3.connect(DIRDATABASE)
+            conn = get_connection()
             c = conn.cursor()
             c.execute('DELETE FROM directories WHERE name = ?', (dir_name,))
             conn.commit()
-            conn.close()
             logging.debug(f'Directory {dir_name} deleted from the database.')
 
             # Stop the corresponding observer if it exists
@@ -390,8 +380,7 @@ def start_directory_watcher(data_dir):
 def update_directory_status(dir_name, new_status):
     logging.info(f"Updating status for {dir_name} to {new_status}")
 
-    # Connect to the SQLite database
-    conn = sqlite3.connect(DIRDATABASE)
+    conn = get_connection()
     c = conn.cursor()
 
     # Update the status only if it has changed
@@ -408,7 +397,6 @@ def update_directory_status(dir_name, new_status):
         logging.warning(f"Directory {dir_name} not found in the database.")
 
     conn.commit()
-    conn.close()
     logging.debug(f"Status for {dir_name} updated to {new_status}")
 
 # Route to get directory data from the SQLite database
@@ -416,7 +404,7 @@ def update_directory_status(dir_name, new_status):
 @login_required
 def get_directories_json():
     logging.debug('Fetching directories from the database...')
-    conn = sqlite3.connect(DIRDATABASE)
+    conn = get_connection()
     c = conn.cursor()
 
     # Ensure the correct order: name, status, creation_date
@@ -432,7 +420,6 @@ def get_directories_json():
         for row in c.fetchall()
     ]
 
-    conn.close()
     #logging.debug(f'Returning {len(directories)} directories as JSON.')
 
     # Print the response before returning it
@@ -460,7 +447,10 @@ def upload():
         return "Directory name not provided", 400  # Return 400 if directory_name is missing
 
     # Start upload in a subprocess to avoid blocking
-    subprocess.Popen(['/venv/bin/python3', 'backend.py', f'{shlex.quote(str(directory_name))}'])
+    command = ['/venv/bin/python3', 'backend.py', f'{shlex.quote(str(directory_name))}']
+    if data.get('priority') == 'urgent':
+        command += ['--priority', 'urgent']
+    subprocess.Popen(command)
 
     return "Upload started", 200
 
@@ -666,55 +656,73 @@ def monitor():
 @login_required
 def get_terminal_output():
     last_id = request.args.get('last_id', 0, type=int)  # Get the last shown log's id from the frontend
-    new_lines = []
-    max_log_lines = 1000  # Limit to 1000 log lines
+    job = request.args.get('job') or None  # Only send the lines of this upload job, all jobs if not given
 
-    if os.path.exists(TERMDATABASE):
-        try:
-            # Connect to SQLite database
-            conn = sqlite3.connect(TERMDATABASE)
-            c = conn.cursor()
+    # Lines are trimmed by the backends as they write, this is a plain range read on the (source, id) index
+    try:
+        rows = fetch_terminal_logs(last_id, job)
+    except sqlite3.Error as e:
+        logging.error(f"SQLite error: {e}")
+        return jsonify({'data': []})
 
-            # Query new lines with id greater than last_id
-            c.execute('''
-                SELECT id, log_line FROM terminal_logs
-                WHERE id > ? 
-                ORDER BY id ASC
-            ''', (last_id,))
-            rows = c.fetchall()
-
-            # Format the new lines
-            new_lines = [{'id': row[0], 'line': row[1]} for row in rows]
-
-            # Keep the last 1000 lines, delete older lines if necessary
-            c.execute('SELECT COUNT(*) FROM terminal_logs')
-            total_lines = c.fetchone()[0]
-
-            if total_lines > max_log_lines:
-                # Calculate the number of excess lines
-                excess_lines = total_lines - max_log_lines
-                
-                # Delete the oldest lines to maintain the max_log_lines limit
-                c.execute('''
-                    DELETE FROM terminal_logs
-                    WHERE id IN (
-                        SELECT id FROM terminal_logs
-                        ORDER BY id ASC
-                        LIMIT ?
-                    )
-                ''', (excess_lines,))
-                logging.info(f"Deleted {excess_lines} old log entries to maintain the log size.")
+    # Format the new lines
+    new_lines = [{'id': row[0], 'line': row[1]} for row in rows]
 
-            conn.commit()
-            conn.close()
-        except sqlite3.Error as e:
-            logging.error(f"SQLite error: {e}")
-            return jsonify({'data': []})
-    else:
-        logging.error(f"Database not found: {TERMDATABASE}")
+    return jsonify({'data': new_lines})
+
+# Route to list the upload jobs the monitor can follow
+@app.route('/get_terminal_jobs', methods=['GET'])
+@login_required
+def get_terminal_jobs():
+    try:
+        rows = fetch_terminal_jobs()
+    except sqlite3.Error as e:
+        logging.error(f"SQLite error: {e}")
         return jsonify({'data': []})
 
-    return jsonify({'data': new_lines})
+    jobs = []
+    for source, started, last_id in rows:
+        # Sources are "<pid>:<directory name>", or just the pid for output from before the directory was known
+        pid, _, name = source.partition(':')
+        jobs.append({'job': source, 'pid': pid, 'name': name or f'PID {pid}', 'started': started,
+                     'last_id': last_id})
+    return jsonify({'data': jobs})
+
+# Route to provide the progress of the running stage of one upload job
+@app.route('/get_progress', methods=['GET'])
+@login_required
+def get_progress():
+    job = request.args.get('job')
+    if not job:
+        return jsonify({'data': None}), 400
+
+    try:
+        row = fetch_progress(job)
+    except sqlite3.Error as e:
+        logging.error(f"SQLite error: {e}")
+        return jsonify({'data': None})
+
+    if row is None:
+        return jsonify({'data': None})
+    return jsonify({'data': {
+        'stage': row[0],
+        'done': row[1],
+        'total': row[2],
+        'bytes_per_second': row[3],
+        'eta_seconds': row[4],
+        'updated': row[5]
+    }})
+
+# Route to predict when each running upload, and the whole queue, is done
+@app.route('/get_queue_eta', methods=['GET'])
+@login_required
+def get_queue_eta():
+    try:
+        eta = queue_eta()
+    except sqlite3.Error as e:
+        logging.error(f"SQLite error: {e}")
+        return jsonify({'data': None})
+    return jsonify({'data': eta})
 
 #################################### LOG PAGE #####################################################
 
@@ -728,13 +736,12 @@ def logs():
 @app.route('/get_logs', methods=['GET'])
 @login_required
 def get_logs():
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     cursor = conn.cursor()
     
-    cursor.execute('SELECT name, category, date, status, size, imdb_url, screenshot_url, image_url FROM uploads')
+    cursor.execute('SELECT name, category, date, status, size, imdb_url, screenshot_url, image_url, id, profile '
+                   'FROM uploads')
     existing_logs = cursor.fetchall()
-    
-    conn.close()
 
     # Format the logs for DataTables
     log_data = [
@@ -746,13 +753,99 @@ def get_logs():
             'size': row[4],
             'imdb_url': row[5],
             'screenshot_url': row[6],
-            'image_url': row[7]
+            'image_url': row[7],
+            'id': row[8],
+            'profile': row[9]
         }
         for row in existing_logs
     ]
 
     return jsonify({'data': log_data})
 
+# Route to provide the stage timings of one upload for the waterfall view
+@app.route('/get_upload_stages', methods=['GET'])
+@login_required
+def get_upload_stages():
+    upload_id = request.args.get('id', type=int)
+    if upload_id is None:
+        return jsonify({'data': []}), 400
+
+    try:
+        rows = fetch_stage_timings(upload_id)
+    except sqlite3.Error as e:
+        logging.error(f"SQLite error: {e}")
+        return jsonify({'data': []})
+
+    stages = [
+        {
+            'stage': row[0],
+            'started': row[1],
+            'duration': row[2],
+            'bytes': row[3]
+        }
+        for row in rows
+    ]
+    return jsonify({'data': stages})
+
+# Route to provide what the latest uploads cost, for the resource graph
+@app.route('/get_resource_usage', methods=['GET'])
+@login_required
+def get_resource_usage():
+    try:
+        rows = fetch_resource_usage()
+    except sqlite3.Error as e:
+        logging.error(f"SQLite error: {e}")
+        return jsonify({'data': []})
+
+    fields = ('id', 'name', 'date', 'status', 'size_bytes', 'wall_seconds', 'cpu_seconds', 'child_cpu_seconds',
+              'read_bytes', 'sent_bytes', 'peak_rss', 'child_peak_rss')
+    return jsonify({'data': [dict(zip(fields, row)) for row in rows]})
+
+# Route to download the cProfile stats of a profiled upload
+@app.route('/profiles/<path:filename>')
+@login_required
+def download_profile(filename):
+    return send_from_directory(os.path.abspath(PROFILE_DIR), filename, as_attachment=True)
+
+#################################### METRICS #####################################################
+
+# Prometheus text exposition of the stage timings. Left without login so a scraper can read it, it only exposes
+# aggregates, never upload names.
+@app.route('/metrics')
+def metrics():
+    lines = []
+    try:
+        stage_totals = fetch_stage_totals()
+        status_counts = fetch_upload_status_counts()
+    except sqlite3.Error as e:
+        logging.error(f"SQLite error: {e}")
+        stage_totals, status_counts = [], []
+
+    lines.append('# HELP dc_uploader_stage_duration_seconds Wall-clock time spent in each upload stage.')
+    lines.append('# TYPE dc_uploader_stage_duration_seconds summary')
+    for stage, count, total_duration, _, _ in stage_totals:
+        lines.append(f'dc_uploader_stage_duration_seconds_sum{{stage="{stage}"}} {total_duration or 0:.3f}')
+        lines.append(f'dc_uploader_stage_duration_seconds_count{{stage="{stage}"}} {count}')
+
+    lines.append('# HELP dc_uploader_stage_bytes_total Bytes processed by each upload stage.')
+    lines.append('# TYPE dc_uploader_stage_bytes_total counter')
+    for stage, _, _, total_bytes, _ in stage_totals:
+        if total_bytes is not None:
+            lines.append(f'dc_uploader_stage_bytes_total{{stage="{stage}"}} {total_bytes}')
+
+    lines.append('# HELP dc_uploader_stage_bytes_per_second Average throughput of each upload stage that processes bytes.')
+    lines.append('# TYPE dc_uploader_stage_bytes_per_second gauge')
+    for stage, _, _, total_bytes, bytes_duration in stage_totals:
+        if total_bytes is not None and bytes_duration:
+            lines.append(f'dc_uploader_stage_bytes_per_second{{stage="{stage}"}} {total_bytes / bytes_duration:.0f}')
+
+    lines.append('# HELP dc_uploader_uploads_total Uploads by status.')
+    lines.append('# TYPE dc_uploader_uploads_total counter')
+    for status, count in status_counts:
+        lines.append(f'dc_uploader_uploads_total{{status="{status}"}} {count}')
+
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     if platform.system() != 'Linux':
         raise PlatformError("This tool is designed only for Linux")
@@ -773,6 +866,12 @@ if __name__ == '__main__':
     # Start the cleanup task to remove orphaned directories from the database
     initiate_cleanup_daemon()
 
+    # Keep the index of SOURCEFOLDER torrents up to date for EDIT_TORRENT
+    start_indexer()
+
+    # Adjust how many uploads may hash or upload at once to the measured throughput
+    start_controller()
+
     # Path to your SSL certificate and key
     ssl_cert_path = 'certificates/cert.pem'
     ssl_key_path = 'certificates/key.pem'
@@ -1,61 +1,64 @@
+import argparse
+import asyncio
 import io
+import json
 import os
 import platform
 import re
 import shutil
 import sqlite3
 import sys
+import threading
 import time
 from pathlib import Path
 
-import requests
-from requests import HTTPError
+from requests import HTTPError, RequestException
 
+from utils import http_utils
+from utils.accounting_utils import ResourceAccount, format_usage
 from utils.art_utils import ascii_art_header
 from utils.bcolors import bcolors
 from utils.category_utils import determine_category
+from utils.concurrency_utils import PRIORITIES, device_name, stage_slot
 from utils.config_loader import ConfigLoader
-from utils.database_utils import insert_upload, update_upload_status
+from utils.database_utils import insert_upload, update_upload_status, insert_stage_timings, set_upload_profile, \
+    insert_terminal_log, prune_terminal_logs, save_upload, save_upload_job, update_upload_job, delete_upload_jobs
 from utils.dupe_utils import check_and_download_dupe
+from utils.eta_utils import EtaPredictor
+from utils.fastresume_utils import manifest_path
 from utils.gameinfo_utils import fetch_game_info, extract_game_name
-from utils.image_utils import upload_images
+from utils.image_utils import upload_images_async
 from utils.imdb_utils import extract_imdb_link_from_nfo, get_imdb_info
-from utils.logging_utils import log_to_file, log_upload_details
+from utils.logging_utils import close_logs, log_event, log_upload_details
 from utils.login_utils import login
 from utils.mediainfo_utils import generate_mediainfo
 from utils.nfo_utils import process_nfo
+from utils.profile_utils import start_profiler, save_profile
+from utils.progress_utils import job_id
 from utils.screenshot_utils import generate_screenshots
 from utils.status_utils import update_status
 from utils.template_utils import prepare_template
+from utils.timing_utils import StageTimer
 from utils.torrent_utils import create_torrent, upload_torrent
+from utils.verify_utils import start_background_verify
 
 
 class CustomOutput(io.TextIOBase):
-    def __init__(self, original_stdout, db_path="data/terminal_output.db"):
+    def __init__(self, original_stdout):
         self.original_stdout = original_stdout
-        self.db_path = db_path
+        # Every run writes to its own ring of lines in terminal_logs, see set_job()
+        self.source = str(os.getpid())
+        self.line_number = 0
         self.ensure_db_initialized()
 
+    def set_job(self, directory_name):
+        """Tag the following output with the directory being uploaded, so the monitor can follow this job alone."""
+        self.source = job_id(directory_name)
+        self.line_number = 0
+
     def ensure_db_initialized(self):
-        """Initialize the SQLite database and the logs table if they don't exist."""
-        # Ensure the database directory exists
-        db_dir = os.path.dirname(self.db_path)
-        if not os.path.exists(db_dir):
-            os.makedirs(db_dir)
-
-        # Connect to the database and ensure the table exists
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS terminal_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
-                source TEXT,  -- Optional, can be used to differentiate uploaders
-                log_line TEXT
-            )
-        ''')
-        conn.commit()
-        conn.close()
+        """Open (and if needed create or migrate) the database, and drop the output of old runs."""
+        prune_terminal_logs()
 
     def write(self, message):
         """Write to terminal and store message in the database."""
@@ -69,17 +72,8 @@ class CustomOutput(io.TextIOBase):
         """Insert the log message into the SQLite database."""
         # Strip all ANSI color codes from the message
         message = re.sub(r'\033\[[0-9;]*m', '', message)
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-
-        # Insert the message into the logs table with the current timestamp
-        c.execute('''
-            INSERT INTO terminal_logs (log_line)
-            VALUES (?)
-        ''', (message,))
-
-        conn.commit()
-        conn.close()
+        insert_terminal_log(self.source, self.line_number, message)
+        self.line_number += 1
 
     def flush(self):
         """Flush the original stdout."""
@@ -95,15 +89,25 @@ class CustomOutput(io.TextIOBase):
 # Replace sys.stdout with CustomOutput
 sys.stdout = CustomOutput(sys.stdout)
 
-def log(message, file_path):
-    """Utility function to log messages to a file and print to the console."""
+# Latest release version from GitHub, cached so most runs never wait on the network
+VERSION_CACHE = Path('data/version_check.json')
+VERSION_CACHE_TTL = 24 * 60 * 60
+
+def log(message, level='info'):
+    """Utility function to log messages to the upload's log."""
     #print(message)
-    log_to_file(file_path, message)
+    log_event('backend', message, level)
 
 def calculate_directory_size(directory):
-    """Calculate the total size of files in a directory, including handling soft links."""
+    """Calculate the total size of files in a directory, including handling soft links.
+
+    Returns:
+        tuple: (size in MB, number of files)
+    """
     total_size = 0
+    file_count = 0
     for dirpath, dirnames, filenames in os.walk(directory):
+        file_count += len(filenames)
         for f in filenames:
             fp = os.path.join(dirpath, f)
             if os.path.islink(fp):
@@ -113,7 +117,7 @@ def calculate_directory_size(directory):
             else:
                 # If it's a real file, just add its size
                 total_size += os.path.getsize(fp)
-    return round(total_size / (1024 * 1024), 2)  # Size in MB
+    return round(total_size / (1024 * 1024), 2), file_count  # Size in MB
 
 def find_nfo_file(directory):
     """Find the .nfo file in the directory."""
@@ -128,6 +132,7 @@ def cleanup_tmp_dir(directory, cleanup_enabled):
     if cleanup_enabled:
         try:
             if directory.exists() and directory.is_dir():
+                close_logs(directory)
                 shutil.rmtree(directory)
                 print(f"Cleaned up temporary directory: {directory}{bcolors.ENDC}")
         except Exception as e:
@@ -137,51 +142,109 @@ def fail_exit(directory, cleanup_enabled):
     cleanup_tmp_dir(directory, cleanup_enabled)
     exit(1)
 
-def version_check(program_version):
-    # Get latest version number from GitHub
-    response = requests.get("https://api.github.com/repos/DigiCore404/dc_uploader/releases/latest")
+def fetch_latest_version():
+    """Get the latest release version number from GitHub.
+    Returns:
+        str: Version number without 'v' prefix, or None if it could not be fetched
+    """
     try:
+        response = http_utils.get('github', "https://api.github.com/repos/DigiCore404/dc_uploader/releases/latest")
         response.raise_for_status()
+        new_version = response.json()["name"]
     except HTTPError as e:
         print(f"{bcolors.WARNING}Received following HTTP code when trying to check version:\n"
               f"{e}\n"
               f"Unable to check for latest version, continuing without version check{bcolors.ENDC}")
-    else:
-        try:
-            new_version = response.json()["name"]
-            # Strip 'v' prefix if present
-            if new_version.startswith('v'):
-                new_version = new_version[1:]
-            if program_version.startswith('v'):
-                program_version = program_version[1:]
-
-            # Parse versions into components
-            new_parts = [int(x) for x in new_version.split('.')]
-            current_parts = [int(x) for x in program_version.split('.')]
-
-            # Pad shorter version with zeros for comparison
-            while len(new_parts) < len(current_parts):
-                new_parts.append(0)
-            while len(current_parts) < len(new_parts):
-                current_parts.append(0)
-
-            # Compare versions
-            if new_parts > current_parts:
-                print(
-                    f"{bcolors.WARNING}A newer version available: v{new_version} (you are on v{program_version})"
-                    f"{bcolors.ENDC}")
-            elif new_parts < current_parts:
-                print(
-                    f"{bcolors.WARNING}You're using a development version: v{program_version} "
-                    f"(latest stable is v{new_version}){bcolors.ENDC}")
-            else:
-                print(f"{bcolors.OKGREEN}You're using the latest version: v{program_version}{bcolors.ENDC}")
-        except KeyError:
-            print(f"{bcolors.WARNING}GitHub API response did not contain a version number. "
-                  f"Continuing without version check{bcolors.ENDC}")
-        except Exception as e:
-            print(f"{bcolors.WARNING}Error comparing versions: {str(e)}. "
-                  f"Continuing without version check{bcolors.ENDC}")
+        return None
+    except RequestException as e:
+        print(f"{bcolors.WARNING}Could not reach GitHub to check version: {e}\n"
+              f"Continuing without version check{bcolors.ENDC}")
+        return None
+    except (KeyError, ValueError):
+        print(f"{bcolors.WARNING}GitHub API response did not contain a version number. "
+              f"Continuing without version check{bcolors.ENDC}")
+        return None
+
+    # Strip 'v' prefix if present
+    if new_version.startswith('v'):
+        new_version = new_version[1:]
+    return new_version
+
+def compare_versions(program_version, new_version):
+    """Print whether the running version is older, newer or the same as the latest release."""
+    try:
+        if program_version.startswith('v'):
+            program_version = program_version[1:]
+
+        # Parse versions into components
+        new_parts = [int(x) for x in new_version.split('.')]
+        current_parts = [int(x) for x in program_version.split('.')]
+
+        # Pad shorter version with zeros for comparison
+        while len(new_parts) < len(current_parts):
+            new_parts.append(0)
+        while len(current_parts) < len(new_parts):
+            current_parts.append(0)
+
+        # Compare versions
+        if new_parts > current_parts:
+            print(
+                f"{bcolors.WARNING}A newer version available: v{new_version} (you are on v{program_version})"
+                f"{bcolors.ENDC}")
+        elif new_parts < current_parts:
+            print(
+                f"{bcolors.WARNING}You're using a development version: v{program_version} "
+                f"(latest stable is v{new_version}){bcolors.ENDC}")
+        else:
+            print(f"{bcolors.OKGREEN}You're using the latest version: v{program_version}{bcolors.ENDC}")
+    except Exception as e:
+        print(f"{bcolors.WARNING}Error comparing versions: {str(e)}. "
+              f"Continuing without version check{bcolors.ENDC}")
+
+def refresh_version_cache(program_version):
+    """Fetch the latest version from GitHub, cache it to disk and print the comparison."""
+    new_version = fetch_latest_version()
+    if new_version is None:
+        return
+    try:
+        VERSION_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        VERSION_CACHE.write_text(json.dumps({'checked': time.time(), 'latest': new_version}))
+    except OSError as e:
+        print(f"{bcolors.WARNING}Could not cache version check: {e}{bcolors.ENDC}")
+    compare_versions(program_version, new_version)
+
+def version_check(program_version):
+    """Compare the running version against the latest GitHub release without holding up the upload.
+
+    The latest version is cached in data/version_check.json for 24 hours. Within that window the comparison is
+    printed straight from the cache, otherwise GitHub is queried from a background thread.
+
+    Returns:
+        threading.Thread: The background refresh thread, or None if the cached version was used
+    """
+    try:
+        cached = json.loads(VERSION_CACHE.read_text())
+        if time.time() - cached['checked'] < VERSION_CACHE_TTL:
+            compare_versions(program_version, cached['latest'])
+            return None
+    except (OSError, ValueError, KeyError, TypeError):
+        pass  # Missing or unreadable cache, refresh it
+
+    thread = threading.Thread(target=refresh_version_cache, args=(program_version,), daemon=True)
+    thread.start()
+    return thread
+
+def parse_args():
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description="Upload a directory from DATADIR to digitalcore.club")
+    parser.add_argument('directory_name', nargs='?', help="Name of the directory inside DATADIR to upload")
+    parser.add_argument('--profile', action='store_true',
+                        help="Profile the run with cProfile and save the stats to data/profiles/. "
+                             "Can also be enabled for every upload with PROFILE in the [Settings] section")
+    parser.add_argument('--priority', choices=PRIORITIES, default='normal',
+                        help="Urgent uploads go first and may pause the hashing of others, smaller uploads go first "
+                             "within a priority")
+    return parser.parse_args()
 
 def main():
     """Main function to run the script."""
@@ -200,6 +263,16 @@ def main():
 
     program_version = "1.1.6"
 
+    # Per-stage wall-clock spans, stored with the upload once it has a row in the database
+    timer = StageTimer()
+    # CPU, disk, network and memory used by the upload and the tools it runs, stored with the upload too
+    account = ResourceAccount()
+    upload_id = None
+    # Job id of the row that shows this upload in the dashboard's queue, once it's registered
+    queue_job = None
+    profiler = None
+    args = parse_args()
+
     try:
         hasher = config.get('Torrent', 'HASHER').strip()
         template_path = Path(config.get('Paths', 'TEMPLATE_PATH'))
@@ -207,8 +280,6 @@ def main():
         # Ensure tmp_dir exists
         tmp_dir.mkdir(parents=True, exist_ok=True)
 
-        log_file_path = tmp_dir / 'main.log'
-
         # Ensure upload.log is created
         try:
             upload_log_path.touch(exist_ok=True)  # Create the file if it does not exist
@@ -217,22 +288,25 @@ def main():
             print(f"Error creating upload log: {str(e)}")
             fail_exit(tmp_dir, cleanup_enabled)
 
-        if len(sys.argv) > 1:
-            directory_name = sys.argv[1]
+        if args.directory_name:
+            directory_name = args.directory_name
+            sys.stdout.set_job(directory_name)
         else:
-            log("No directory name provided.", log_file_path)
+            log("No directory name provided.", 'error')
             fail_exit(tmp_dir, cleanup_enabled)
 
+        if args.profile or config.getboolean('Settings', 'PROFILE', fallback=False):
+            profiler = start_profiler()
+
         ascii_art_header("Header", program_version)
         version_check(program_version)
-        time.sleep(3) # Sleep 3 seconds so users can see our pretty header :)
 
         print(f"\n{bcolors.OKBLUE}Starting upload script...{bcolors.ENDC}")
 
         base_dir = config.get('Paths', 'DATADIR')
 
         if not base_dir:
-            log("DATADIR not found in config.", log_file_path)
+            log("DATADIR not found in config.", 'error')
             print(f"{bcolors.ENDC}{bcolors.FAIL}DATADIR not found in config.\n{bcolors.ENDC}")
             fail_exit(tmp_dir, cleanup_enabled)
         else:
@@ -242,21 +316,31 @@ def main():
         directory = base_dir / directory_name
 
         if not directory.exists():
-            log(f"The provided directory does not exist: {directory}", log_file_path)
+            log(f"The provided directory does not exist: {directory}", 'error')
             print(f"{bcolors.ENDC}{bcolors.FAIL}Directory does not exist: {directory}\n{bcolors.ENDC}")
             fail_exit(tmp_dir, cleanup_enabled)
 
         if hasher != 'torf' and hasher != 'mkbrr':
-            log(f"Unknown hasher: {hasher}", log_file_path)
+            log(f"Unknown hasher: {hasher}", 'error')
             print(f"{bcolors.ENDC}{bcolors.FAIL}Unknown hasher: {hasher}\n{bcolors.ENDC}")
             fail_exit(tmp_dir, cleanup_enabled)
 
         update_status(directory, 'uploading')
 
+        directory_size, file_count = calculate_directory_size(directory)
+        directory_size_bytes = int(directory_size * 1024 * 1024)
+
+        # Show the upload in the dashboard's queue, with the stage it's in, so eta_utils can predict when it's done
+        device = device_name(directory)
+        queue_job = job_id(directory_name)
+        save_upload_job(queue_job, os.getpid(), directory_name, PRIORITIES[args.priority], directory_size_bytes,
+                        file_count, device)
+        timer.on_stage = lambda stage: update_upload_job(queue_job, stage=stage, stage_started=time.time())
+
         # Initialize upload details dictionary
         upload_details = {"name": directory_name, "path": str(directory), "category": None,
                           "piece_size": None, "piece_size_bytes": None, "etor_started": None, "torrent_file": None,
-                          "etor_completed": None, 'size': f"{calculate_directory_size(directory)} MB",
+                          "etor_completed": None, 'size': f"{directory_size} MB",
                           'nfo': find_nfo_file(directory) or "NFO file not found"}
 
         # Check if settings are enabled
@@ -300,86 +384,95 @@ def main():
         ascii_art_header("Login")
         print(f"{bcolors.ENDC}{bcolors.YELLOW}Logging in...\n{bcolors.ENDC}")
         # Login and get cookies
-        try:
-            cookies = login()  # Call the login function from login.utils.py
-            if not cookies:
-                log_to_file(log_file_path, "Login failed. Cannot proceed with the script.")
-                print(f"{bcolors.RED}Login failed. Cannot proceed with the script.\n{bcolors.ENDC}")
+        with timer.stage('login'):
+            try:
+                cookies = login()  # Call the login function from login.utils.py
+                if not cookies:
+                    log("Login failed. Cannot proceed with the script.", 'error')
+                    print(f"{bcolors.RED}Login failed. Cannot proceed with the script.\n{bcolors.ENDC}")
+                    fail_exit(tmp_dir, cleanup_enabled)
+                else:
+                    print(f"{bcolors.OKGREEN}Login successful. Proceeding...\n{bcolors.ENDC}")
+                    # Continue with the rest of your script using the cookies
+                    # For example:
+                    # upload_data(cookies)
+            except Exception as e:
+                log(f"Error during login: {str(e)}", 'error')
+                print(f"{bcolors.FAIL}Error during login: {str(e)}\n{bcolors.ENDC}")
                 fail_exit(tmp_dir, cleanup_enabled)
-            else:
-                print(f"{bcolors.OKGREEN}Login successful. Proceeding...\n{bcolors.ENDC}")
-                # Continue with the rest of your script using the cookies
-                # For example:
-                # upload_data(cookies)
-        except Exception as e:
-            log_to_file(log_file_path, f"Error during login: {str(e)}")
-            print(f"{bcolors.FAIL}Error during login: {str(e)}\n{bcolors.ENDC}")
-            fail_exit(tmp_dir, cleanup_enabled)
 
-        insert_upload(name=directory_name)
+        upload_id = insert_upload(name=directory_name)
+        save_upload(upload_id, directory_name, size_bytes=directory_size_bytes, file_count=file_count, device=device)
 
         # Create process-specific directory in tmp_dir
         temp_dir = tmp_dir
 
         # Check for duplicates
-        try:
-            # Only run dupe check if both DUPECHECK and DUPEDL are enabled
-            if dupecheck_enabled and dupedl_enabled:
-                ascii_art_header("Dupe checking")
-                duplicate_found = check_and_download_dupe(directory_name, cookies)
-                if duplicate_found:
-                    log("Duplicate found. Skipping further operations.", log_file_path)
-                    update_status(directory, 'dupe')
-                    update_upload_status(name=directory_name, new_status='dupe')
-                    log_upload_details(upload_details, upload_log_path, duplicate_found=True)
-                    cleanup_tmp_dir(tmp_dir, cleanup_enabled)  # Clean up tmp_dir
-                    exit(0)
-            else:
-                log("Dupe check or download is disabled in the config.", log_file_path)
+        with timer.stage('dupe_check'):
+            try:
+                # Only run dupe check if both DUPECHECK and DUPEDL are enabled
+                if dupecheck_enabled and dupedl_enabled:
+                    ascii_art_header("Dupe checking")
+                    duplicate_found = check_and_download_dupe(directory_name, cookies)
+                    if duplicate_found:
+                        log("Duplicate found. Skipping further operations.")
+                        update_status(directory, 'dupe')
+                        update_upload_status(upload_id, directory_name, new_status='dupe')
+                        log_upload_details(upload_details, upload_log_path, duplicate_found=True)
+                        cleanup_tmp_dir(tmp_dir, cleanup_enabled)  # Clean up tmp_dir
+                        exit(0)
+                else:
+                    log("Dupe check or download is disabled in the config.")
 
-        except Exception as e:
-            log(f"Error checking for duplicates: {str(e)}", log_file_path)
-            cleanup_tmp_dir(tmp_dir, cleanup_enabled)  # Clean up tmp_dir
-            exit(1)
+            except Exception as e:
+                log(f"Error checking for duplicates: {str(e)}", 'error')
+                cleanup_tmp_dir(tmp_dir, cleanup_enabled)  # Clean up tmp_dir
+                exit(1)
 
         ascii_art_header("Category")
 
         # Determine the category of the torrent
-        category_name, category_id_str = determine_category(directory_name)
-        category_id = int(category_id_str)  # Convert category_id to integer
+        with timer.stage('category'):
+            category_name, category_id_str = determine_category(directory_name)
+            category_id = int(category_id_str)  # Convert category_id to integer
 
         upload_details['category'] = f"{category_name} ({category_id})"
-        update_upload_status(name=directory_name, new_status='uploading', size=f'{upload_details["size"]}', category=f'{category_name}')
+        update_upload_status(upload_id, directory_name, new_status='uploading', size=f'{upload_details["size"]}', category=f'{category_name}')
+        update_upload_job(queue_job, category=category_name)
+        # Predicted stage durations, so the slot queues can run the quickest stages first
+        expected_seconds = EtaPredictor.load().predict_stages(directory_size_bytes, file_count, category_name, device)
 
         # Initialize replacements dictionary with version info.
         replacements = {'!version!': program_version}
         ### Screenshots processing section
         if screenshots_enabled:
             ascii_art_header("Screenshots")
-            if category_id in screenshot_categories:
-                try:
-                    generate_screenshots(directory, category_id)
-                except Exception as e:
-                    log(f"Error generating screenshots: {str(e)}", log_file_path)
-                    fail_exit(tmp_dir, cleanup_enabled)
-            else:
-                log(f"Category ID {category_id} is not in the screenshot categories: {screenshot_categories}", log_file_path)
+            with timer.stage('screenshots'):
+                if category_id in screenshot_categories:
+                    try:
+                        generate_screenshots(directory, category_id)
+                    except Exception as e:
+                        log(f"Error generating screenshots: {str(e)}", 'error')
+                        fail_exit(tmp_dir, cleanup_enabled)
+                else:
+                    log(f"Category ID {category_id} is not in the screenshot categories: {screenshot_categories}")
         else:
-            log("Screenshots are disabled.", log_file_path)
+            log("Screenshots are disabled.")
 
         # Mediainfo processing
         mediainfo_content = ''
         if mediainfo_enabled:
             ascii_art_header("Mediainfo")
-            if category_id in mediainfo_categories:
-                try:
-                    mediainfo_file_path = generate_mediainfo(directory, temp_dir)
-                except Exception as e:
-                    log(f"Error generating mediainfo: {str(e)}", log_file_path)
-                else:
-                    if mediainfo_file_path.exists():
-                        with open(mediainfo_file_path, 'r') as file:
-                            mediainfo_content = file.read()
+            with timer.stage('mediainfo'):
+                if category_id in mediainfo_categories:
+                    try:
+                        mediainfo_file_path = generate_mediainfo(directory, temp_dir)
+                    except Exception as e:
+                        log(f"Error generating mediainfo: {str(e)}", 'error')
+                    else:
+                        if mediainfo_file_path.exists():
+                            with open(mediainfo_file_path, 'r') as file:
+                                mediainfo_content = file.read()
 
         # IMDb processing
         imdb_link = ''
@@ -388,31 +481,32 @@ def main():
 
             print(f"{bcolors.YELLOW}Searching for IMDB data\n{bcolors.ENDC}")
 
-            if category_id in imdb_movie_categories or category_id in imdb_tv_categories:
-                # Attempt to extract IMDb link from .nfo file
-                imdb_link = extract_imdb_link_from_nfo(directory)
+            with timer.stage('imdb'):
+                if category_id in imdb_movie_categories or category_id in imdb_tv_categories:
+                    # Attempt to extract IMDb link from .nfo file
+                    imdb_link = extract_imdb_link_from_nfo(directory)
 
-                if imdb_link:
-                    print(f"{bcolors.OKGREEN}IMDb link found in NFO: {imdb_link}\n{bcolors.ENDC}")
+                    if imdb_link:
+                        print(f"{bcolors.OKGREEN}IMDb link found in NFO: {imdb_link}\n{bcolors.ENDC}")
 
-                    update_upload_status(name=directory_name, imdb_url=imdb_link)  # Update IMDb URL in DB
-                elif category_id in imdb_movie_categories or category_id in imdb_tv_categories:
-                    if category_id in imdb_movie_categories:
-                        media_type = 'movie'
-                    else:
-                        media_type = 'tv'
-                    print(f"{bcolors.YELLOW}No IMDb link found in NFO or no NFO file present. "
-                          f"Attempting to extract details from directory name.\n{bcolors.ENDC}")
-                    # If found, will contain a dict with 'id', 'title', and 'year'
-                    imdb_info = get_imdb_info(directory_name, media_type)
-                    if imdb_info:
-                        imdb_link = f"https://www.imdb.com/title/{imdb_info['id']}/"
-
-                        print(f"{bcolors.OKGREEN}IMDb link found: {imdb_link}\n{bcolors.ENDC}")
-                        update_upload_status(name=directory_name, imdb_url=imdb_link)  # Update IMDb URL in DB
-            else:
-                print(f"{bcolors.YELLOW}Category ID {category_id} is not in the IMDb categories: "
-                      f"{imdb_movie_categories} or {imdb_tv_categories}{bcolors.ENDC}")
+                        update_upload_status(upload_id, directory_name, imdb_url=imdb_link)  # Update IMDb URL in DB
+                    elif category_id in imdb_movie_categories or category_id in imdb_tv_categories:
+                        if category_id in imdb_movie_categories:
+                            media_type = 'movie'
+                        else:
+                            media_type = 'tv'
+                        print(f"{bcolors.YELLOW}No IMDb link found in NFO or no NFO file present. "
+                              f"Attempting to extract details from directory name.\n{bcolors.ENDC}")
+                        # If found, will contain a dict with 'id', 'title', and 'year'
+                        imdb_info = get_imdb_info(directory_name, media_type)
+                        if imdb_info:
+                            imdb_link = f"https://www.imdb.com/title/{imdb_info['id']}/"
+
+                            print(f"{bcolors.OKGREEN}IMDb link found: {imdb_link}\n{bcolors.ENDC}")
+                            update_upload_status(upload_id, directory_name, imdb_url=imdb_link)  # Update IMDb URL in DB
+                else:
+                    print(f"{bcolors.YELLOW}Category ID {category_id} is not in the IMDb categories: "
+                          f"{imdb_movie_categories} or {imdb_tv_categories}{bcolors.ENDC}")
 
         imdb_id = re.search(r'tt\d+', imdb_link).group() if imdb_link else ''
 
@@ -422,49 +516,50 @@ def main():
 
             print(f"{bcolors.YELLOW}Fetching game information...\n{bcolors.ENDC}")
 
-            try:
-                # Use the correct function for extracting the game name from the release name or directory
-                game_name = extract_game_name(directory_name)  # Ensure this function exists and works
-
-                if game_name:
-                    print(f"{bcolors.YELLOW}Extracted Game Name: {game_name}{bcolors.ENDC}")
-
-                    # Fetch game information from IGDB
-                    game_info = fetch_game_info(game_name, directory_name)
-
-                    if game_info:
-                        # Extract relevant game info
-                        game_summary = game_info['summary']
-                        game_genres = ', '.join(game_info['genres'])
-                        game_release_date = game_info['release_date']
-
-                        # Prepare the game info content for the template with BBCode formatting
-                        gameinfo_content = (
-                            f"[b]Game:[/b] [color=purple]{game_info['game_name']}[/color]\n"
-                            f"[b]Summary:[/b] [i]{game_summary}[/i]\n"
-                            f"[b]Genres:[/b] [color=green]{game_genres}[/color]\n"
-                            f"[b]Release Date:[/b] [color=cyan]{game_release_date}[/color]\n"
-                        )
-
-                        # Log and display fetched game info
-                        print(f"{bcolors.GREEN}Fetched Game Info:\n{gameinfo_content}{bcolors.ENDC}")
-
-                        # Insert gameinfo content into replacements
-                        replacements['!gameinfo!'] = gameinfo_content
-                        print(f"{bcolors.GREEN}Game information successfully fetched and added to template!{bcolors.ENDC}")
+            with timer.stage('igdb'):
+                try:
+                    # Use the correct function for extracting the game name from the release name or directory
+                    game_name = extract_game_name(directory_name)  # Ensure this function exists and works
+
+                    if game_name:
+                        print(f"{bcolors.YELLOW}Extracted Game Name: {game_name}{bcolors.ENDC}")
+
+                        # Fetch game information from IGDB
+                        game_info = fetch_game_info(game_name, directory_name)
+
+                        if game_info:
+                            # Extract relevant game info
+                            game_summary = game_info['summary']
+                            game_genres = ', '.join(game_info['genres'])
+                            game_release_date = game_info['release_date']
+
+                            # Prepare the game info content for the template with BBCode formatting
+                            gameinfo_content = (
+                                f"[b]Game:[/b] [color=purple]{game_info['game_name']}[/color]\n"
+                                f"[b]Summary:[/b] [i]{game_summary}[/i]\n"
+                                f"[b]Genres:[/b] [color=green]{game_genres}[/color]\n"
+                                f"[b]Release Date:[/b] [color=cyan]{game_release_date}[/color]\n"
+                            )
+
+                            # Log and display fetched game info
+                            print(f"{bcolors.GREEN}Fetched Game Info:\n{gameinfo_content}{bcolors.ENDC}")
+
+                            # Insert gameinfo content into replacements
+                            replacements['!gameinfo!'] = gameinfo_content
+                            print(f"{bcolors.GREEN}Game information successfully fetched and added to template!{bcolors.ENDC}")
+                        else:
+                            # Handle case when no game info is found
+                            replacements['!gameinfo!'] = ''
+                            print(f"{bcolors.RED}No game information found for {game_name}.\n{bcolors.ENDC}")
                     else:
-                        # Handle case when no game info is found
+                        print(f"{bcolors.RED}Game name could not be extracted from the NFO or directory.\n{bcolors.ENDC}")
                         replacements['!gameinfo!'] = ''
-                        print(f"{bcolors.RED}No game information found for {game_name}.\n{bcolors.ENDC}")
-                else:
-                    print(f"{bcolors.RED}Game name could not be extracted from the NFO or directory.\n{bcolors.ENDC}")
-                    replacements['!gameinfo!'] = ''
 
-            except Exception as e:
-                # Handle exceptions and log errors
-                replacements['!gameinfo!'] = ''
-                log(f"Error fetching game information: {str(e)}", log_file_path)
-                print(f"{bcolors.RED}Error fetching game information: {str(e)}{bcolors.ENDC}")
+                except Exception as e:
+                    # Handle exceptions and log errors
+                    replacements['!gameinfo!'] = ''
+                    log(f"Error fetching game information: {str(e)}", 'error')
+                    print(f"{bcolors.RED}Error fetching game information: {str(e)}{bcolors.ENDC}")
         else:
             # If gameinfo is disabled or category is not in game categories
             replacements['!gameinfo!'] = ''
@@ -472,136 +567,137 @@ def main():
         ### Torrent creation section
         ascii_art_header("Create Torrent")
         # Create a torrent file and store it in the process-specific directory
-        try:
-            upload_details['etor_started'] = time.strftime('%a %b %d %H:%M:%S %Z %Y')
+        with stage_slot(job_id(directory_name), 'hashing', args.priority, directory_size_bytes,
+                        expected_seconds.get('hashing')), \
+                timer.stage('hashing', bytes_processed=directory_size_bytes):
+            try:
+                upload_details['etor_started'] = time.strftime('%a %b %d %H:%M:%S %Z %Y')
 
-            # Capture both torrent_file and piece_size from create_torrent
-            torrent_file, piece_size = create_torrent(directory, temp_dir,
-                                                      config.getboolean('Torrent', 'EDIT_TORRENT'), hasher)
+                # Capture both torrent_file and piece_size from create_torrent
+                torrent_file, piece_size = create_torrent(directory, temp_dir,
+                                                          config.getboolean('Torrent', 'EDIT_TORRENT'), hasher)
 
-            if torrent_file is None:
-                raise RuntimeError("Failed to create torrent file.")
+                if torrent_file is None:
+                    raise RuntimeError("Failed to create torrent file.")
 
-            upload_details['torrent_file'] = torrent_file
-            upload_details['piece_size'] = piece_size
-            upload_details['etor_completed'] = time.strftime('%a %b %d %H:%M:%S %Z %Y')
+                upload_details['torrent_file'] = torrent_file
+                upload_details['piece_size'] = piece_size
+                upload_details['etor_completed'] = time.strftime('%a %b %d %H:%M:%S %Z %Y')
 
-        except Exception as e:
-            log(f"Error creating torrent: {str(e)}", log_file_path)
-            update_upload_status(name=directory_name, new_status='failed')
-            fail_exit(tmp_dir, cleanup_enabled)
+            except Exception as e:
+                log(f"Error creating torrent: {str(e)}", 'error')
+                update_upload_status(upload_id, directory_name, new_status='failed')
+                fail_exit(tmp_dir, cleanup_enabled)
 
         # Image upload processing
         ascii_art_header("UploadImages")
         if image_upload_enabled:
-            print(f"{bcolors.YELLOW}Uploading images...\n{bcolors.ENDC}")
-            try:
-                # Collect all image URLs from the source directory
-                source_image_urls = upload_images(directory)
-
-                if source_image_urls:
-                    image_urls_str = '\n'.join(source_image_urls)
-                    update_upload_status(name=directory_name, image_url=image_urls_str)
-                    replacements['!imageupload!'] = '\n'.join(source_image_urls)
-                    print(f"{bcolors.GREEN}Image upload successful!\n{bcolors.ENDC}")  # Print success message
-                else:
-                    replacements['!imageupload!'] = ''
-                    print(f"No images found in the source directory.\n")  # Print no images found message
-
-                # Upload the screenshots and get URLs
-                if screenshots_enabled:
-                    print(f"{bcolors.YELLOW}Uploading screenshots...\n{bcolors.ENDC}")
+            print(f"{bcolors.YELLOW}Uploading images, screenshots and game images...\n{bcolors.ENDC}")
+            with stage_slot(job_id(directory_name), 'network', args.priority, directory_size_bytes,
+                            expected_seconds.get('image_upload')), \
+                    timer.stage('image_upload'):
+                try:
                     screenshots_dir = tmp_dir / 'screens'
-                    if screenshots_dir.exists():
-                        screenshot_urls = upload_images(screenshots_dir, is_screenshots=True)
-
-                        if screenshot_urls:
-                            screenshot_urls_str = '\n'.join(screenshot_urls)
-                            update_upload_status(name=directory_name, screenshot_url=screenshot_urls_str)
-                            replacements['!screenshots!'] = '\n'.join(screenshot_urls)
-                            print(f"{bcolors.GREEN}Screenshot upload successful!{bcolors.ENDC}")  # Print success message
-                        else:
-                            replacements['!screenshots!'] = ''
-                            print(f"No screenshots found.\n")  # Print no screenshots found message
-                    else:
-                        replacements['!screenshots!'] = ''
-                        print(f"Screenshots directory not found or no screenshots token.\n")
-
-                # Upload the game images if game info is available and game images exist
-                game_image_dir = tmp_dir / 'images'
-                if game_image_dir.exists() and any(game_image_dir.iterdir()):
-                    print(f"{bcolors.YELLOW}Uploading game images...\n{bcolors.ENDC}")
-
-                    # Sort files based on the number prefix (1-cover, 2-screenshot, etc.)
-                    sorted_images = sorted(game_image_dir.iterdir(), key=lambda x: int(x.name.split('-')[0]))
-
-                    # Ensure the first image is cover image if it exists
-                    cover_image = [img for img in sorted_images if '1-cover' in img.name]
-                    remaining_images = [img for img in sorted_images if '1-cover' not in img.name]
-
-                    # Combine the cover and remaining images, ensuring the cover is first
-                    sorted_images = cover_image + remaining_images
+                    game_image_dir = tmp_dir / 'images'
+                    upload_screenshots = screenshots_enabled and screenshots_dir.exists()
+                    upload_game_images = game_image_dir.exists() and any(game_image_dir.iterdir())
+
+                    async def upload_all_images():
+                        # Source images, screenshots and game images don't depend on each other, upload them concurrently
+                        async def nothing():
+                            return []
+                        return await asyncio.gather(
+                            upload_images_async(directory),
+                            upload_images_async(screenshots_dir, is_screenshots=True) if upload_screenshots else nothing(),
+                            upload_images_async(game_image_dir, is_screenshots=False) if upload_game_images else nothing()
+                        )
 
-                    # Pass the directory (sorted) to the upload_images function
-                    game_image_urls = upload_images(game_image_dir, is_screenshots=False)
+                    source_image_urls, screenshot_urls, game_image_urls = http_utils.run(upload_all_images())
 
-                    if game_image_urls:
-                        game_image_urls_str = '\n'.join(game_image_urls)
-                        update_upload_status(name=directory_name, image_url=game_image_urls_str)
-                        replacements['!gameimage!'] = '\n'.join(game_image_urls)
-                        print(f"{bcolors.GREEN}Game image upload successful!\n{bcolors.ENDC}")
+                    if source_image_urls:
+                        image_urls_str = '\n'.join(source_image_urls)
+                        update_upload_status(upload_id, directory_name, image_url=image_urls_str)
+                        replacements['!imageupload!'] = '\n'.join(source_image_urls)
+                        print(f"{bcolors.GREEN}Image upload successful!\n{bcolors.ENDC}")  # Print success message
+                    else:
+                        replacements['!imageupload!'] = ''
+                        print(f"No images found in the source directory.\n")  # Print no images found message
+
+                    # Screenshot URLs
+                    if screenshots_enabled:
+                        if upload_screenshots:
+                            if screenshot_urls:
+                                screenshot_urls_str = '\n'.join(screenshot_urls)
+                                update_upload_status(upload_id, directory_name, screenshot_url=screenshot_urls_str)
+                                replacements['!screenshots!'] = '\n'.join(screenshot_urls)
+                                print(f"{bcolors.GREEN}Screenshot upload successful!{bcolors.ENDC}")  # Print success message
+                            else:
+                                replacements['!screenshots!'] = ''
+                                print(f"No screenshots found.\n")  # Print no screenshots found message
+                        else:
+                            replacements['!screenshots!'] = ''
+                            print(f"Screenshots directory not found or no screenshots token.\n")
+
+                    # Game image URLs, if game info is available and game images exist
+                    if upload_game_images:
+                        if game_image_urls:
+                            game_image_urls_str = '\n'.join(game_image_urls)
+                            update_upload_status(upload_id, directory_name, image_url=game_image_urls_str)
+                            replacements['!gameimage!'] = '\n'.join(game_image_urls)
+                            print(f"{bcolors.GREEN}Game image upload successful!\n{bcolors.ENDC}")
+                        else:
+                            replacements['!gameimage!'] = ''
+                            print(f"No game images found.\n")
                     else:
                         replacements['!gameimage!'] = ''
-                        print(f"No game images found.\n")
-                else:
-                    replacements['!gameimage!'] = ''
-                    print(f"No game images directory found.")
+                        print(f"No game images directory found.")
 
-            except Exception as e:
-                log(f"Error uploading images: {str(e)}", log_file_path)
-                print(f"{bcolors.RED}Error uploading images: {str(e)}{bcolors.ENDC}")  # Print error message
+                except Exception as e:
+                    log(f"Error uploading images: {str(e)}", 'error')
+                    print(f"{bcolors.RED}Error uploading images: {str(e)}{bcolors.ENDC}")  # Print error message
 
         # Process .nfo file
         ascii_art_header("NFO")
         print(f"{bcolors.YELLOW}\nFinding NFO data...\n{bcolors.ENDC}")
-        try:
-            process_nfo(directory, replacements, log_file_path)
-        except Exception as e:
-            log(f"Error processing .nfo file: {str(e)}", log_file_path)
+        with timer.stage('template'):
+            try:
+                process_nfo(directory, replacements)
+            except Exception as e:
+                log(f"Error processing .nfo file: {str(e)}", 'error')
 
-        print(f"{bcolors.GREEN}Add directory name to template\n{bcolors.ENDC}")
-        replacements['!releasename!'] = directory_name
+            print(f"{bcolors.GREEN}Add directory name to template\n{bcolors.ENDC}")
+            replacements['!releasename!'] = directory_name
 
-       # Prepare and save the final template with all content
-        try:
-            output_template_path = os.path.join(tmp_dir, 'output_template.txt')
-            prepare_template(str(template_path), output_template_path, replacements)
+           # Prepare and save the final template with all content
+            try:
+                output_template_path = os.path.join(tmp_dir, 'output_template.txt')
+                prepare_template(str(template_path), output_template_path, replacements)
 
-            # Read the template content after replacements
-            with open(output_template_path, 'r', encoding='utf-8') as file:
-                template_content = file.read()
+                # Read the template content after replacements
+                with open(output_template_path, 'r', encoding='utf-8') as file:
+                    template_content = file.read()
 
-            # Remove empty lines
-            template_content = "\n".join([line for line in template_content.splitlines() if line.strip()])
+                # Remove empty lines
+                template_content = "\n".join([line for line in template_content.splitlines() if line.strip()])
 
-            # Remove empty BBCode tags (e.g., [tag][/tag], [tag][tag2][/tag2][/tag])
-            template_content = re.sub(r'\[([a-zA-Z0-9]+)]\s*\[/\1]', '', template_content)
+                # Remove empty BBCode tags (e.g., [tag][/tag], [tag][tag2][/tag2][/tag])
+                template_content = re.sub(r'\[([a-zA-Z0-9]+)]\s*\[/\1]', '', template_content)
 
-            # Save the cleaned content back to the file
-            with open(output_template_path, 'w', encoding='utf-8') as file:
-                file.write(template_content)
+                # Save the cleaned content back to the file
+                with open(output_template_path, 'w', encoding='utf-8') as file:
+                    file.write(template_content)
 
-            # Correctly use the path to the file, not the content itself
-            template_content = output_template_path  # This ensures the path is used later
+                # Correctly use the path to the file, not the content itself
+                template_content = output_template_path  # This ensures the path is used later
 
-        except FileNotFoundError as e:
-            log(f"File not found: {str(e)}", log_file_path)
-            update_upload_status(name=directory_name, new_status='failed')
-            fail_exit(tmp_dir, cleanup_enabled)
-        except Exception as e:
-            log(f"Error preparing template: {str(e)}", log_file_path)
-            update_upload_status(name=directory_name, new_status='failed')
-            fail_exit(tmp_dir, cleanup_enabled)
+            except FileNotFoundError as e:
+                log(f"File not found: {str(e)}", 'error')
+                update_upload_status(upload_id, directory_name, new_status='failed')
+                fail_exit(tmp_dir, cleanup_enabled)
+            except Exception as e:
+                log(f"Error preparing template: {str(e)}", 'error')
+                update_upload_status(upload_id, directory_name, new_status='failed')
+                fail_exit(tmp_dir, cleanup_enabled)
 
         # Upload the torrent
         ascii_art_header("Uploading")
@@ -616,33 +712,70 @@ def main():
         #print(f"Mediainfo content length: {len(mediainfo_content) if mediainfo_content else '0'}")
 
         # Log variables
-        log(f"Torrent file: {torrent_file}", log_file_path)
-        log(f"Template content: {template_content}", log_file_path)
-        log(f"Cookies: {cookies}", log_file_path)
-        log(f"Category ID: {category_id}", log_file_path)
-        log(f"IMDB ID: {imdb_id}", log_file_path)
-        log(f"Mediainfo content length: {len(mediainfo_content) if mediainfo_content else '0'}", log_file_path)
+        log_event('backend', "Uploading torrent", torrent_file=str(torrent_file), template=template_content,
+                  category_id=category_id, imdb_id=imdb_id,
+                  mediainfo_length=len(mediainfo_content) if mediainfo_content else 0)
+        # Cookie names only, their values are credentials
+        log_event('backend', "Cookies", 'debug', cookies=sorted(cookies.keys()))
         # Initialize upload details dictionary
 
-        try:
-            upload_torrent(torrent_file, template_content, cookies, category_id, imdb_id, mediainfo_content, dupedl_enabled)
-            log_upload_details(upload_details, upload_log_path, duplicate_found=False)
-            update_status(directory, 'uploaded')
-            update_upload_status(name=directory_name, new_status='uploaded')
-            print(f"Torrent uploaded successfully. Details logged at: {upload_log_path}")
-        except Exception as e:
-            log(f"Error uploading torrent: {str(e)}", log_file_path)
-            # Optionally, you can log details even when an exception occurs, if relevant
-            #log_upload_details(upload_details, upload_log_path, duplicate_found=False)
-            print(f"Failed to upload torrent. Error: {str(e)}")
-            update_upload_status(name=directory_name, new_status='failed')
-            fail_exit(tmp_dir, cleanup_enabled)
+        with stage_slot(job_id(directory_name), 'network', args.priority, directory_size_bytes,
+                        expected_seconds.get('tracker_upload')), \
+                timer.stage('tracker_upload'):
+            try:
+                upload_torrent(torrent_file, template_content, cookies, category_id, imdb_id, mediainfo_content, dupedl_enabled)
+                log_upload_details(upload_details, upload_log_path, duplicate_found=False)
+                update_status(directory, 'uploaded')
+                update_upload_status(upload_id, directory_name, new_status='uploaded')
+                print(f"Torrent uploaded successfully. Details logged at: {upload_log_path}")
+            except Exception as e:
+                log(f"Error uploading torrent: {str(e)}", 'error')
+                # Optionally, you can log details even when an exception occurs, if relevant
+                #log_upload_details(upload_details, upload_log_path, duplicate_found=False)
+                print(f"Failed to upload torrent. Error: {str(e)}")
+                update_upload_status(upload_id, directory_name, new_status='failed')
+                fail_exit(tmp_dir, cleanup_enabled)
+
+        # Only reused torrents need it, a torrent hashed here has a hash manifest and was checked by hashing it
+        if config.getboolean('Torrent', 'VERIFY_AFTER_UPLOAD', fallback=False) \
+                and not manifest_path(torrent_file).exists():
+            try:
+                verify_log = start_background_verify(torrent_file, directory, directory_name)
+                print(f"{bcolors.OKBLUE}Full verification running in the background, see {verify_log}{bcolors.ENDC}")
+            except OSError as e:
+                print(f"{bcolors.WARNING}Could not start background verification: {e}{bcolors.ENDC}")
     except KeyboardInterrupt:
         # Cleanup on keyboard interrupt
         print(f"\nKeyboard interrupt detected. Cleaning up and exiting...")
-        update_upload_status(name=directory_name, new_status='failed')
+        if upload_id is not None:
+            update_upload_status(upload_id, directory_name, new_status='failed')
         fail_exit(tmp_dir, cleanup_enabled)
     finally:
+        if profiler is not None:
+            profile = save_profile(profiler, directory_name)
+            if upload_id is not None:
+                try:
+                    set_upload_profile(upload_id, directory_name, profile)
+                except sqlite3.Error as e:
+                    print(f"{bcolors.WARNING}Could not save profile filename: {e}{bcolors.ENDC}")
+        if upload_id is not None and timer.spans:
+            print(f"{bcolors.OKBLUE}Stage timings:\n{timer.summary()}{bcolors.ENDC}")
+            try:
+                insert_stage_timings(upload_id, timer.spans)
+            except sqlite3.Error as e:
+                print(f"{bcolors.WARNING}Could not save stage timings: {e}{bcolors.ENDC}")
+        if upload_id is not None:
+            usage = account.totals()
+            print(f"{bcolors.OKBLUE}Resources: {format_usage(usage)}{bcolors.ENDC}")
+            try:
+                save_upload(upload_id, directory_name, **usage)
+            except sqlite3.Error as e:
+                print(f"{bcolors.WARNING}Could not save resource usage: {e}{bcolors.ENDC}")
+        if queue_job is not None:
+            try:
+                delete_upload_jobs([queue_job])
+            except sqlite3.Error as e:
+                print(f"{bcolors.WARNING}Could not remove upload from the queue: {e}{bcolors.ENDC}")
         cleanup_tmp_dir(tmp_dir, cleanup_enabled)
 
 if __name__ == "__main__":
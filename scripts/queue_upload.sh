@@ -34,6 +34,11 @@ fi
 red='\033[0;31m'
 ncl='\033[0m'
 
+# Uploads started at once, the backends themselves wait for hashing and network slots
+queue_jobs="$(awk -F '=' '/^QUEUE_JOBS[[:space:]]*=/ {gsub(/^[[:space:]]+|[[:space:]]+$/, "", $2); print $2}' "$root_dir/config.ini")"
+if ! [[ "$queue_jobs" =~ ^[1-9][0-9]*$ ]]; then
+    queue_jobs=1
+fi
 data_dir="$(awk -F '=' '/^DATADIR[[:space:]]*=/ {gsub(/^[[:space:]]+|[[:space:]]+$/, "", $2); print $2}' "$root_dir/config.ini")"
 # In case user put in a trailing forward slash to DATADIR
 data_dir=$(realpath -s "$data_dir")
@@ -128,10 +133,19 @@ if [ -f "$log_file" ]; then
         fi
 fi
 
-while IFS= read -r line; do
-    if ./upload.sh "$line" "$ARG"; then
-        echo "Successfully uploaded $line" >> "$log_file"
+run_upload() {
+    if ./upload.sh "$1" "$ARG"; then
+        echo "Successfully uploaded $1" >> "$log_file"
     else
-        echo "Error when uploading $line" >> "$log_file"
+        echo "Error when uploading $1" >> "$log_file"
     fi
-done < "$queue_file"
\ No newline at end of file
+}
+
+while IFS= read -r line; do
+    # Wait for one of the running uploads to finish before starting another
+    while [ "$(jobs -rp | wc -l)" -ge "$queue_jobs" ]; do
+        wait -n || true
+    done
+    run_upload "$line" < /dev/null &
+done < "$queue_file"
+wait
\ No newline at end of file
@@ -169,19 +169,21 @@ if ! [ -d "$data_dir/$uploaded_directory" ]; then
     echo "$uploaded_directory not already in $data_dir, creating it with specified option"
     if $LN; then
         # Hardlink, fallback to symlink otherwise
-        if ! cp -alv --strip-trailing-slashes -t "$data_dir" "$data_path"; then
-            echo -e "${ylw}Could not hardlink, falling back to symlink${ncl}"
-            ln -sv -t "$data_dir" "$data_path" || exit 1
-        fi
+        ingest_mode="--ln"
     elif $CP; then
-        # Copy
-        cp -av --strip-trailing-slashes -t "$data_dir" "$data_path" || exit 1
+        # Copy, using reflinks or parallel in-kernel copies where possible
+        ingest_mode="--cp"
     elif $MV; then
-        mv -v --strip-trailing-slashes -t "$data_dir" "$data_path" || exit 1
+        ingest_mode="--mv"
     else
         echo -e "${red}ERROR: Cannot create data to upload. When providing a path that is outside of DATADIR," \
         "move, copy, or link MUST be specified.${ncl}" >&2
     fi
+
+    if [ -n "$ingest_mode" ]; then
+        source "/venv/dc_uploader/bin/activate"
+        python3 -m utils.ingest_utils "$ingest_mode" "$data_path" "$data_dir" || exit 1
+    fi
 fi
 
 # Run using venv
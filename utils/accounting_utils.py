@@ -0,0 +1,168 @@
+import argparse
+import os
+import resource
+import threading
+import time
+
+from utils import http_utils
+
+# Processes that detach instead of being waited for, like the rar2fs daemon. getrusage(RUSAGE_CHILDREN) and
+# /proc/self/io only include children once they are reaped, so these are sampled from /proc before they go away.
+_detached = []
+_detached_lock = threading.Lock()
+
+
+def read_proc_io(pid='self'):
+    """Get the counters of /proc/<pid>/io, empty if the kernel doesn't provide them.
+
+    For a process the counters include its children that have been waited for, so for this process they cover every
+    tool run through subprocess.
+    """
+    try:
+        with open(f'/proc/{pid}/io') as f:
+            return {key: int(value) for key, value in (line.split(': ') for line in f.read().splitlines() if line)}
+    except (OSError, ValueError):
+        return {}
+
+
+def sample_process(pid):
+    """Get the usage of a running process we can't wait for.
+
+    Returns:
+        dict: 'cpu_seconds' (with its reaped children), 'read_bytes' and 'peak_rss' in bytes, None if it's gone
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # Fields after the command name, which may itself contain spaces. utime is field 14 of proc(5).
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/status') as f:
+            status = dict(line.split(':', 1) for line in f.read().splitlines() if ':' in line)
+    except OSError:
+        return None
+    ticks = os.sysconf('SC_CLK_TCK')
+    return {'cpu_seconds': sum(int(value) for value in fields[11:15]) / ticks,
+            'read_bytes': read_proc_io(pid).get('read_bytes', 0),
+            'peak_rss': int(status.get('VmHWM', '0 kB').split()[0]) * 1024}
+
+
+def find_processes(*arguments):
+    """Get the pids of the processes whose command line contains all of `arguments`."""
+    pids = []
+    for entry in os.scandir('/proc'):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry.name}/cmdline', 'rb') as f:
+                command = f.read().decode(errors='replace').split('\0')
+        except OSError:
+            continue
+        if all(argument in command for argument in arguments):
+            pids.append(int(entry.name))
+    return pids
+
+
+def record_detached(*arguments):
+    """Add the usage of the detached processes running with `arguments`, call it right before stopping them."""
+    for pid in find_processes(*arguments):
+        usage = sample_process(pid)
+        if usage:
+            with _detached_lock:
+                _detached.append(usage)
+
+
+class ResourceAccount:
+    """What an upload costs: its own CPU, memory and I/O, and that of every tool it ran."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.own = resource.getrusage(resource.RUSAGE_SELF)
+        self.children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.io = read_proc_io()
+        self.sent = http_utils.sent_bytes()
+
+    def totals(self):
+        """Get the usage since the account was opened.
+
+        Peak RSS is the largest of this process and of any single child, not a sum: it's what the machine needs for
+        the upload when the tools run one after another.
+
+        Returns:
+            dict: Values for the wall_seconds, cpu_seconds, child_cpu_seconds, read_bytes, sent_bytes, peak_rss and
+                  child_peak_rss upload fields
+        """
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        with _detached_lock:
+            detached = list(_detached)
+        cpu = lambda usage: usage.ru_utime + usage.ru_stime
+        return {
+            'wall_seconds': time.monotonic() - self.started,
+            'cpu_seconds': cpu(own) - cpu(self.own),
+            'child_cpu_seconds': cpu(children) - cpu(self.children) + sum(d['cpu_seconds'] for d in detached),
+            # Disk reads only, pages already in the page cache cost no I/O
+            'read_bytes': read_proc_io().get('read_bytes', 0) - self.io.get('read_bytes', 0)
+                          + sum(d['read_bytes'] for d in detached),
+            'sent_bytes': http_utils.sent_bytes() - self.sent,
+            # ru_maxrss is in KiB on Linux
+            'peak_rss': own.ru_maxrss * 1024,
+            'child_peak_rss': max([children.ru_maxrss * 1024] + [d['peak_rss'] for d in detached]),
+        }
+
+
+def format_bytes(count):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if count < 1024:
+            return f"{count:.1f} {unit}"
+        count /= 1024
+    return f"{count:.1f} TiB"
+
+
+def format_usage(totals):
+    """One printable line of ResourceAccount.totals()."""
+    return (f"{totals['wall_seconds']:.1f}s wall, {totals['cpu_seconds']:.1f}s CPU "
+            f"+ {totals['child_cpu_seconds']:.1f}s in tools, {format_bytes(totals['read_bytes'])} read from disk, "
+            f"{format_bytes(totals['sent_bytes'])} sent, peak RSS {format_bytes(totals['peak_rss'])} "
+            f"(tools {format_bytes(totals['child_peak_rss'])})")
+
+
+def check():
+    """Account a child that burns CPU and memory, and a detached one, and check both are counted."""
+    import subprocess
+    import sys
+    account = ResourceAccount()
+    subprocess.run([sys.executable, '-c', 'b = bytearray(200 * 2 ** 20); sum(range(3 * 10 ** 7))'], check=True)
+    totals = account.totals()
+    print(format_usage(totals))
+    assert totals['child_cpu_seconds'] > 0.3, totals
+    assert totals['child_peak_rss'] > 200 * 2 ** 20, totals
+
+    marker = f'accounting-check-{os.getpid()}'
+    # Started in the background by a shell that exits right away, like a daemon that forks
+    subprocess.run(['sh', '-c', f'"{sys.executable}" -c "import time; sum(range(2 * 10 ** 7)); time.sleep(30)" '
+                                f'{marker} > /dev/null &'], check=True)
+    time.sleep(2)
+    record_detached(marker)
+    for pid in find_processes(marker):
+        os.kill(pid, 9)
+    detached = account.totals()['child_cpu_seconds'] - totals['child_cpu_seconds']
+    print(f"Detached process used {detached:.2f}s CPU")
+    assert detached > 0.2
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-upload resource accounting")
+    parser.add_argument('command', nargs='?', choices=('status', 'check'), default='status')
+    args = parser.parse_args()
+    if args.command == 'check':
+        check()
+        return
+
+    from utils.database_utils import fetch_resource_usage
+    for row in fetch_resource_usage(20):
+        totals = dict(zip(('wall_seconds', 'cpu_seconds', 'child_cpu_seconds', 'read_bytes', 'sent_bytes',
+                           'peak_rss', 'child_peak_rss'), row[5:]))
+        print(f"{row[1]} ({row[3]}): {format_usage(totals)}")
+
+
+if __name__ == '__main__':
+    main()
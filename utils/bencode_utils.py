@@ -0,0 +1,360 @@
+import hashlib
+import re
+
+
+# One bencode token: start of a list/dict, end of a container, an integer, or a string's length prefix
+_TOKEN = re.compile(rb'(?P<open>[ld])|(?P<end>e)|i-?\d+e|(?P<string>\d+):')
+
+
+class BencodeError(ValueError):
+    pass
+
+
+def decode(data):
+    """Decode bencoded bytes. Strings stay bytes, dictionary keys included, like bencodepy.
+
+    Args:
+        data (bytes): Bencoded data, e.g. the contents of a .torrent file
+
+    Returns:
+        The decoded int, bytes, list or dict
+    """
+    try:
+        value, end = _decode(data, 0)
+    except (IndexError, ValueError) as e:
+        raise BencodeError(f"Invalid bencoded data: {e}") from e
+    if end != len(data):
+        raise BencodeError(f"Invalid bencoded data: {len(data) - end} trailing bytes")
+    return value
+
+
+def _decode(data, index):
+    """Decode the value starting at data[index] and return it with the index right after it."""
+    token = data[index:index + 1]
+    if token == b'i':
+        end = data.index(b'e', index)
+        return int(data[index + 1:end]), end + 1
+    if token == b'l':
+        items = []
+        index += 1
+        while data[index:index + 1] != b'e':
+            item, index = _decode(data, index)
+            items.append(item)
+        return items, index + 1
+    if token == b'd':
+        items = {}
+        index += 1
+        while data[index:index + 1] != b'e':
+            key, index = _decode(data, index)
+            if not isinstance(key, bytes):
+                raise BencodeError(f"Dictionary key at {index} is not a string")
+            items[key], index = _decode(data, index)
+        return items, index + 1
+    if token.isdigit():
+        colon = data.index(b':', index)
+        start = colon + 1
+        end = start + int(data[index:colon])
+        if end > len(data):
+            raise BencodeError(f"String at {index} runs past the end of the data")
+        return data[start:end], end
+    raise BencodeError(f"Unexpected {token!r} at {index}")
+
+
+def encode(value):
+    """Bencode an int, str, bytes, list or dict. Dictionary keys are sorted as the spec requires."""
+    chunks = []
+    _encode(value, chunks)
+    return b''.join(chunks)
+
+
+def _encode(value, chunks):
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        chunks.append(b'i%de' % value)
+    elif isinstance(value, (bytes, str)):
+        if isinstance(value, str):
+            value = value.encode()
+        chunks.append(b'%d:' % len(value))
+        chunks.append(value)
+    elif isinstance(value, (list, tuple)):
+        chunks.append(b'l')
+        for item in value:
+            _encode(item, chunks)
+        chunks.append(b'e')
+    elif isinstance(value, dict):
+        chunks.append(b'd')
+        items = [(key.encode() if isinstance(key, str) else key, item) for key, item in value.items()]
+        for key, item in sorted(items):
+            _encode(key, chunks)
+            _encode(item, chunks)
+        chunks.append(b'e')
+    else:
+        raise BencodeError(f"Can't bencode {type(value).__name__}")
+
+
+def skip(data, index):
+    """Return the index right after the value starting at data[index], without decoding it.
+
+    Strings are jumped over by their length prefix, so a multi-megabyte pieces string costs the same as a short one,
+    and containers are walked with a depth counter instead of recursion.
+    """
+    depth = 0
+    match = _TOKEN.match
+    while True:
+        token = match(data, index)
+        if token is None:
+            raise BencodeError(f"Unexpected {data[index:index + 1]!r} at {index}")
+        index = token.end()
+        kind = token.lastgroup
+        if kind == 'string':
+            index += int(token.group('string'))
+            if index > len(data):
+                raise BencodeError(f"String at {token.start()} runs past the end of the data")
+        elif kind == 'open':
+            depth += 1
+            continue
+        elif kind == 'end':
+            depth -= 1
+            if depth < 0:
+                raise BencodeError(f"Unexpected end at {token.start()}")
+        if depth == 0:
+            return index
+
+
+def dict_spans(data, start=0):
+    """Map every key of the dictionary at data[start] to the (start, end) of its still encoded value.
+
+    Returns:
+        tuple: ({key: (value start, value end)}, index right after the dictionary)
+    """
+    try:
+        if data[start] != 0x64:
+            raise BencodeError(f"Expected a dictionary at {start}")
+        spans = {}
+        index = start + 1
+        while data[index] != 0x65:
+            key, index = _decode(data, index)
+            if not isinstance(key, bytes):
+                raise BencodeError(f"Dictionary key at {index} is not a string")
+            end = skip(data, index)
+            spans[key] = (index, end)
+            index = end
+        return spans, index + 1
+    except BencodeError:
+        raise
+    except (IndexError, ValueError) as e:
+        raise BencodeError(f"Invalid bencoded data: {e}") from e
+
+
+def edit_dict(data, spans, changes, keep=None):
+    """Rewrite a dictionary from its value spans, only encoding what changes.
+
+    Args:
+        data (bytes): Data the spans point into
+        spans (dict): From dict_spans()
+        changes (dict): Key to list of already bencoded chunks, replacing or adding that key
+        keep (iterable): Keys to carry over unchanged, None to keep every key
+
+    Returns:
+        list: Chunks of the new dictionary. Unchanged values are memoryviews into data, nothing is copied.
+    """
+    view = memoryview(data)
+    keys = set(changes) | {key for key in spans if keep is None or key in keep}
+    chunks = [b'd']
+    for key in sorted(keys):
+        chunks.append(encode(key))
+        if key in changes:
+            chunks.extend(changes[key])
+        else:
+            start, end = spans[key]
+            chunks.append(view[start:end])
+    chunks.append(b'e')
+    return chunks
+
+
+def edit_torrent(data, changes, info_changes, keep=None, info_keep=None):
+    """Rewrite a .torrent without decoding it, only the changed top level and info keys are encoded.
+
+    The infohash is hashed chunk by chunk while the info dictionary is assembled, so it never exists as one string.
+
+    Args:
+        data (bytes): The .torrent file
+        changes (dict): Top level key to new value, see edit_dict() for keep
+        info_changes (dict): Info key to new value
+        keep (iterable): Top level keys to carry over, None for all
+        info_keep (iterable): Info keys to carry over, None for all
+
+    Returns:
+        tuple: (chunks of the new .torrent, new infohash as hex, {info key: old encoded value as memoryview})
+    """
+    spans, end = dict_spans(data)
+    if end != len(data):
+        raise BencodeError(f"Invalid bencoded data: {len(data) - end} trailing bytes")
+    if b'info' not in spans:
+        raise BencodeError("Torrent has no info dictionary")
+    info_spans, _ = dict_spans(data, spans[b'info'][0])
+
+    info_chunks = edit_dict(data, info_spans, {key: [encode(value)] for key, value in info_changes.items()},
+                            info_keep)
+    infohash = hashlib.sha1()
+    for chunk in info_chunks:
+        infohash.update(chunk)
+
+    top_changes = {key: [encode(value)] for key, value in changes.items()}
+    top_changes[b'info'] = info_chunks
+    view = memoryview(data)
+    old_info = {key: view[start:end] for key, (start, end) in info_spans.items()}
+    return edit_dict(data, spans, top_changes, keep), infohash.hexdigest(), old_info
+
+
+class HashingWriter:
+    """File wrapper that hashes what is written while a flag is set, for the infohash of a streamed info dict."""
+
+    def __init__(self, file):
+        self.file = file
+        self.hash = None
+
+    def write(self, data):
+        if self.hash is not None:
+            self.hash.update(data)
+        self.file.write(data)
+
+
+def write_torrent(file, fields, info_fields, file_entries=None, batch=1000):
+    """Stream a .torrent to a file without building it in memory, computing the infohash on the way.
+
+    Args:
+        file: Binary file object to write to
+        fields (dict): Top level keys except info, e.g. {b'announce': ...}
+        info_fields (dict): Info keys except files, e.g. name, piece length, pieces (any bytes-like), private
+        file_entries (iterable): Bencoded entries of the files list, e.g. FileList.bencoded_entries(), None for a
+                                 single-file torrent
+        batch (int): Entries joined per write
+
+    Returns:
+        str: The infohash as hex
+    """
+    out = HashingWriter(file)
+    keys = sorted(set(fields) | {b'info'})
+    info_keys = sorted(set(info_fields) | ({b'files'} if file_entries is not None else set()))
+
+    out.write(b'd')
+    for key in keys:
+        out.write(encode(key))
+        if key != b'info':
+            out.write(encode(fields[key]))
+            continue
+
+        out.hash = hashlib.sha1()
+        out.write(b'd')
+        for info_key in info_keys:
+            out.write(encode(info_key))
+            if info_key == b'files':
+                out.write(b'l')
+                pending = []
+                for entry in file_entries:
+                    pending.append(entry)
+                    if len(pending) >= batch:
+                        out.write(b''.join(pending))
+                        pending = []
+                out.write(b''.join(pending) + b'e')
+            elif isinstance(info_fields[info_key], (bytes, bytearray, memoryview)):
+                # Written as is, so a large pieces buffer is never copied
+                value = info_fields[info_key]
+                out.write(b'%d:' % len(value))
+                out.write(value)
+            else:
+                out.write(encode(info_fields[info_key]))
+        out.write(b'e')
+        infohash = out.hash.hexdigest()
+        out.hash = None
+    out.write(b'e')
+    return infohash
+
+
+def benchmark(file_count=50000, piece_count=200000):
+    """Time editing a large multi-file torrent: torf round trip, full decode/encode, and edit_torrent()."""
+    import os
+    import sys
+    import tempfile
+    import time
+    import tracemalloc
+
+    metainfo = {
+        b'announce': b'https://tracker.example/announce',
+        b'announce-list': [[b'https://tracker.example/announce']],
+        b'comment': b'Original comment',
+        b'creation date': 1700000000,
+        b'info': {
+            b'name': b'Benchmark.Release',
+            b'piece length': 2 ** 20,
+            b'pieces': os.urandom(20 * piece_count),
+            b'files': [{b'length': 2 ** 20 * piece_count // file_count,
+                        b'path': [b'CD%d' % (i % 10), b'file.%06d.rar' % i]} for i in range(file_count)],
+        },
+    }
+    # Keep the total length consistent with the piece count so torf accepts the torrent
+    metainfo[b'info'][b'files'][0][b'length'] += 2 ** 20 * piece_count % file_count
+    data = encode(metainfo)
+    changes = {b'announce': 'https://tracker.example/new', b'comment': 'New comment', b'created by': 'Benchmark'}
+    info_changes = {b'source': 'Benchmark', b'private': 1}
+
+    def torf_edit(path, output):
+        from torf import Torrent
+        torrent = Torrent.read(path)
+        torrent.trackers = [changes[b'announce']]
+        torrent.comment = changes[b'comment']
+        torrent.created_by = changes[b'created by']
+        torrent.source = info_changes[b'source']
+        torrent.private = True
+        Torrent.copy(torrent).write(output, overwrite=True)
+
+    def decode_edit(path, output):
+        with open(path, 'rb') as f:
+            decoded = decode(f.read())
+        decoded.update(changes)
+        decoded[b'info'].update(info_changes)
+        with open(output, 'wb') as f:
+            f.write(encode(decoded))
+        return hashlib.sha1(encode(decoded[b'info'])).hexdigest()
+
+    def stream_edit(path, output):
+        with open(path, 'rb') as f:
+            chunks, infohash, _ = edit_torrent(f.read(), changes, info_changes)
+        with open(output, 'wb') as f:
+            f.writelines(chunks)
+        return infohash
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'input.torrent')
+        with open(path, 'wb') as f:
+            f.write(data)
+        print(f"{file_count} files, {piece_count} pieces, {len(data) / 2 ** 20:.1f} MiB .torrent")
+        print(f"{'method':>14} {'seconds':>8} {'peak MiB':>9}")
+        hashes = {}
+        for name, method in (('torf', torf_edit), ('decode/encode', decode_edit), ('edit_torrent', stream_edit)):
+            output = os.path.join(tmp, f'{name.replace("/", "_")}.torrent')
+            start = time.perf_counter()
+            try:
+                hashes[name] = method(path, output)
+            except ImportError:
+                continue
+            elapsed = time.perf_counter() - start
+            # Second run for memory only, tracemalloc slows everything down too much to time with it
+            tracemalloc.start()
+            method(path, output)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{name:>14} {elapsed:>8.2f} {peak / 2 ** 20:>9.1f}")
+        if hashes['decode/encode'] != hashes['edit_torrent']:
+            print("edit_torrent infohash differs from a full re-encode")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        benchmark(*(int(arg) for arg in sys.argv[2:4]))
+    else:
+        print("Usage: python -m utils.bencode_utils benchmark [files] [pieces]")
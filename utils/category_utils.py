@@ -1,16 +1,14 @@
 import os
 import re
-from configparser import ConfigParser
 
 from utils.bcolors import bcolors
+from utils.config_loader import ConfigLoader
 from utils.filters_utils import load_filters
 
 
 def load_config(config_file='config.ini'):
     """Load the configuration from the specified file."""
-    config = ConfigParser()
-    config.read(config_file)
-    return config
+    return ConfigLoader(config_file).get_config()
 
 def check_for_mp3_files(directory_path):
     """Check if there are any .mp3 files in the given directory."""
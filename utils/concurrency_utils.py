@@ -0,0 +1,348 @@
+import argparse
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from utils.bcolors import bcolors
+from utils.config_loader import ConfigLoader
+from utils.database_utils import claim_stage_slot, fetch_stage_limits, fetch_stage_slots, pause_stage_slot, \
+    preempt_requested, release_stage_slots, save_stage_limit
+
+# Load configuration
+config = ConfigLoader().get_config()
+
+# Stages that share a limit. Hashing is bound by the disk DATADIR is on, uploads by the outbound network.
+RESOURCES = ('hashing', 'network')
+# Defaults for the [Concurrency] options, see config.ini
+DEFAULT_SLOTS = {'hashing': 1, 'network': 2}
+DEFAULT_MAX_SLOTS = {'hashing': 4, 'network': 6}
+# Priority classes, stored as the number. Within a class the smallest job goes first.
+PRIORITIES = {'bulk': 0, 'normal': 1, 'urgent': 2}
+# Only hashing is long enough to be worth pausing for a more urgent job
+PREEMPTIBLE = ('hashing',)
+
+# Seconds between polls of a backend waiting for a slot, and of a running job for a request to pause
+WAIT_INTERVAL = 1
+PREEMPT_POLL_INTERVAL = 1
+# The controller samples the counters every SAMPLE_INTERVAL seconds and reconsiders the limits every DECISION_INTERVAL
+SAMPLE_INTERVAL = 5
+DECISION_INTERVAL = 60
+# A new slot has to add this much throughput to be kept, and this much of a drop halves the slots
+IMPROVEMENT = 0.05
+DEGRADATION = 0.15
+# Decisions to wait before probing for more slots again, once adding one didn't help
+PROBE_HOLDOFF = 10
+
+
+def get_slot_limits(resource):
+    """Get (starting slots, maximum slots) of a resource from config.ini."""
+    key = resource.upper()
+    return (config.getint('Concurrency', f'{key}_SLOTS', fallback=DEFAULT_SLOTS[resource]),
+            config.getint('Concurrency', f'{key}_MAX_SLOTS', fallback=DEFAULT_MAX_SLOTS[resource]))
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def reap_dead_slots():
+    """Free the slots of backends that were killed before they could release them."""
+    dead = [row[0] for row in fetch_stage_slots() if not pid_alive(row[2])]
+    if dead:
+        release_stage_slots(dead)
+    return len(dead)
+
+
+class HeldSlot:
+    """A slot this process is waiting for or running a stage in."""
+
+    def __init__(self, job, resource, priority, expected_bytes, expected_seconds=None):
+        self.job = job
+        self.resource = resource
+        self.priority = PRIORITIES[priority]
+        self.expected_bytes = expected_bytes
+        self.expected_seconds = expected_seconds
+        self.default_limit = get_slot_limits(resource)[0]
+        # Only a job that can't be paused itself may pause others, so two urgent jobs never take turns
+        self.may_preempt = self.priority == max(PRIORITIES.values()) and resource in PREEMPTIBLE \
+            and config.getboolean('Concurrency', 'PREEMPT', fallback=True)
+        self.last_poll = time.monotonic()
+
+    def wait(self, message):
+        """Wait until the slot is ours, printing `message` once if that takes a while."""
+        announced = False
+        while True:
+            claimed, running, limit = claim_stage_slot(self.job, os.getpid(), self.resource, self.default_limit,
+                                                       self.priority, self.expected_bytes, self.may_preempt,
+                                                       self.expected_seconds)
+            if claimed:
+                return
+            if not announced:
+                print(f"{bcolors.YELLOW}{message}, {running} of {limit} in use{bcolors.ENDC}")
+                announced = True
+            time.sleep(WAIT_INTERVAL)
+            reap_dead_slots()
+
+
+# Slots held by this process, for preemption_point()
+_held = {}
+
+
+@contextmanager
+def stage_slot(job, resource, priority='normal', expected_bytes=None, expected_seconds=None):
+    """Run the enclosed stage once the job has a slot of `resource`, waiting in line if all of them are taken.
+
+    Args:
+        job (str): Job id, see progress_utils.job_id()
+        resource (str): One of RESOURCES
+        priority (str): One of PRIORITIES. An urgent job may pause a running job of a lower priority, see
+                        preemption_point()
+        expected_bytes (int): Size of the job, smaller jobs of the same priority go first
+        expected_seconds (float): Predicted duration of the stage (see eta_utils), ranks before expected_bytes
+    """
+    slot = HeldSlot(job, resource, priority, expected_bytes, expected_seconds)
+    try:
+        slot.wait(f"Waiting for a {resource} slot")
+        _held[(job, resource)] = slot
+        yield slot
+    finally:
+        _held.pop((job, resource), None)
+        release_stage_slots([job], resource)
+
+
+def preemption_point(job, on_pause=None, on_resume=None, resource='hashing'):
+    """Pause here if a more urgent job asked for this job's slot, and continue once the slot is ours again.
+
+    Cheap enough to call for every piece, the database is polled at most every PREEMPT_POLL_INTERVAL seconds. Does
+    nothing if the job doesn't hold a slot of `resource` in this process.
+
+    Args:
+        job (str): Job id
+        on_pause (callable): Called before the slot is given up, e.g. to checkpoint or to stop a child process
+        on_resume (callable): Called once the slot is back
+    """
+    slot = _held.get((job, resource))
+    if slot is None or time.monotonic() - slot.last_poll < PREEMPT_POLL_INTERVAL:
+        return
+    slot.last_poll = time.monotonic()
+    if not preempt_requested(job, resource):
+        return
+
+    print(f"{bcolors.YELLOW}Pausing {resource} for a more urgent upload{bcolors.ENDC}")
+    if on_pause:
+        on_pause()
+    paused = time.monotonic()
+    pause_stage_slot(job, resource)
+    slot.wait(f"Paused until a {resource} slot is free")
+    if on_resume:
+        on_resume()
+    print(f"{bcolors.YELLOW}Resuming {resource} after {time.monotonic() - paused:.0f}s{bcolors.ENDC}")
+
+
+class AIMDPolicy:
+    """Additive increase, multiplicative decrease of the slots of one resource, driven by its measured throughput.
+
+    While jobs are waiting for slots, one more slot is tried each decision. It is kept if the throughput improved by
+    at least IMPROVEMENT, otherwise the limit goes back down and stays there for PROBE_HOLDOFF decisions. If the
+    throughput falls by DEGRADATION below what the current limit achieved before, e.g. because a single HDD started
+    seeking, the limit is halved.
+    """
+
+    def __init__(self, limit, max_limit):
+        self.limit = limit
+        self.max_limit = max(max_limit, 1)
+        # Best throughput seen at each limit, the baseline for the next decision at that limit
+        self.best = {}
+        self.probing = False
+        self.holdoff = 0
+
+    def decide(self, throughput, waiting):
+        """Get the limit for the next interval.
+
+        Args:
+            throughput (float): Bytes per second over the interval that just ended
+            waiting (bool): Whether any job waited for a slot during the interval, without that more slots can't help
+
+        Returns:
+            int: The new limit
+        """
+        self.holdoff = max(self.holdoff - 1, 0)
+        below = self.best.get(self.limit - 1)
+        if self.probing:
+            self.probing = False
+            if below is not None and throughput < below * (1 + IMPROVEMENT):
+                # The new slot didn't pay for itself
+                self.limit -= 1
+                self.holdoff = PROBE_HOLDOFF
+                return self.limit
+
+        best = self.best.get(self.limit)
+        if best is not None and throughput < best * (1 - DEGRADATION) and self.limit > 1:
+            self.best = {limit: value for limit, value in self.best.items() if limit < self.limit // 2}
+            self.limit = max(self.limit // 2, 1)
+            self.holdoff = PROBE_HOLDOFF
+            return self.limit
+        self.best[self.limit] = max(best or 0, throughput)
+
+        if waiting and not self.holdoff and self.limit < self.max_limit:
+            self.limit += 1
+            self.probing = True
+        return self.limit
+
+
+def device_name(path):
+    """Name of the block device a path is on, as in /proc/diskstats, None if it isn't a block device (e.g. overlay)."""
+    try:
+        device = os.stat(path).st_dev
+        return os.path.basename(os.readlink(f'/sys/dev/block/{os.major(device)}:{os.minor(device)}'))
+    except OSError:
+        return None
+
+
+class ThroughputSampler:
+    """Read bytes of the DATADIR device and bytes sent on every interface, averaged over a decision interval."""
+
+    def __init__(self, data_dir):
+        self.device = device_name(data_dir) if data_dir else None
+        self.last = None
+        self.totals = {resource: 0 for resource in RESOURCES}
+        self.seconds = 0
+
+    def counters(self):
+        import psutil
+
+        disks = psutil.disk_io_counters(perdisk=True) or {}
+        if self.device in disks:
+            read_bytes = disks[self.device].read_bytes
+        else:
+            # Not a plain block device, count every disk instead
+            total = psutil.disk_io_counters()
+            read_bytes = total.read_bytes if total else 0
+        return time.monotonic(), {'hashing': read_bytes, 'network': psutil.net_io_counters().bytes_sent}
+
+    def sample(self):
+        now, values = self.counters()
+        if self.last is not None:
+            then, previous = self.last
+            self.seconds += now - then
+            for resource in RESOURCES:
+                self.totals[resource] += max(values[resource] - previous[resource], 0)
+        self.last = now, values
+
+    def take(self):
+        """Get {resource: bytes per second} since the last take(), and start a new interval."""
+        rates = {resource: total / self.seconds if self.seconds else 0.0 for resource, total in self.totals.items()}
+        self.totals = {resource: 0 for resource in RESOURCES}
+        self.seconds = 0
+        return rates
+
+
+class ConcurrencyController:
+    """Adjust the slot limits of every resource from the throughput measured while jobs use them."""
+
+    def __init__(self):
+        self.sampler = ThroughputSampler(config.get('Paths', 'DATADIR', fallback='').strip())
+        stored = fetch_stage_limits()
+        self.policies = {}
+        for resource in RESOURCES:
+            start, maximum = get_slot_limits(resource)
+            limit = min(stored[resource][0], maximum) if resource in stored else start
+            self.policies[resource] = AIMDPolicy(limit, maximum)
+        self.busy = {resource: False for resource in RESOURCES}
+        self.waiting = {resource: False for resource in RESOURCES}
+
+    def sample(self):
+        self.sampler.sample()
+        reap_dead_slots()
+        for _, resource, _, state, *_ in fetch_stage_slots():
+            if resource in self.busy:
+                self.busy[resource] = True
+                self.waiting[resource] |= state != 'running'
+
+    def decide(self):
+        """Feed the interval's throughput to each policy. Idle intervals say nothing about the limit and are skipped."""
+        rates = self.sampler.take()
+        for resource, policy in self.policies.items():
+            if self.busy[resource]:
+                previous = policy.limit
+                limit = policy.decide(rates[resource], self.waiting[resource])
+                save_stage_limit(resource, limit, rates[resource])
+                if limit != previous:
+                    logging.info(f"{resource} slots {previous} -> {limit} at {rates[resource] / 2 ** 20:.1f} MiB/s")
+            self.busy[resource] = False
+            self.waiting[resource] = False
+
+    def run(self):
+        samples = max(DECISION_INTERVAL // SAMPLE_INTERVAL, 1)
+        while True:
+            for _ in range(samples):
+                try:
+                    self.sample()
+                except Exception as e:
+                    logging.error(f"Concurrency controller sample failed: {e}")
+                time.sleep(SAMPLE_INTERVAL)
+            try:
+                self.decide()
+            except Exception as e:
+                logging.error(f"Concurrency controller decision failed: {e}")
+
+
+def start_controller():
+    """Start adjusting the slot limits in the background, unless ADAPTIVE is off in config.ini."""
+    if config.getboolean('Concurrency', 'ADAPTIVE', fallback=True):
+        threading.Thread(target=ConcurrencyController().run, daemon=True).start()
+
+
+def simulate(decisions=40):
+    """Run the policy against modelled disks and check where it settles.
+
+    The HDD loses throughput with every extra reader as it starts seeking, the NVMe array scales to 4 readers and
+    flattens out after that.
+    """
+    models = {
+        'single HDD': (lambda slots: 180e6 / (1 + 0.35 * (slots - 1)), 1),
+        'NVMe array': (lambda slots: 1.5e9 * min(slots, 4) / (1 + 0.02 * max(slots - 4, 0)), 4),
+    }
+    for name, (model, expected) in models.items():
+        policy = AIMDPolicy(1, 8)
+        history = deque(maxlen=10)
+        for _ in range(decisions):
+            history.append(policy.decide(model(policy.limit), waiting=True))
+        settled = max(set(history), key=history.count)
+        print(f"{name:>10}: limits {list(history)}, mostly {settled}, {model(settled) / 2 ** 20:.0f} MiB/s")
+        assert settled == expected, f"{name} settled at {settled} slots instead of {expected}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stage slots and the adaptive concurrency controller")
+    parser.add_argument('command', nargs='?', choices=('status', 'simulate'), default='status')
+    args = parser.parse_args()
+    if args.command == 'simulate':
+        simulate()
+        return
+
+    reap_dead_slots()
+    limits = fetch_stage_limits()
+    slots = fetch_stage_slots()
+    for resource in RESOURCES:
+        limit, throughput = limits.get(resource, (get_slot_limits(resource)[0], None))
+        measured = f", {throughput / 2 ** 20:.1f} MiB/s measured" if throughput is not None else ""
+        print(f"{resource}: limit {limit}{measured}")
+        names = {number: name for name, number in PRIORITIES.items()}
+        for job, slot_resource, pid, state, requested, _, priority, expected_bytes in slots:
+            if slot_resource == resource:
+                size = f", {expected_bytes / 2 ** 30:.1f} GiB" if expected_bytes else ""
+                print(f"    {state:>8} {job} ({names.get(priority, priority)}{size}) for {time.time() - requested:.0f}s")
+
+
+if __name__ == '__main__':
+    main()
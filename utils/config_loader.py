@@ -1,13 +1,23 @@
 # utils/config_loader.py
 
 import configparser
+import threading
 from pathlib import Path
 
 class ConfigLoader:
+    # Parsed configs shared by every ConfigLoader in the process, keyed by path. Each utils module creates its own
+    # loader at import, this keeps config.ini from being read and parsed once per module.
+    _configs = {}
+    _lock = threading.Lock()
+
     def __init__(self, config_file='config.ini'):
-        self.config = configparser.ConfigParser()
         config_path = Path(__file__).resolve().parent.parent / config_file
-        self.config.read(config_path)
+        with ConfigLoader._lock:
+            if config_path not in ConfigLoader._configs:
+                config = configparser.ConfigParser()
+                config.read(config_path)
+                ConfigLoader._configs[config_path] = config
+        self.config = ConfigLoader._configs[config_path]
 
     def get_config(self):
         return self.config
@@ -1,17 +1,69 @@
+import os
 import sqlite3
 import sys
+import threading
+import time
 from datetime import datetime
 from pathlib import Path
 
+DATABASE = 'data/dc_uploader.db'
+
+# Databases used before everything moved into DATABASE, imported by the first migration
 UPLOADS_DB = 'data/uploads.db'
 TERMINAL_OUTPUT_DB = 'data/terminal_output.db'
 DIRECTORIES_DB = 'data/directories.db'
+QUEUE_DB = 'data/upload_queue.db'
+LEGACY_DATABASES = {
+    UPLOADS_DB: ('uploads', 'upload_stages'),
+    TERMINAL_OUTPUT_DB: ('terminal_logs',),
+    DIRECTORIES_DB: ('directories',),
+    QUEUE_DB: ('upload_queue',),
+}
 
-def create_uploads_table():
-    """Create the uploads table in SQLite if it doesn't exist."""
-    conn = sqlite3.connect(UPLOADS_DB)
-    cursor = conn.cursor()
-    cursor.execute('''
+# Lines of terminal output kept per source (one backend run), and the number of most recent sources kept
+TERMINAL_LOG_LINES = 1000
+TERMINAL_LOG_SOURCES = 20
+
+# Milliseconds a connection waits for another writer before failing with "database is locked"
+BUSY_TIMEOUT = 30000
+
+_local = threading.local()
+
+
+def get_connection():
+    """Get this thread's connection to DATABASE, opening and migrating it on first use.
+
+    Connections are kept open per thread (and per process, in case of a fork) instead of being opened for every
+    query. The database runs in WAL mode so readers like the web app never block the backends writing to it.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == os.getpid():
+        return conn
+
+    Path(DATABASE).parent.mkdir(parents=True, mode=0o775, exist_ok=True)
+    conn = sqlite3.connect(DATABASE, timeout=BUSY_TIMEOUT / 1000)
+    conn.execute('PRAGMA journal_mode = WAL')
+    # NORMAL is safe in WAL mode, a power loss can only lose the last transactions, never corrupt the database
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT}')
+    migrate(conn)
+    _local.conn = conn
+    _local.pid = os.getpid()
+    return conn
+
+
+def close_connection():
+    """Close this thread's connection, if it has one."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+def migration_1(conn):
+    """Create the schema and import the data of the separate databases used before."""
+    statements = [
+        '''
         CREATE TABLE IF NOT EXISTS uploads (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
@@ -23,132 +75,687 @@ def create_uploads_table():
             mediainfo TEXT,
             nfo_content TEXT,
             screenshot_url TEXT,
-            image_url TEXT
+            image_url TEXT,
+            profile TEXT  -- Filename of the .pstats file in data/profiles, if the upload was profiled
         )
-    ''')
-    conn.commit()
-    conn.close()
-
-def create_terminal_output_table():
-    """Create the terminal_output table in SQLite if it doesn't exist."""
-    conn = sqlite3.connect(TERMINAL_OUTPUT_DB)
-    cursor = conn.cursor()
-    cursor.execute('''
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS upload_stages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            upload_id INTEGER NOT NULL,  -- id of the row in uploads
+            stage TEXT NOT NULL,
+            started REAL NOT NULL,  -- Unix timestamp
+            duration REAL NOT NULL,  -- Seconds
+            bytes INTEGER
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_upload_stages_upload_id ON upload_stages (upload_id)',
+        '''
         CREATE TABLE IF NOT EXISTS terminal_logs (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
             source TEXT,  -- Optional, can be used to differentiate uploaders
             log_line TEXT
         )
-    ''')
-    conn.commit()
-    conn.close()
-
-def create_directories_table():
-    """Create the directories table in SQLite if it doesn't exist."""
-    conn = sqlite3.connect(DIRECTORIES_DB)
-    cursor = conn.cursor()
-    cursor.execute('''
+        ''',
+        '''
         CREATE TABLE IF NOT EXISTS directories (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT UNIQUE,
             status TEXT,
             creation_date TEXT
         )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS upload_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            pid INTEGER,
+            directory_name TEXT,
+            status TEXT,  -- queued, running, completed, failed
+            timestamp TEXT
+        )
+        ''',
+    ]
+    for statement in statements:
+        conn.execute(statement)
+
+    # Copy the rows of the legacy databases attached by migrate()
+    aliases = [row[1] for row in conn.execute('PRAGMA database_list') if row[1].startswith('legacy_')]
+    for alias in aliases:
+        # SQLite's internal tables, like sqlite_sequence, are kept up to date by main itself
+        tables = [row[0] for row in conn.execute(f"SELECT name FROM {alias}.sqlite_master "
+                                                 f"WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+        for table in tables:
+            columns = [row[1] for row in conn.execute(f'PRAGMA main.table_info({table})')]
+            if not columns:
+                continue  # Not a table we know
+            legacy_columns = [row[1] for row in conn.execute(f'PRAGMA {alias}.table_info({table})')]
+            # Older installs may miss columns added later, copy whatever both sides have. Ids are kept so
+            # upload_stages still points at the right uploads.
+            shared = ', '.join(column for column in columns if column in legacy_columns)
+            conn.execute(f'INSERT OR IGNORE INTO main.{table} ({shared}) SELECT {shared} FROM {alias}.{table}')
+
+
+def migration_2(conn):
+    """Index uploads by name and date, so looking up the attempts of one directory doesn't scan the table."""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_uploads_name_date ON uploads (name, date)')
+
+
+def migration_3(conn):
+    """Turn terminal_logs into fixed size rings, one per source.
+
+    Each line goes into slot (line number % TERMINAL_LOG_LINES) of its source. Writing a slot replaces the line
+    that was there, which also gives it a new, higher id, so readers can keep asking for id > last_id.
+    """
+    conn.execute('''
+        CREATE TABLE terminal_logs_ring (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+            source TEXT NOT NULL DEFAULT '',  -- Which backend run wrote the line
+            slot INTEGER NOT NULL,  -- Position in the source's ring
+            log_line TEXT,
+            UNIQUE (source, slot)
+        )
+    ''')
+    # Keep the newest lines of every source
+    conn.execute('''
+        INSERT INTO terminal_logs_ring (id, timestamp, source, slot, log_line)
+        SELECT id, timestamp, source, line - 1, log_line FROM (
+            SELECT id, timestamp, COALESCE(source, '') AS source, log_line,
+                   ROW_NUMBER() OVER (PARTITION BY COALESCE(source, '') ORDER BY id DESC) AS line
+            FROM terminal_logs
+        )
+        WHERE line <= ?
+    ''', (TERMINAL_LOG_LINES,))
+    conn.execute('DROP TABLE terminal_logs')
+    conn.execute('ALTER TABLE terminal_logs_ring RENAME TO terminal_logs')
+
+
+def migration_4(conn):
+    """Index terminal_logs by source and id, so following one job's output reads only that job's lines."""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_terminal_logs_source_id ON terminal_logs (source, id)')
+
+
+def migration_5(conn):
+    """Add upload_progress, the latest progress of the running stage of each job."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS upload_progress (
+            job TEXT PRIMARY KEY,  -- Same as the job's terminal_logs source
+            stage TEXT NOT NULL,
+            done INTEGER NOT NULL,  -- Units of work done, e.g. pieces hashed
+            total INTEGER,
+            bytes_per_second REAL,
+            eta_seconds REAL,
+            updated REAL NOT NULL  -- Unix timestamp
+        )
     ''')
-    conn.commit()
-    conn.close()
+
+
+def migration_6(conn):
+    """Add source_torrents, the index of the torrents in SOURCEFOLDER by content."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS source_torrents (
+            path TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL,  -- mtime and size of the .torrent file, to only parse changed files
+            file_size INTEGER NOT NULL,
+            name TEXT,  -- NULL if the file couldn't be parsed
+            total_size INTEGER,
+            files_hash TEXT,  -- See source_index_utils.files_hash()
+            piece_length INTEGER
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_source_torrents_content ON source_torrents (name, files_hash)')
+
+
+def migration_7(conn):
+    """Add stage_slots and stage_limits, how many jobs may run a hashing or network stage at once."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stage_slots (
+            job TEXT NOT NULL,
+            resource TEXT NOT NULL,  -- 'hashing' or 'network', see concurrency_utils.RESOURCES
+            pid INTEGER NOT NULL,  -- To free the slots of a backend that died without releasing them
+            state TEXT NOT NULL,  -- 'waiting' or 'running'
+            requested REAL NOT NULL,  -- Unix timestamps
+            acquired REAL,
+            PRIMARY KEY (job, resource)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stage_limits (
+            resource TEXT PRIMARY KEY,
+            slot_limit INTEGER NOT NULL,  -- Set by the controller in the web app
+            throughput REAL,  -- Bytes per second it measured at this limit
+            updated REAL NOT NULL
+        )
+    ''')
+
+
+def migration_8(conn):
+    """Give stage slots a priority, an expected size for shortest job first, and a way to ask a job to pause."""
+    conn.execute('ALTER TABLE stage_slots ADD COLUMN priority INTEGER NOT NULL DEFAULT 1')  # concurrency_utils.PRIORITIES
+    conn.execute('ALTER TABLE stage_slots ADD COLUMN expected_bytes INTEGER')
+    conn.execute('ALTER TABLE stage_slots ADD COLUMN preempt INTEGER NOT NULL DEFAULT 0')  # Set for a running job
+
+
+def migration_9(conn):
+    """Record what the ETA predictor learns from with every upload, and add upload_jobs, the uploads in progress."""
+    conn.execute('ALTER TABLE uploads ADD COLUMN size_bytes INTEGER')
+    conn.execute('ALTER TABLE uploads ADD COLUMN file_count INTEGER')
+    conn.execute('ALTER TABLE uploads ADD COLUMN device TEXT')  # Block device of the data, see concurrency_utils
+    conn.execute('ALTER TABLE stage_slots ADD COLUMN expected_seconds REAL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS upload_jobs (
+            job TEXT PRIMARY KEY,  -- Same as the job's terminal_logs source
+            pid INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            size_bytes INTEGER,
+            file_count INTEGER,
+            category TEXT,  -- Once known
+            device TEXT,
+            stage TEXT,  -- Stage running now, NULL between stages
+            stage_started REAL,
+            started REAL NOT NULL  -- Unix timestamps
+        )
+    ''')
+
+
+def migration_10(conn):
+    """Add what each upload cost, see accounting_utils."""
+    for column, column_type in (('wall_seconds', 'REAL'), ('cpu_seconds', 'REAL'), ('child_cpu_seconds', 'REAL'),
+                                ('read_bytes', 'INTEGER'), ('sent_bytes', 'INTEGER'), ('peak_rss', 'INTEGER'),
+                                ('child_peak_rss', 'INTEGER')):
+        conn.execute(f'ALTER TABLE uploads ADD COLUMN {column} {column_type}')
+
+
+# Schema changes, in order. PRAGMA user_version holds how many of them a database has had applied.
+# Never edit a migration once released, append a new one instead.
+MIGRATIONS = [
+    migration_1,
+    migration_2,
+    migration_3,
+    migration_4,
+    migration_5,
+    migration_6,
+    migration_7,
+    migration_8,
+    migration_9,
+    migration_10,
+]
+
+
+def migrate(conn):
+    """Apply the migrations the database hasn't had yet."""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version >= len(MIGRATIONS):
+        return
+
+    # ATTACH can't run inside a transaction, so the databases the first migration imports are attached up front
+    aliases = []
+    if version == 0:
+        for number, legacy_path in enumerate(LEGACY_DATABASES):
+            if os.path.exists(legacy_path):
+                alias = f'legacy_{number}'
+                conn.execute(f'ATTACH DATABASE ? AS {alias}', (legacy_path,))
+                aliases.append(alias)
+
+    try:
+        # Take the write lock before checking again, so two processes starting at once don't both migrate
+        conn.execute('BEGIN IMMEDIATE')
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for migration in MIGRATIONS[version:]:
+            migration(conn)
+        conn.execute(f'PRAGMA user_version = {len(MIGRATIONS)}')
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        for alias in aliases:
+            conn.execute(f'DETACH DATABASE {alias}')
 
 
 def initialize_all_databases():
-    """Initialize all required databases."""
-    # Ensure data directory for databases exists
-    Path("data").mkdir(parents=False, mode=0o775, exist_ok=True)
-    create_uploads_table()
-    create_terminal_output_table()
-    create_directories_table()
-    print("All databases initialized successfully.")
+    """Create or migrate the database."""
+    get_connection()
+    print(f"Database {DATABASE} initialized successfully.")
+
+
+# Columns of uploads that can be written through save_upload()
+UPLOAD_FIELDS = ('category', 'status', 'size', 'imdb_url', 'mediainfo', 'nfo_content', 'screenshot_url', 'image_url',
+                 'profile', 'size_bytes', 'file_count', 'device', 'wall_seconds', 'cpu_seconds', 'child_cpu_seconds',
+                 'read_bytes', 'sent_bytes', 'peak_rss', 'child_peak_rss')
+
+
+def save_upload(upload_id, name, **fields):
+    """Insert or update one upload attempt with a single UPSERT keyed by its id.
+
+    Only the fields passed are written, the others keep their current value (or their default for a new row).
+
+    Args:
+        upload_id (int): id of the attempt, None to start a new attempt
+        name (str): Name of the uploaded directory
+        **fields: Values for any of UPLOAD_FIELDS
+
+    Returns:
+        int: id of the attempt
+    """
+    unknown = set(fields) - set(UPLOAD_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown upload fields: {', '.join(sorted(unknown))}")
+
+    # Defaults for the NOT NULL columns, only used when the row is inserted
+    values = {
+        'category': "Unknown",
+        'status': "pending",
+    }
+    values.update((field, value) for field, value in fields.items() if value is not None)
+    columns = ['id', 'name', 'date'] + list(values)
+    updates = [field for field, value in fields.items() if value is not None]
+
+    sql_query = f'''
+        INSERT INTO uploads ({', '.join(columns)})
+        VALUES ({', '.join('?' * len(columns))})
+    '''
+    if updates:
+        sql_query += f"ON CONFLICT(id) DO UPDATE SET {', '.join(f'{field} = excluded.{field}' for field in updates)}"
+    else:
+        sql_query += "ON CONFLICT(id) DO NOTHING"
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(sql_query, [upload_id, name, datetime.now().strftime('%Y-%m-%d %H:%M:%S')] + list(values.values()))
+    conn.commit()
+    return upload_id if upload_id is not None else cursor.lastrowid
 
 def insert_upload(name, category=None, status=None, size=None, imdb_url=None, mediainfo=None, nfo_content=None, screenshot_url=None, image_url=None):
-    """Insert a new upload record into the SQLite database with only the fields provided."""
-    conn = sqlite3.connect(UPLOADS_DB)
+    """Start a new upload attempt with only the fields provided.
+    Returns:
+        int: id of the attempt, pass it to update_upload_status()
+    """
+    return save_upload(None, name, category=category, status=status, size=size, imdb_url=imdb_url,
+                       mediainfo=mediainfo, nfo_content=nfo_content, screenshot_url=screenshot_url,
+                       image_url=image_url)
+
+def update_upload_status(upload_id, name, new_status=None, category=None, size=None, imdb_url=None, mediainfo=None,
+                         nfo_content=None, screenshot_url=None, image_url=None):
+    """Update the status and other details of an upload attempt.
+
+    Earlier attempts of the same directory are left alone. If the attempt's row is missing, e.g. the history was
+    cleared while uploading, it is recreated.
+    """
+    save_upload(upload_id, name, status=new_status, category=category, size=size, imdb_url=imdb_url,
+                mediainfo=mediainfo, nfo_content=nfo_content, screenshot_url=screenshot_url, image_url=image_url)
+
+
+def set_upload_profile(upload_id, name, profile):
+    """Store the filename of an upload's profile."""
+    save_upload(upload_id, name, profile=profile)
+
+
+def fetch_all_uploads():
+    """Fetch all uploads from the database."""
+    conn = get_connection()
     cursor = conn.cursor()
-    date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    cursor.execute('SELECT * FROM uploads ORDER BY date DESC')
+    rows = cursor.fetchall()
+    return rows
 
-    cursor.execute('''
-        INSERT INTO uploads (name, category, date, status, size, imdb_url, mediainfo, nfo_content, screenshot_url, image_url)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        name, 
-        category if category else "Unknown",  # Default to "Unknown" if category not provided
-        date, 
-        status if status else "pending",  # Default to "pending" if status not provided
-        size, 
-        imdb_url, 
-        mediainfo, 
-        nfo_content, 
-        screenshot_url, 
-        image_url
-    ))
 
+def insert_stage_timings(upload_id, spans):
+    """Store the stage spans recorded by a StageTimer for an upload."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.executemany('''
+        INSERT INTO upload_stages (upload_id, stage, started, duration, bytes)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [(upload_id, span['stage'], span['started'], span['duration'], span['bytes']) for span in spans])
     conn.commit()
-    conn.close()
 
-def update_upload_status(name, new_status=None, category=None, size=None, imdb_url=None, mediainfo=None, nfo=None,
-                         screenshot_url=None, image_url=None):
-    """Update the status and other details of an existing upload."""
-    conn = sqlite3.connect(UPLOADS_DB)
+
+def fetch_stage_timings(upload_id):
+    """Fetch the stage spans of one upload, in the order they started."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT stage, started, duration, bytes FROM upload_stages
+        WHERE upload_id = ?
+        ORDER BY started
+    ''', (upload_id,))
+    rows = cursor.fetchall()
+    return rows
+
+
+def fetch_stage_totals():
+    """Fetch per-stage aggregates over all uploads: count, total seconds, total bytes and total seconds of the
+    spans that processed bytes."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT stage, COUNT(*), SUM(duration), SUM(bytes), SUM(CASE WHEN bytes IS NOT NULL THEN duration END)
+        FROM upload_stages
+        GROUP BY stage
+    ''')
+    rows = cursor.fetchall()
+    return rows
+
+
+def fetch_upload_status_counts():
+    """Fetch the number of uploads per status."""
+    conn = get_connection()
     cursor = conn.cursor()
+    cursor.execute('SELECT status, COUNT(*) FROM uploads GROUP BY status')
+    rows = cursor.fetchall()
+    return rows
 
-    # Build the SQL query dynamically based on provided fields
-    fields_to_update = []
-    values = []
-
-    if new_status is not None:
-        fields_to_update.append("status = ?")
-        values.append(new_status)
-    if category is not None:
-        fields_to_update.append("category = ?")
-        values.append(category)
-    if size is not None:
-        fields_to_update.append("size = ?")
-        values.append(size)
-    if imdb_url is not None:
-        fields_to_update.append("imdb_url = ?")
-        values.append(imdb_url)
-    if mediainfo is not None:
-        fields_to_update.append("mediainfo = ?")
-        values.append(mediainfo)
-    if nfo is not None:
-        fields_to_update.append("nfo = ?")
-        values.append(nfo)
-    if screenshot_url is not None:
-        fields_to_update.append("screenshot_url = ?")
-        values.append(screenshot_url)
-    if image_url is not None:
-        fields_to_update.append("image_url = ?")
-        values.append(image_url)
-
-    # Ensure we only run an update if there are fields to update
-    if fields_to_update:
-        values.append(name)
-        sql_query = f"UPDATE uploads SET {', '.join(fields_to_update)} WHERE name = ?"
-        cursor.execute(sql_query, values)
 
+def insert_terminal_log(source, line_number, log_line):
+    """Store a line of terminal output in its source's ring, replacing the line TERMINAL_LOG_LINES lines back.
+
+    Args:
+        source (str): Which job wrote the line, "<pid>:<directory name>"
+        line_number (int): Number of lines the source has written before this one
+        log_line (str): The output
+    """
+    conn = get_connection()
+    conn.execute('''
+        INSERT OR REPLACE INTO terminal_logs (source, slot, log_line)
+        VALUES (?, ?, ?)
+    ''', (source, line_number % TERMINAL_LOG_LINES, log_line))
     conn.commit()
-    conn.close()
 
 
-def fetch_all_uploads():
-    """Fetch all uploads from the database."""
-    conn = sqlite3.connect(UPLOADS_DB)
+def prune_terminal_logs(keep=TERMINAL_LOG_SOURCES):
+    """Delete the output of all but the `keep` sources that wrote most recently. Run once when a source starts."""
+    conn = get_connection()
+    conn.execute('''
+        DELETE FROM terminal_logs WHERE source NOT IN (
+            SELECT source FROM terminal_logs
+            GROUP BY source
+            ORDER BY MAX(id) DESC
+            LIMIT ?
+        )
+    ''', (keep,))
+    conn.execute('DELETE FROM upload_progress WHERE job NOT IN (SELECT DISTINCT source FROM terminal_logs)')
+    conn.commit()
+
+
+def fetch_terminal_logs(last_id, source=None):
+    """Fetch the lines of terminal output written after last_id, oldest first.
+
+    Args:
+        last_id (int): id of the last line the caller already has
+        source (str): Only fetch the lines of this job, all jobs if None
+    """
+    conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM uploads ORDER BY date DESC')
+    if source is None:
+        cursor.execute('''
+            SELECT id, log_line FROM terminal_logs
+            WHERE id > ?
+            ORDER BY id ASC
+        ''', (last_id,))
+    else:
+        cursor.execute('''
+            SELECT id, log_line FROM terminal_logs
+            WHERE source = ? AND id > ?
+            ORDER BY id ASC
+        ''', (source, last_id))
     rows = cursor.fetchall()
-    conn.close()
     return rows
 
 
+def fetch_terminal_jobs():
+    """Fetch the jobs that have terminal output, most recently active first, with the time of their first line."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT source, MIN(timestamp), MAX(id) FROM terminal_logs
+        GROUP BY source
+        ORDER BY MAX(id) DESC
+    ''')
+    rows = cursor.fetchall()
+    return rows
+
+
+def save_progress(job, stage, done, total, bytes_per_second, eta_seconds):
+    """Overwrite the progress row of a job."""
+    conn = get_connection()
+    conn.execute('''
+        INSERT INTO upload_progress (job, stage, done, total, bytes_per_second, eta_seconds, updated)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(job) DO UPDATE SET stage = excluded.stage, done = excluded.done, total = excluded.total,
+            bytes_per_second = excluded.bytes_per_second, eta_seconds = excluded.eta_seconds, updated = excluded.updated
+    ''', (job, stage, done, total, bytes_per_second, eta_seconds, time.time()))
+    conn.commit()
+
+
+def fetch_progress(job):
+    """Fetch the progress row of a job, None if it hasn't reported any progress."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT stage, done, total, bytes_per_second, eta_seconds, updated FROM upload_progress
+        WHERE job = ?
+    ''', (job,))
+    return cursor.fetchone()
+
+
+def fetch_source_torrent_stats():
+    """Get {path: (mtime_ns, file_size)} of every indexed source torrent."""
+    conn = get_connection()
+    return {path: (mtime_ns, file_size) for path, mtime_ns, file_size in
+            conn.execute('SELECT path, mtime_ns, file_size FROM source_torrents')}
+
+
+def save_source_torrents(rows, removed_paths=()):
+    """Insert or replace index rows and drop the rows of removed torrents, in one transaction.
+
+    Args:
+        rows (list): (path, mtime_ns, file_size, name, total_size, files_hash, piece_length) per torrent
+        removed_paths (iterable): Paths that no longer exist
+    """
+    conn = get_connection()
+    with conn:
+        conn.executemany('''
+            INSERT OR REPLACE INTO source_torrents
+                (path, mtime_ns, file_size, name, total_size, files_hash, piece_length)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        conn.executemany('DELETE FROM source_torrents WHERE path = ?', ((path,) for path in removed_paths))
+
+
+def find_source_torrent(name, files_hash):
+    """Find an indexed source torrent by content, None if there is none. Newest file wins if there are several."""
+    conn = get_connection()
+    row = conn.execute('''
+        SELECT path FROM source_torrents WHERE name = ? AND files_hash = ?
+        ORDER BY mtime_ns DESC LIMIT 1
+    ''', (name, files_hash)).fetchone()
+    return row[0] if row else None
+
+
+def claim_stage_slot(job, pid, resource, default_limit, priority=1, expected_bytes=None, preempt=False,
+                     expected_seconds=None):
+    """Queue a job for a slot of a resource, and take one if it's free and the job is first in line.
+
+    The line is ordered by priority, then paused jobs before new ones, then shortest first. Safe to call repeatedly
+    while waiting, the job keeps its place in the line.
+
+    Args:
+        default_limit (int): Slots if the controller hasn't set a limit yet
+        priority (int): Higher goes first
+        expected_bytes (int): Size of the job, for shortest job first within a priority
+        preempt (bool): If the job is first in line but every slot is taken, ask the largest running job of a lower
+                        priority to pause, unless some job has been asked already
+        expected_seconds (float): Predicted duration of the stage, orders the line before expected_bytes does
+
+    Returns:
+        tuple: (whether the job has the slot now, slots in use, slot limit)
+    """
+    conn = get_connection()
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        now = time.time()
+        conn.execute('''
+            INSERT OR IGNORE INTO stage_slots
+                (job, resource, pid, state, requested, priority, expected_bytes, expected_seconds)
+            VALUES (?, ?, ?, 'waiting', ?, ?, ?, ?)
+        ''', (job, resource, pid, now, priority, expected_bytes, expected_seconds))
+        row = conn.execute('SELECT slot_limit FROM stage_limits WHERE resource = ?', (resource,)).fetchone()
+        limit = row[0] if row else default_limit
+        running = conn.execute("SELECT COUNT(*) FROM stage_slots WHERE resource = ? AND state = 'running'",
+                               (resource,)).fetchone()[0]
+        state, = conn.execute('SELECT state FROM stage_slots WHERE job = ? AND resource = ?', (job, resource)).fetchone()
+        if state == 'running':
+            return True, running, limit
+        first, = conn.execute('''
+            SELECT job FROM stage_slots WHERE resource = ? AND state IN ('waiting', 'paused')
+            ORDER BY priority DESC, state = 'paused' DESC, COALESCE(expected_seconds, 9e18),
+                COALESCE(expected_bytes, 9e18), requested, job
+            LIMIT 1
+        ''', (resource,)).fetchone()
+        if first != job:
+            return False, running, limit
+        if running >= limit:
+            asked = conn.execute("SELECT 1 FROM stage_slots WHERE resource = ? AND preempt = 1",
+                                 (resource,)).fetchone()
+            if preempt and not asked:
+                conn.execute('''
+                    UPDATE stage_slots SET preempt = 1 WHERE rowid = (
+                        SELECT rowid FROM stage_slots WHERE resource = ? AND state = 'running' AND priority < ?
+                        ORDER BY priority, COALESCE(expected_seconds, 9e18) DESC, COALESCE(expected_bytes, 9e18) DESC
+                        LIMIT 1
+                    )
+                ''', (resource, priority))
+            return False, running, limit
+        conn.execute('''
+            UPDATE stage_slots SET state = 'running', acquired = ? WHERE job = ? AND resource = ?
+        ''', (now, job, resource))
+        return True, running + 1, limit
+
+
+def preempt_requested(job, resource):
+    """Whether a job has been asked to pause its running stage."""
+    conn = get_connection()
+    row = conn.execute('SELECT preempt FROM stage_slots WHERE job = ? AND resource = ?', (job, resource)).fetchone()
+    return bool(row and row[0])
+
+
+def pause_stage_slot(job, resource):
+    """Give up a running slot but keep the job's place in line, ahead of jobs of its priority that haven't started."""
+    conn = get_connection()
+    with conn:
+        conn.execute('''
+            UPDATE stage_slots SET state = 'paused', preempt = 0, acquired = NULL WHERE job = ? AND resource = ?
+        ''', (job, resource))
+
+
+def release_stage_slots(jobs, resource=None):
+    """Drop the slots of jobs, running or waiting, of one resource or of all of them."""
+    conn = get_connection()
+    with conn:
+        if resource is None:
+            conn.executemany('DELETE FROM stage_slots WHERE job = ?', ((job,) for job in jobs))
+        else:
+            conn.executemany('DELETE FROM stage_slots WHERE job = ? AND resource = ?',
+                             ((job, resource) for job in jobs))
+
+
+def fetch_stage_slots():
+    """Fetch (job, resource, pid, state, requested, acquired, priority, expected_bytes) of every queued, running or
+    paused stage."""
+    conn = get_connection()
+    return conn.execute('''
+        SELECT job, resource, pid, state, requested, acquired, priority, expected_bytes FROM stage_slots
+        ORDER BY resource, priority DESC, requested
+    ''').fetchall()
+
+
+def fetch_stage_limits():
+    """Get {resource: (slot limit, throughput measured at it)} as last set by the controller."""
+    conn = get_connection()
+    return {resource: (limit, throughput) for resource, limit, throughput in
+            conn.execute('SELECT resource, slot_limit, throughput FROM stage_limits')}
+
+
+def save_stage_limit(resource, limit, throughput):
+    conn = get_connection()
+    with conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO stage_limits (resource, slot_limit, throughput, updated) VALUES (?, ?, ?, ?)
+        ''', (resource, limit, throughput, time.time()))
+
+
+def save_upload_job(job, pid, name, priority, size_bytes, file_count, device):
+    """Register an upload in progress, replacing a row left behind by an earlier run with the same job id."""
+    conn = get_connection()
+    with conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO upload_jobs (job, pid, name, priority, size_bytes, file_count, device, started)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (job, pid, name, priority, size_bytes, file_count, device, time.time()))
+
+
+def update_upload_job(job, **fields):
+    """Set the category, or the stage (with stage_started) of an upload in progress."""
+    unknown = set(fields) - {'category', 'stage', 'stage_started'}
+    if unknown:
+        raise ValueError(f"Unknown upload job fields: {', '.join(sorted(unknown))}")
+    conn = get_connection()
+    with conn:
+        conn.execute(f"UPDATE upload_jobs SET {', '.join(f'{field} = ?' for field in fields)} WHERE job = ?",
+                     (*fields.values(), job))
+
+
+def delete_upload_jobs(jobs):
+    conn = get_connection()
+    with conn:
+        conn.executemany('DELETE FROM upload_jobs WHERE job = ?', ((job,) for job in jobs))
+
+
+def fetch_upload_jobs():
+    """Fetch (job, pid, name, priority, size_bytes, file_count, category, device, stage, stage_started, started) of
+    every upload in progress, oldest first."""
+    conn = get_connection()
+    return conn.execute('''
+        SELECT job, pid, name, priority, size_bytes, file_count, category, device, stage, stage_started, started
+        FROM upload_jobs ORDER BY started
+    ''').fetchall()
+
+
+def fetch_stage_history(uploads=500):
+    """Fetch the stage durations of the latest successful uploads, with what the ETA predictor predicts from.
+
+    Returns:
+        list: (upload id, stage, duration, size_bytes, file_count, category, device) per stage span
+    """
+    conn = get_connection()
+    return conn.execute('''
+        SELECT u.id, s.stage, s.duration, u.size_bytes, u.file_count, u.category, u.device
+        FROM upload_stages s
+        JOIN (SELECT id, size_bytes, file_count, category, device FROM uploads
+              WHERE status = 'uploaded' AND size_bytes IS NOT NULL
+              ORDER BY id DESC LIMIT ?) u ON u.id = s.upload_id
+    ''', (uploads,)).fetchall()
+
+
+def fetch_resource_usage(uploads=200):
+    """Fetch what the latest accounted uploads cost.
+
+    Returns:
+        list: (id, name, date, status, size_bytes, wall_seconds, cpu_seconds, child_cpu_seconds, read_bytes,
+              sent_bytes, peak_rss, child_peak_rss) per upload, newest first
+    """
+    conn = get_connection()
+    return conn.execute('''
+        SELECT id, name, date, status, size_bytes, wall_seconds, cpu_seconds, child_cpu_seconds, read_bytes,
+               sent_bytes, peak_rss, child_peak_rss FROM uploads
+        WHERE wall_seconds IS NOT NULL
+        ORDER BY id DESC LIMIT ?
+    ''', (uploads,)).fetchall()
+
+
 def main():
     if len(sys.argv) < 2:
         print("Usage: python database_utils.py <function_name>")
@@ -156,14 +763,8 @@ def main():
     
     function_name = sys.argv[1]
     
-    if function_name == 'initialize_all_databases':
+    if function_name in ('initialize_all_databases', 'migrate'):
         initialize_all_databases()
-    elif function_name == 'create_uploads_table':
-        create_uploads_table()
-    elif function_name == 'create_terminal_output_table':
-        create_terminal_output_table()
-    elif function_name == 'create_directories_table':
-        create_directories_table()
     else:
         print(f"Unknown function: {function_name}")
 
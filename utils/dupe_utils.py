@@ -4,9 +4,10 @@ import shutil
 
 import requests
 
+from utils import http_utils
 from utils.bcolors import bcolors
 from utils.config_loader import ConfigLoader
-from utils.logging_utils import log_to_file
+from utils.logging_utils import log_event
 from utils.torrent_utils import download_torrent
 
 # Load configuration
@@ -67,17 +68,16 @@ def check_and_download_dupe(release_name, cookies):
 
     try:
         print(f"{bcolors.YELLOW}Checking for dupe: {release_name}\n{bcolors.ENDC}")
-        response = requests.get(search_url, cookies=cookies, headers={'User-Agent': 'Mozilla/5.0'})
+        response = http_utils.get('site', search_url, cookies=cookies, headers={'User-Agent': 'Mozilla/5.0'})
         response.raise_for_status()
 
         # Log the response
-        log_to_file(os.path.join(TMP_DIR, 'dupe_check_response.log'), response.text)
+        log_event('dupe_check', "Search response", 'debug', status=response.status_code, body=response.text)
 
         # Check if the response is empty
         if not response.text.strip():
             print(f"{bcolors.FAIL}Did not found a dupe for: {release_name}\n{bcolors.ENDC}")
-            log_to_file(os.path.join(TMP_DIR, 'dupe_empty_response.log'),
-                        f"Empty response received for: {release_name}")
+            log_event('dupe_check', f"Empty response received for: {release_name}", 'warning')
             return False
 
         # Parse the JSON response
@@ -85,14 +85,12 @@ def check_and_download_dupe(release_name, cookies):
             torrents = json.loads(response.text)
         except json.JSONDecodeError as e:
             print(f"{bcolors.FAIL}Failed to decode JSON response: {str(e)}{bcolors.ENDC}")
-            log_to_file(os.path.join(TMP_DIR, 'dupe_json_decode_error.log'),
-                        f"Failed to decode JSON response: {str(e)}")
+            log_event('dupe_check', f"Failed to decode JSON response: {str(e)}", 'error', body=response.text)
             return False
 
         if not isinstance(torrents, list):
             print(f"{bcolors.FAIL}Unexpected response format for: {release_name}{bcolors.ENDC}")
-            log_to_file(os.path.join(TMP_DIR, 'dupe_unexpected_format.log'),
-                        f"Unexpected response format for: {release_name}")
+            log_event('dupe_check', f"Unexpected response format for: {release_name}", 'error', body=response.text)
             return False
 
         for torrent in torrents:
@@ -101,8 +99,7 @@ def check_and_download_dupe(release_name, cookies):
                 dupe_torrent_url = f"{config.get('Website', 'SITEURL')}/api/v1/torrents/download/{torrent_id}"
 
                 # Log and print the duplicate detection
-                log_to_file(os.path.join(TMP_DIR, 'dupe_detected.log'),
-                            f"Duplicate found: {release_name} (ID: {torrent_id})")
+                log_event('dupe_check', f"Duplicate found: {release_name} (ID: {torrent_id})", torrent_id=torrent_id)
                 print(f"{bcolors.OKGREEN}Duplicate found: {release_name}.{bcolors.ENDC}")
 
                 # If DUPECHECK is true and DUPEDL is false, exit the script after checking for duplicates
@@ -124,11 +121,11 @@ def check_and_download_dupe(release_name, cookies):
 
         # If no duplicate was found
         print(f"{bcolors.FAIL}No duplicate found for: {release_name}{bcolors.ENDC}")
-        log_to_file(os.path.join(TMP_DIR, 'dupe_not_found.log'), f"No duplicate found for: {release_name}")
+        log_event('dupe_check', f"No duplicate found for: {release_name}")
         return False
 
     except requests.RequestException as e:
         # Log any request exceptions
-        log_to_file(os.path.join(TMP_DIR, 'dupe_check_error.log'), f"Failed to check for duplicate: {str(e)}")
+        log_event('dupe_check', f"Failed to check for duplicate: {str(e)}", 'error')
         print(f"{bcolors.FAIL}Failed to check for duplicate: {str(e)}{bcolors.ENDC}")
         return False
@@ -0,0 +1,310 @@
+import argparse
+import heapq
+import random
+import time
+from collections import defaultdict
+
+from utils.concurrency_utils import PRIORITIES, RESOURCES, get_slot_limits, pid_alive
+from utils.database_utils import delete_upload_jobs, fetch_progress, fetch_stage_history, fetch_stage_limits, \
+    fetch_stage_slots, fetch_upload_jobs
+
+# Stages in the order backend.py runs them
+STAGES = ('login', 'dupe_check', 'category', 'screenshots', 'mediainfo', 'imdb', 'igdb', 'hashing', 'image_upload',
+          'template', 'tracker_upload')
+# The stages backend.py runs inside a stage_slot() of a concurrency_utils resource
+STAGE_RESOURCES = {'hashing': 'hashing', 'image_upload': 'network', 'tracker_upload': 'network'}
+
+# Successful uploads learned from, and the samples a group needs before it is used instead of a broader one
+HISTORY_UPLOADS = 500
+MIN_SAMPLES = 5
+# Until there is history: (seconds, seconds per GiB) of the stages every upload runs
+DEFAULT_STAGES = {'login': (2, 0), 'dupe_check': (2, 0), 'category': (0, 0), 'hashing': (2, 7), 'image_upload': (10, 0),
+                  'template': (1, 0), 'tracker_upload': (5, 0)}
+# Seconds a hashing progress row stays more trustworthy than the prediction
+PROGRESS_FRESHNESS = 30
+
+
+def solve(matrix, vector):
+    """Solve a small linear system by Gaussian elimination, None if it's singular."""
+    size = len(vector)
+    rows = [list(matrix[i]) + [vector[i]] for i in range(size)]
+    for column in range(size):
+        pivot = max(range(column, size), key=lambda row: abs(rows[row][column]))
+        if abs(rows[pivot][column]) < 1e-12:
+            return None
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        for row in range(size):
+            if row != column:
+                factor = rows[row][column] / rows[column][column]
+                rows[row] = [a - factor * b for a, b in zip(rows[row], rows[column])]
+    return [rows[i][size] / rows[i][i] for i in range(size)]
+
+
+def fit_linear(samples):
+    """Least squares fit of duration = constant + a * GiB + b * files, without negative slopes.
+
+    A feature whose slope comes out negative, noise for a stage that doesn't depend on it, is dropped and the fit
+    repeated, so a larger release is never predicted to be faster.
+
+    Args:
+        samples (list): (GiB, file count, seconds) per upload
+
+    Returns:
+        dict: Coefficients of 'constant', 'gib' and 'files'
+    """
+    features = ['gib', 'files']
+    while True:
+        columns = [[1.0] * len(samples)] + [[sample[('gib', 'files').index(name)] for sample in samples]
+                                            for name in features]
+        durations = [sample[2] for sample in samples]
+        matrix = [[sum(a * b for a, b in zip(left, right)) for right in columns] for left in columns]
+        vector = [sum(a * b for a, b in zip(column, durations)) for column in columns]
+        solution = solve(matrix, vector)
+        if solution is None and features:
+            features.pop()
+            continue
+        coefficients = dict(zip(['constant'] + features, solution or [sum(durations) / len(durations)]))
+        negative = [name for name in features if coefficients[name] < 0]
+        if not negative:
+            return {name: coefficients.get(name, 0.0) for name in ('constant', 'gib', 'files')}
+        features.remove(negative[0])
+
+
+class EtaPredictor:
+    """Predict stage durations from the stages of past uploads.
+
+    Each stage is fitted per (category, device), falling back to per category, per device and finally all uploads
+    when a group has fewer than MIN_SAMPLES uploads. Stages that only run for some uploads (screenshots, imdb, ...)
+    are weighted by how often they ran for the category.
+    """
+
+    def __init__(self, history):
+        """
+        Args:
+            history (list): Rows of database_utils.fetch_stage_history()
+        """
+        self.uploads = {}
+        self.samples = defaultdict(list)
+        for upload_id, stage, duration, size_bytes, file_count, category, device in history:
+            self.uploads[upload_id] = category
+            sample = (size_bytes / 2 ** 30, file_count or 0, duration)
+            for key in ((category, device), (category, None), (None, device), (None, None)):
+                self.samples[(stage,) + key].append((upload_id, sample))
+        self.category_uploads = defaultdict(int)
+        for category in self.uploads.values():
+            self.category_uploads[category] += 1
+        self.models = {}
+
+    @classmethod
+    def load(cls):
+        return cls(fetch_stage_history(HISTORY_UPLOADS))
+
+    def model(self, stage, category, device):
+        """Coefficients for a stage, None if no upload ever ran it."""
+        for key in ((stage, category, device), (stage, category, None), (stage, None, device), (stage, None, None)):
+            samples = self.samples.get(key, [])
+            if len(samples) >= MIN_SAMPLES or (key[1:] == (None, None) and samples):
+                if key not in self.models:
+                    self.models[key] = fit_linear([sample for _, sample in samples])
+                return self.models[key]
+        return None
+
+    def probability(self, stage, category):
+        """How often uploads of a category ran a stage."""
+        if not self.uploads:
+            return 1.0 if stage in DEFAULT_STAGES else 0.0
+        if self.category_uploads.get(category, 0) >= MIN_SAMPLES:
+            ran = {upload_id for upload_id, _ in self.samples.get((stage, category, None), [])}
+            return len(ran) / self.category_uploads[category]
+        ran = {upload_id for upload_id, _ in self.samples.get((stage, None, None), [])}
+        return len(ran) / len(self.uploads)
+
+    def predict(self, stage, size_bytes, file_count, category=None, device=None):
+        """Seconds a stage takes if it runs."""
+        model = self.model(stage, category, device)
+        gib = (size_bytes or 0) / 2 ** 30
+        if model is None:
+            constant, per_gib = DEFAULT_STAGES.get(stage, (0, 0))
+            return constant + per_gib * gib
+        return max(model['constant'] + model['gib'] * gib + model['files'] * (file_count or 0), 0.0)
+
+    def predict_stages(self, size_bytes, file_count, category=None, device=None):
+        """Get {stage: expected seconds} of a whole upload, each weighted by how likely it is to run."""
+        expected = {}
+        for stage in STAGES:
+            probability = self.probability(stage, category)
+            if probability:
+                expected[stage] = probability * self.predict(stage, size_bytes, file_count, category, device)
+        return expected
+
+
+def simulate_queue(jobs, limits):
+    """Play the remaining stages of every job through the slot limits, like concurrency_utils schedules them.
+
+    Args:
+        jobs (list): Dicts with 'order' (sort key of the job's place in line, lower goes first), 'steps' (list of
+                     (resource or None, seconds)) and 'holding' (the resource whose slot the first step already has)
+        limits (dict): Slots per resource
+
+    Returns:
+        list: Seconds from now until each job is done
+    """
+    free = dict(limits)
+    held = [None] * len(jobs)
+    position = [0] * len(jobs)
+    finish = [0.0] * len(jobs)
+    waiting = defaultdict(list)
+    events = []
+    for index, job in enumerate(jobs):
+        if job['holding']:
+            free[job['holding']] -= 1
+        heapq.heappush(events, (0.0, index))
+
+    def start(now, index):
+        resource, seconds = jobs[index]['steps'][position[index]]
+        position[index] += 1
+        heapq.heappush(events, (now + seconds, index))
+
+    while events:
+        now, index = heapq.heappop(events)
+        if held[index]:
+            resource = held[index]
+            held[index] = None
+            free[resource] += 1
+            while free[resource] > 0 and waiting[resource]:
+                _, next_index = heapq.heappop(waiting[resource])
+                free[resource] -= 1
+                held[next_index] = resource
+                start(now, next_index)
+        job = jobs[index]
+        if position[index] == len(job['steps']):
+            finish[index] = now
+            continue
+        resource = job['steps'][position[index]][0]
+        if position[index] == 0 and job['holding']:
+            held[index] = resource
+        elif resource:
+            if free[resource] <= 0:
+                heapq.heappush(waiting[resource], (job['order'], index))
+                continue
+            free[resource] -= 1
+            held[index] = resource
+        start(now, index)
+    return finish
+
+
+def queue_eta(predictor=None, now=None):
+    """Predict when every upload in progress finishes, and when the whole queue is done.
+
+    Returns:
+        dict: 'jobs' (list of dicts per upload, in the order they finish) and 'drain_seconds'
+    """
+    predictor = predictor or EtaPredictor.load()
+    now = now or time.time()
+    rows = fetch_upload_jobs()
+    dead = [row[0] for row in rows if not pid_alive(row[1])]
+    if dead:
+        delete_upload_jobs(dead)
+
+    slots = {(job, resource): state for job, resource, _, state, *_ in fetch_stage_slots()}
+    stored = fetch_stage_limits()
+    limits = {resource: stored[resource][0] if resource in stored else get_slot_limits(resource)[0]
+              for resource in RESOURCES}
+    priorities = {number: name for name, number in PRIORITIES.items()}
+
+    jobs = []
+    for job, pid, name, priority, size_bytes, file_count, category, device, stage, stage_started, started in rows:
+        if pid_alive(pid) is False or job in dead:
+            continue
+        expected = predictor.predict_stages(size_bytes, file_count, category, device)
+        steps = []
+        holding = None
+        current = STAGES.index(stage) if stage in STAGES else -1
+        if current >= 0:
+            remaining = max(expected.get(stage, 0) - (now - stage_started), 0.0)
+            progress = fetch_progress(job)
+            if stage == 'hashing' and progress and progress[4] is not None \
+                    and now - progress[5] < PROGRESS_FRESHNESS:
+                remaining = progress[4]
+            resource = STAGE_RESOURCES.get(stage)
+            state = slots.get((job, resource))
+            if resource and state == 'running':
+                holding = resource
+            # A paused job has to wait for a slot again, a finished stage's slot is released already
+            steps.append((resource if state in ('running', 'paused') else None, remaining))
+        for later in STAGES[current + 1:]:
+            if later in expected:
+                steps.append((STAGE_RESOURCES.get(later), expected[later]))
+        state = next((slots[(job, resource)] for resource in RESOURCES if (job, resource) in slots), 'running')
+        work = sum(seconds for _, seconds in steps)
+        jobs.append({'job': job, 'name': name, 'priority': priorities.get(priority, priority),
+                     'stage': stage, 'state': state, 'remaining_seconds': work,
+                     'order': (-priority, work, started), 'steps': steps, 'holding': holding})
+
+    for job, seconds in zip(jobs, simulate_queue(jobs, limits)):
+        job['finish_seconds'] = seconds
+        del job['order'], job['steps'], job['holding']
+    jobs.sort(key=lambda job: job['finish_seconds'])
+    return {'jobs': jobs, 'drain_seconds': max((job['finish_seconds'] for job in jobs), default=0.0),
+            'limits': limits}
+
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    return f"{seconds // 60}m{seconds % 60:02d}s"
+
+
+def check(uploads=300, seed=1):
+    """Fit synthetic history with known costs and check the predictions and the queue simulation."""
+    rng = random.Random(seed)
+    devices = {'sda1': 180, 'nvme0n1p1': 1500}  # MiB/s
+    history = []
+    for upload_id in range(uploads):
+        device = rng.choice(list(devices))
+        category = rng.choice(['Movies', 'TV', 'Games'])
+        size = rng.uniform(0.2, 60) * 2 ** 30
+        files = rng.randint(1, 300)
+        noise = lambda: rng.uniform(0.9, 1.1)
+        history.append((upload_id, 'login', 1.5 * noise(), size, files, category, device))
+        history.append((upload_id, 'hashing', (1 + size / 2 ** 20 / devices[device] + 0.002 * files) * noise(),
+                        size, files, category, device))
+        if category != 'Games':
+            history.append((upload_id, 'screenshots', 12 * noise(), size, files, category, device))
+        history.append((upload_id, 'tracker_upload', 4 * noise(), size, files, category, device))
+
+    predictor = EtaPredictor(history)
+    for device, rate in devices.items():
+        size = 20 * 2 ** 30
+        actual = 1 + size / 2 ** 20 / rate + 0.002 * 100
+        predicted = predictor.predict('hashing', size, 100, 'Movies', device)
+        print(f"hashing 20 GiB on {device}: predicted {predicted:.1f}s, actual {actual:.1f}s")
+        assert abs(predicted - actual) / actual < 0.1
+    assert predictor.probability('screenshots', 'Games') == 0
+    assert abs(predictor.probability('screenshots', 'Movies') - 1) < 1e-9
+
+    # One hashing slot: three 60s hashes queue up behind each other, network stages overlap with the next hash
+    jobs = [{'order': (0, index), 'holding': None, 'steps': [('hashing', 60), ('network', 10)]} for index in range(3)]
+    finish = simulate_queue(jobs, {'hashing': 1, 'network': 2})
+    print(f"3 jobs through 1 hashing slot finish after {finish}")
+    assert finish == [70, 130, 190]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Predict when queued and running uploads finish")
+    parser.add_argument('command', nargs='?', choices=('status', 'check'), default='status')
+    args = parser.parse_args()
+    if args.command == 'check':
+        check()
+        return
+
+    eta = queue_eta()
+    for job in eta['jobs']:
+        print(f"{job['name']}: {job['state']} ({job['priority']}) in {job['stage'] or 'startup'}, "
+              f"done in {format_seconds(job['finish_seconds'])}, {format_seconds(job['remaining_seconds'])} of work")
+    print(f"Queue drains in {format_seconds(eta['drain_seconds'])}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,139 @@
+import hashlib
+import json
 import os
+import time
+from pathlib import Path
 
-import rfr
-
+from utils import bencode_utils
 from utils.art_utils import ascii_art_header
 from utils.bcolors import bcolors
 
 
-def add_fastresume(torrent_file, download_dir, output_file):
-    """Add fast resume to the torrent using the rfr Python module."""
-    #print(f"{bcolors.OKBLUE}Adding fast resume information...{bcolors.ENDC}")
-    #print(f"Torrent file: {torrent_file}")
-    #print(f"Download directory: {download_dir}")
-    #print(f"Output file: {output_file}")
+def manifest_path(torrent_file):
+    """Path of the hash manifest written next to a torrent created by create_torrent()."""
+    return Path(torrent_file).with_suffix('.resume.json')
+
+
+def write_manifest(torrent_file, files, piece_length):
+    """Record what was hashed for a torrent, so fast resume can be added later without touching the data.
+
+    Only call this once every piece has been hashed from the files as listed, which is what proves the data complete.
+
+    Args:
+        torrent_file (str): Path of the created torrent
+        files (list): The list_files() listing the torrent was hashed from
+        piece_length (int): Piece length in bytes
+    """
+    with open(torrent_file, 'rb') as f:
+        pieces = bencode_utils.decode(f.read())[b'info'][b'pieces']
+    manifest = {
+        'piece_length': piece_length,
+        'pieces': len(pieces) // 20,
+        # A torrent downloaded back from the site only matches if it carries exactly these piece hashes
+        'pieces_sha1': hashlib.sha1(pieces).hexdigest(),
+        'files': [['/'.join(parts), size, mtime] for parts, size, mtime in files],
+        'hashed': int(time.time()),
+    }
+    with open(manifest_path(torrent_file), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+
+
+def calc_chunks(length, piece_length):
+    """Number of pieces that `length` bytes touch, counting from the start of the torrent."""
+    return -(-length // piece_length)
+
+
+def build_resume_data(metainfo, manifest, download_dir):
+    """Add rtorrent fast resume data to a decoded torrent from a hash manifest, the way rfr does after checking files.
+
+    Args:
+        metainfo (dict): Decoded torrent, bytes keys, modified in place
+        manifest (dict): Manifest written by write_manifest()
+        download_dir (str): Directory the torrent's data is in (DATADIR)
+
+    Raises:
+        ValueError: If the torrent doesn't describe the hashed files, e.g. a dupe with another piece length
+    """
+    info = metainfo[b'info']
+    name = info[b'name'].decode()
+    piece_length = info[b'piece length']
+    if piece_length != manifest['piece_length']:
+        raise ValueError(f"Piece length {piece_length} differs from the hashed {manifest['piece_length']}")
+    if hashlib.sha1(info[b'pieces']).hexdigest() != manifest['pieces_sha1']:
+        raise ValueError("Piece hashes differ from the hashed torrent")
+
+    if b'files' in info:
+        torrent_files = [('/'.join(part.decode() for part in entry[b'path']), entry[b'length'])
+                         for entry in info[b'files']]
+        directory = os.path.join(download_dir, name)
+    else:
+        torrent_files = [(name, info[b'length'])]
+        directory = download_dir
+
+    hashed = {path: (size, mtime) for path, size, mtime in manifest['files']}
+    # Hashers leave empty files out of the torrent, every other hashed file has to be in it
+    in_torrent = {path for path, _ in torrent_files}
+    missing = [path for path, (size, _) in hashed.items() if size and path not in in_torrent]
+    if missing:
+        raise ValueError(f"{len(missing)} hashed files are not in the torrent, e.g. {missing[0]}")
+
+    resume_files = []
+    offset = 0
+    for path, length in torrent_files:
+        if hashed.get(path, (None, None))[0] != length:
+            raise ValueError(f"{path} was not hashed with a size of {length} bytes")
+        completed = calc_chunks(offset + length, piece_length) - calc_chunks(offset + 1, piece_length) + 1 \
+            if length else 0
+        resume_files.append({b'priority': 0, b'mtime': hashed[path][1], b'completed': completed})
+        offset += length
+
+    now = int(time.time())
+    metainfo[b'libtorrent_resume'] = {
+        b'files': resume_files,
+        b'bitfield': manifest['pieces'],
+        b'uncertain_pieces.timestamp': now,
+    }
+    metainfo[b'rtorrent'] = {
+        b'state': 1,
+        b'state_changed': now,
+        b'state_counter': 1,
+        b'chunks_wanted': 0,
+        b'chunks_done': manifest['pieces'],
+        b'complete': 1,
+        b'hashing': 0,
+        b'directory': directory.encode(),
+        b'timestamp.finished': 0,
+        b'timestamp.started': now,
+    }
+
+
+def add_manifest_fastresume(torrent_file, download_dir, output_file, manifest_file):
+    """Add fast resume from a hash manifest. Reads two small files and touches nothing under download_dir.
+
+    Returns:
+        bool: True if the output was written, False if the manifest doesn't fit the torrent
+    """
+    try:
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        with open(torrent_file, 'rb') as f:
+            metainfo = bencode_utils.decode(f.read())
+        build_resume_data(metainfo, manifest, os.path.expanduser(os.path.expandvars(download_dir)))
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"{bcolors.WARNING}Can't use hash manifest ({e}), checking files instead{bcolors.ENDC}")
+        return False
+
+    with open(output_file, 'wb') as f:
+        f.write(bencode_utils.encode(metainfo))
+    return True
+
+
+def add_fastresume(torrent_file, download_dir, output_file, manifest_file=None):
+    """Add fast resume to the torrent.
+
+    Uses the hash manifest of the torrent we created when there is one, otherwise falls back to the rfr Python
+    module, which checks every file in download_dir.
+    """
     print(ascii_art_header("Fastresume"))
 
     try:
@@ -19,15 +141,19 @@ def add_fastresume(torrent_file, download_dir, output_file):
         if not os.path.isfile(torrent_file):
             raise FileNotFoundError(f"Torrent file not found: {torrent_file}")
 
-        # Initialize FastTorrent object
-        tor = rfr.FastTorrent(torrent_file, download_dir)
-        
-        # Generate fast resume data
-        tor.do_resume()
-        
-        # Save the resulting torrent to a file
-        tor.save_to_file(output_file)
-        
+        if not (manifest_file and os.path.isfile(manifest_file)
+                and add_manifest_fastresume(torrent_file, download_dir, output_file, manifest_file)):
+            import rfr
+
+            # Initialize FastTorrent object
+            tor = rfr.FastTorrent(torrent_file, download_dir)
+
+            # Generate fast resume data
+            tor.do_resume()
+
+            # Save the resulting torrent to a file
+            tor.save_to_file(output_file)
+
         if os.path.exists(output_file):
             print(f"{bcolors.OKGREEN}Fast resume added successfully: {output_file}\n{bcolors.ENDC}")
         else:
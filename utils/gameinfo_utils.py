@@ -1,12 +1,12 @@
+import asyncio
 import os
 import re
 from datetime import datetime, timezone
 from pathlib import Path
 
-import requests
-
+from utils import http_utils
 from utils.config_loader import ConfigLoader
-from utils.logging_utils import log_to_file
+from utils.logging_utils import log_event
 
 # Load configuration
 config = ConfigLoader().get_config()
@@ -24,7 +24,7 @@ def get_igdb_token():
         'client_secret': igdb_client_secret,
         'grant_type': 'client_credentials'
     }
-    response = requests.post(auth_url, params=params)
+    response = http_utils.post('igdb', auth_url, params=params)
     if response.status_code == 200:
         return response.json()['access_token']
     else:
@@ -84,14 +84,12 @@ def fetch_game_info(game_name, releasedir):
     image_dir = tmp_dir / 'images'
     image_dir.mkdir(parents=True, exist_ok=True)
 
-    log_file_path = tmp_dir / 'game_info.log'
-
     try:
-        response = requests.post(search_url, headers=headers, data=query)
+        response = http_utils.post('igdb', search_url, headers=headers, data=query)
         if response.status_code == 200:
             game_data = response.json()
             if not game_data:
-                log_to_file(log_file_path, f"Game not found for {game_name}")
+                log_event('game_info', f"Game not found for {game_name}", 'warning')
                 return None
 
             # Process the first result (most relevant)
@@ -122,31 +120,32 @@ def fetch_game_info(game_name, releasedir):
                 'images': []  # Placeholder for downloaded image paths
             }
 
-            log_to_file(log_file_path, f"Game info fetched for {game_name}: {game_info}")
-
-            # Download cover image and screenshots
-            counter = 1
+            log_event('game_info', f"Game info fetched for {game_name}", name=game_info['game_name'],
+                      release_date=release_date, screenshots=len(game_info['screenshots']))
 
+            # Download cover image and up to 3 screenshots (4 images total) concurrently
+            downloads = []
             if game_info['cover_image']:
-                cover_image_path = download_image(game_info['cover_image'], f"{counter}-cover.jpg", image_dir, game_name)
-                if cover_image_path:
-                    game_info['images'].append(cover_image_path)
-                counter += 1
-
+                downloads.append((game_info['cover_image'], "cover"))
             for screenshot_url in game_info['screenshots']:
-                if counter > 4:  # Limit to 4 images (cover + screenshots)
-                    break
-                screenshot_path = download_image(screenshot_url, f"{counter}-screenshot.jpg", image_dir, game_name)
-                if screenshot_path:
-                    game_info['images'].append(screenshot_path)
-                counter += 1
+                downloads.append((screenshot_url, "screenshot"))
+            downloads = downloads[:4]
+
+            async def download_all():
+                return await asyncio.gather(*(
+                    download_image_async(url, f"{counter}-{kind}.jpg", image_dir, game_name)
+                    for counter, (url, kind) in enumerate(downloads, start=1)
+                ))
+
+            game_info['images'] = [path for path in http_utils.run(download_all()) if path]
 
             return game_info
         else:
-            log_to_file(log_file_path, f"Failed to fetch game info for {game_name}: {response.text}")
+            log_event('game_info', f"Failed to fetch game info for {game_name}", 'error', status=response.status_code,
+                      body=response.text)
             return None
     except Exception as e:
-        log_to_file(log_file_path, f"Error fetching game info for {game_name}: {str(e)}")
+        log_event('game_info', f"Error fetching game info for {game_name}: {str(e)}", 'error')
         return None
 
 
@@ -164,18 +163,23 @@ def download_image(image_url, filename, image_dir, game_name):
     Returns:
         Path: The path to the saved image, or None if the download failed.
     """
-    log_file_path = Path(config.get('Paths', 'TMP_DIR')) / str(os.getpid()) / 'game_info.log'
+    return http_utils.run(download_image_async(image_url, filename, image_dir, game_name))
+
+
+async def download_image_async(image_url, filename, image_dir, game_name):
+    """Async version of download_image."""
     try:
-        response = requests.get(image_url)
+        response = await http_utils.aget('igdb', image_url)
         if response.status_code == 200:
             image_path = image_dir / filename
             with open(image_path, 'wb') as image_file:
                 image_file.write(response.content)
-            log_to_file(log_file_path, f"Downloaded {filename} for {game_name}")
+            log_event('game_info', f"Downloaded {filename} for {game_name}", size=len(response.content))
             return image_path
         else:
-            log_to_file(log_file_path, f"Failed to download image {filename} for {game_name}: {response.text}")
+            log_event('game_info', f"Failed to download image {filename} for {game_name}", 'error',
+                      status=response.status_code)
             return None
     except Exception as e:
-        log_to_file(log_file_path, f"Error downloading image {filename} for {game_name}: {str(e)}")
+        log_event('game_info', f"Error downloading image {filename} for {game_name}: {str(e)}", 'error')
         return None
@@ -0,0 +1,230 @@
+import argparse
+import ctypes
+import os
+import platform
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from utils.config_loader import ConfigLoader
+
+# Load configuration
+config = ConfigLoader().get_config()
+
+# Seconds between checks of which profile is active, so a long hash slows down or speeds up when the hour comes
+PROFILE_CHECK_INTERVAL = 60
+
+# ioprio_set(2) has no glibc wrapper, these are its syscall numbers
+IOPRIO_SYSCALLS = {'x86_64': 251, 'aarch64': 30, 'armv7l': 314, 'i686': 289, 'i386': 289}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IO_CLASSES = {'none': 0, 'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+Profile = namedtuple('Profile', ['name', 'read_bytes_per_second', 'nice', 'io_class', 'io_level'])
+UNLIMITED = Profile('unlimited', 0, 0, 'none', 4)
+
+
+def parse_clock(value):
+    """Minutes after midnight of an HH:MM time."""
+    hours, minutes = value.strip().split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+def is_day(minute, day_start, night_start):
+    """Whether `minute` after midnight falls in the day profile, which may wrap past midnight (e.g. 08:00-01:00)."""
+    if day_start <= night_start:
+        return day_start <= minute < night_start
+    return minute >= day_start or minute < night_start
+
+
+def read_profile(prefix):
+    """Read the DAY_ or NIGHT_ options of [Governor] in config.ini."""
+    io_class = config.get('Governor', f'{prefix}_IOCLASS', fallback='best-effort').strip().lower()
+    if io_class not in IO_CLASSES:
+        raise ValueError(f"{prefix}_IOCLASS must be one of {', '.join(IO_CLASSES)}, not {io_class}")
+    return Profile(prefix.lower(),
+                   int(config.getfloat('Governor', f'{prefix}_READ_MIB', fallback=0) * 2 ** 20),
+                   config.getint('Governor', f'{prefix}_NICE', fallback=0),
+                   io_class,
+                   min(max(config.getint('Governor', f'{prefix}_IOLEVEL', fallback=4), 0), 7))
+
+
+def current_profile(now=None):
+    """Get the profile for the time of day, UNLIMITED if the governor is off.
+
+    Args:
+        now (datetime): Defaults to the local time
+
+    Returns:
+        Profile: Read rate (0 for no limit), and niceness and I/O class and level for spawned tools
+    """
+    if not config.getboolean('Governor', 'GOVERNOR', fallback=False):
+        return UNLIMITED
+    now = now or datetime.now()
+    day_start = parse_clock(config.get('Governor', 'DAY_START', fallback='08:00'))
+    night_start = parse_clock(config.get('Governor', 'NIGHT_START', fallback='01:00'))
+    return read_profile('DAY' if is_day(now.hour * 60 + now.minute, day_start, night_start) else 'NIGHT')
+
+
+class TokenBucket:
+    """Limit a byte rate. Thread safe, so the readers of parallel verify workers can share one bucket.
+
+    A read is allowed to overdraw the bucket, the reader then sleeps until the debt is paid. Reads of a whole piece
+    at a time therefore work with any burst size, and the average rate stays exact.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        Args:
+            rate (int): Bytes per second, 0 for no limit
+            burst (int): Bytes that can be read at full speed after idling, defaults to a quarter second's worth
+        """
+        self.lock = threading.Lock()
+        self.tokens = 0
+        self.updated = time.monotonic()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            self.rate = rate
+            self.burst = burst if burst is not None else rate / 4
+            self.tokens = min(self.tokens, self.burst)
+
+    def consume(self, count):
+        """Take `count` bytes from the bucket, sleeping as long as needed to stay under the rate."""
+        with self.lock:
+            if not self.rate:
+                return
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - count
+            self.updated = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class ReadThrottle:
+    """A TokenBucket following the read limit of the active profile, for hashing and verify loops."""
+
+    def __init__(self, profile=None):
+        """
+        Args:
+            profile (Profile): Use this profile for good instead of following the time of day
+        """
+        self.fixed = profile is not None
+        self.profile = profile or current_profile()
+        self.bucket = TokenBucket(self.profile.read_bytes_per_second)
+        self.next_check = time.monotonic() + PROFILE_CHECK_INTERVAL
+
+    def consume(self, count):
+        if not self.fixed and time.monotonic() >= self.next_check:
+            self.next_check = time.monotonic() + PROFILE_CHECK_INTERVAL
+            profile = current_profile()
+            if profile != self.profile:
+                self.profile = profile
+                self.bucket.set_rate(profile.read_bytes_per_second)
+        self.bucket.consume(count)
+
+
+def ioprio_setter():
+    """Get a function setting the I/O priority of the calling process, None where ioprio_set(2) isn't available."""
+    number = IOPRIO_SYSCALLS.get(platform.machine())
+    if platform.system() != 'Linux' or number is None:
+        return None
+    try:
+        syscall = ctypes.CDLL(None, use_errno=True).syscall
+    except (OSError, AttributeError):
+        return None
+    syscall.restype = ctypes.c_long
+
+    def set_ioprio(io_class, io_level):
+        return syscall(number, IOPRIO_WHO_PROCESS, 0, (io_class << IOPRIO_CLASS_SHIFT) | io_level)
+
+    return set_ioprio
+
+
+def spawn_priority(profile=None):
+    """Get a preexec_fn for subprocess that starts a tool (mkbrr, mtn, mediainfo, rar2fs) at the profile's priority.
+
+    Everything is looked up before the fork, the child only makes two system calls. Failures are ignored: a tool that
+    runs at normal priority is better than one that doesn't run.
+
+    Args:
+        profile (Profile): Defaults to the active profile
+
+    Returns:
+        callable: For subprocess's preexec_fn, None if there is nothing to change
+    """
+    profile = profile or current_profile()
+    io_class = IO_CLASSES[profile.io_class]
+    set_ioprio = ioprio_setter() if io_class else None
+    # Unprivileged processes can only lower their priority, so never ask for more than we already have
+    nice = max(os.getpriority(os.PRIO_PROCESS, 0), min(profile.nice, 19)) if profile.nice else None
+    if nice is None and set_ioprio is None:
+        return None
+
+    def preexec():
+        if nice is not None:
+            try:
+                os.setpriority(os.PRIO_PROCESS, 0, nice)
+            except OSError:
+                pass
+        if set_ioprio is not None:
+            set_ioprio(io_class, profile.io_level)
+
+    return preexec
+
+
+def check():
+    """Self-check of the schedule and of the token bucket's rate."""
+    day_start, night_start = parse_clock('08:00'), parse_clock('01:00')
+    for clock, expected in (('07:59', False), ('08:00', True), ('23:59', True), ('00:30', True), ('01:00', False)):
+        assert is_day(parse_clock(clock), day_start, night_start) == expected, clock
+    assert is_day(parse_clock('12:00'), parse_clock('09:00'), parse_clock('17:00'))
+    assert not is_day(parse_clock('18:00'), parse_clock('09:00'), parse_clock('17:00'))
+
+    rate = 64 * 2 ** 20
+    bucket = TokenBucket(rate)
+    start = time.monotonic()
+    for _ in range(32):
+        bucket.consume(4 * 2 ** 20)
+    elapsed = time.monotonic() - start
+    assert 1.9 < elapsed < 2.3, f"128 MiB at 64 MiB/s took {elapsed:.2f}s"
+    print(f"Schedule ok, token bucket read 128 MiB at 64 MiB/s in {elapsed:.2f}s")
+
+    import tempfile
+    from utils.hash_utils import hash_pieces
+    with tempfile.NamedTemporaryFile(dir='.') as f:
+        f.write(os.urandom(64 * 2 ** 20))
+        f.flush()
+        start = time.monotonic()
+        hash_pieces([f.name], [64 * 2 ** 20], 2 ** 20,
+                    throttle=ReadThrottle(Profile('check', 32 * 2 ** 20, 0, 'none', 4)))
+        elapsed = time.monotonic() - start
+    assert 1.9 < elapsed < 2.5, f"Hashing 64 MiB at 32 MiB/s took {elapsed:.2f}s"
+    print(f"Hashed 64 MiB at 32 MiB/s in {elapsed:.2f}s")
+
+    preexec = spawn_priority(Profile('check', 0, 5, 'idle', 7))
+    if preexec:
+        import subprocess
+        output = subprocess.run(['sh', '-c', 'cat /proc/self/stat; ionice -p $$ 2>/dev/null'], capture_output=True,
+                                text=True, preexec_fn=preexec).stdout.split('\n')
+        print(f"Spawned tool: nice {output[0].rsplit(')', 1)[1].split()[16]}, ioprio {output[1] or 'unknown'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resource governor for hashing and media tools")
+    parser.add_argument('command', nargs='?', choices=('status', 'check'), default='status')
+    args = parser.parse_args()
+    if args.command == 'check':
+        check()
+        return
+    profile = current_profile()
+    limit = f"{profile.read_bytes_per_second / 2 ** 20:.0f} MiB/s" if profile.read_bytes_per_second else "unlimited"
+    print(f"Profile {profile.name}: reads {limit}, tools at nice {profile.nice}, "
+          f"I/O class {profile.io_class} level {profile.io_level}")
+
+
+if __name__ == '__main__':
+    main()
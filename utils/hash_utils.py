@@ -0,0 +1,482 @@
+import argparse
+import hashlib
+import json
+import os
+import queue
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from utils.config_loader import ConfigLoader
+from utils.governor_utils import ReadThrottle, current_profile
+
+# Load configuration
+config = ConfigLoader().get_config()
+
+# Defaults for the [Torrent] options, see config.ini
+HASH_WORKERS = 4
+# A release counts as small-file heavy when its pieces span this many files on average, or when most files are
+# smaller than SMALL_FILE_SIZE. Either way per-file open/read/close dominates over reading the data.
+SMALL_FILE_RATIO = 4
+SMALL_FILE_SIZE = 1024 * 1024
+# How far the prefetcher opens files ahead of the reader
+PREFETCH_FILES = 512
+PREFETCH_BYTES = 64 * 1024 * 1024
+# With CACHE_FRIENDLY_HASHING, how much is read ahead, and how often pages already hashed are dropped from the cache
+CACHE_FRIENDLY_PREFETCH_BYTES = 8 * 1024 * 1024
+DROP_BYTES = 8 * 1024 * 1024
+# Where hash_pieces() keeps the pieces hashed so far, and how often it saves them while hashing
+CHECKPOINT_DIR = Path('data/checkpoints')
+CHECKPOINT_INTERVAL = 60
+
+
+class HashError(Exception):
+    pass
+
+
+def is_small_file_heavy(files, piece_length):
+    """Whether a release is mostly small files, see SMALL_FILE_RATIO and SMALL_FILE_SIZE.
+
+    Args:
+        files (FileList): The release's files
+        piece_length (int): Piece length in bytes
+    """
+    count = len(files)
+    if count < 2:
+        return False
+    pieces = max(1, -(-files.total_size() // piece_length))
+    small = sum(1 for size in files.sizes if size < SMALL_FILE_SIZE)
+    return count / pieces >= SMALL_FILE_RATIO or small * 2 > count
+
+
+def use_cache_friendly_hashing():
+    return config.getboolean('Torrent', 'CACHE_FRIENDLY_HASHING', fallback=False)
+
+
+def use_native_hasher(files, piece_length):
+    """Apply NATIVE_HASHER from config.ini: 'always', 'never', or 'auto' for small-file heavy releases only.
+
+    CACHE_FRIENDLY_HASHING and a read limit of the active governor profile always take the native engine, torf and
+    mkbrr can't be told to stay out of the page cache or to read slower.
+    """
+    if use_cache_friendly_hashing() or current_profile().read_bytes_per_second:
+        return True
+    mode = config.get('Torrent', 'NATIVE_HASHER', fallback='auto').strip().lower()
+    if mode == 'always':
+        return True
+    if mode == 'auto':
+        return is_small_file_heavy(files, piece_length)
+    return False
+
+
+class Prefetcher:
+    """Open files ahead of the reader in a thread pool and ask the kernel to start reading them.
+
+    Opening is where small files lose most of their time, so it happens in parallel, PREFETCH_FILES or PREFETCH_BYTES
+    ahead of the reader, whichever is hit first. posix_fadvise(WILLNEED) then queues the reads, so by the time the
+    reader gets to a file its data is usually in the page cache already.
+    """
+
+    def __init__(self, paths, sizes, workers, window_bytes=PREFETCH_BYTES):
+        self.window_bytes = window_bytes
+        self.pending = iter(zip(paths, sizes))
+        self.executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+        self.ahead = deque()
+        self.ahead_bytes = 0
+        self.fill()
+
+    def open(self, path, size):
+        fd = os.open(path, os.O_RDONLY)
+        if hasattr(os, 'posix_fadvise') and size:
+            try:
+                # Sequential for the kernel's own readahead, WILLNEED for the start of the file right away
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                os.posix_fadvise(fd, 0, min(size, self.window_bytes), os.POSIX_FADV_WILLNEED)
+            except OSError:
+                pass
+        return fd
+
+    def fill(self):
+        while len(self.ahead) < PREFETCH_FILES and self.ahead_bytes < self.window_bytes:
+            entry = next(self.pending, None)
+            if entry is None:
+                return
+            path, size = entry
+            self.ahead.append((self.executor.submit(self.open, path, size), size))
+            self.ahead_bytes += size
+
+    def next_fd(self):
+        """File descriptor of the next file, in order. The caller closes it."""
+        future, size = self.ahead.popleft()
+        self.ahead_bytes -= size
+        self.fill()
+        return future.result()
+
+    def close(self):
+        # Files opened ahead that will never be read, e.g. after an error
+        for future, _ in self.ahead:
+            try:
+                os.close(future.result())
+            except OSError:
+                pass
+        self.ahead.clear()
+        self.executor.shutdown(wait=True)
+
+
+class HashCheckpoint:
+    """The pieces of an unfinished hash, so a paused or killed hash continues where it was instead of starting over.
+
+    A checkpoint only applies to exactly the files it was made from: same paths, sizes and mtimes, same piece length.
+    """
+
+    def __init__(self, directory, files, piece_length):
+        """
+        Args:
+            directory (Path): The release
+            files (FileList): The files being hashed, in torrent order
+            piece_length (int): Piece length in bytes
+        """
+        fingerprint = hashlib.sha1(b'%d\n' % piece_length)
+        for entry, mtime in zip(files.bencoded_entries(), files.mtimes):
+            fingerprint.update(entry)
+            fingerprint.update(b'%d\n' % mtime)
+        self.fingerprint = fingerprint.hexdigest()
+        self.path = CHECKPOINT_DIR / f"{hashlib.sha1(str(Path(directory).resolve()).encode()).hexdigest()}.json"
+
+    def load(self):
+        """Get the pieces hashed so far, 20 bytes each, empty if there is no usable checkpoint."""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+            if saved['fingerprint'] == self.fingerprint:
+                return bytes.fromhex(saved['pieces'])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return b''
+
+    def save(self, pieces):
+        CHECKPOINT_DIR.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_suffix('.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'fingerprint': self.fingerprint, 'pieces': pieces.hex(), 'saved': int(time.time())}, f)
+        os.replace(temp_path, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def resume_position(sizes, offset):
+    """Find where byte `offset` of the piece stream is.
+
+    Returns:
+        tuple: (index of the file it's in, offset in that file)
+    """
+    for index, size in enumerate(sizes):
+        if offset < size:
+            return index, offset
+        offset -= size
+    return len(sizes), 0
+
+
+def drop_cached(fd, start, length):
+    """Tell the kernel the pages of a file range won't be needed again, so they leave the page cache first."""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, start, length, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+
+def hash_pieces(paths, sizes, piece_length, workers=None, progress=None, cache_friendly=None, throttle=None,
+                checkpoint=None, pause_point=None):
+    """Hash files as one stream of pieces, the way they are laid out in a torrent.
+
+    Files are read with readinto() straight into reusable piece buffers, so a piece spanning hundreds of files is
+    never concatenated. Full pieces are hashed in a thread pool, hashlib releases the GIL.
+
+    In cache friendly mode the read-ahead window shrinks to CACHE_FRIENDLY_PREFETCH_BYTES, and every DROP_BYTES the
+    pages behind the read cursor are dropped with posix_fadvise(DONTNEED). A release then never occupies more than a
+    few MiB of page cache, instead of pushing out whatever the torrent client is seeding from it.
+
+    Args:
+        paths (list): Files in torrent order
+        sizes (list): Their sizes, a file that turns out shorter or longer raises HashError
+        piece_length (int): Piece length in bytes
+        workers (int): Threads for opening files and for hashing pieces, defaults to HASH_WORKERS in config.ini
+        progress (callable): Called with (pieces done, pieces total) from the reading thread
+        cache_friendly (bool): Defaults to CACHE_FRIENDLY_HASHING in config.ini
+        throttle (ReadThrottle): Read rate limit, defaults to the one of the active governor profile
+        checkpoint (HashCheckpoint): Start after the pieces it holds, save progress every CHECKPOINT_INTERVAL seconds
+                                     and before a pause, and remove it when done
+        pause_point (callable): Called after every piece with a function that checkpoints, e.g.
+                                concurrency_utils.preemption_point, which may block for as long as the hash is paused
+
+    Returns:
+        bytes: The pieces, 20 bytes of SHA1 per piece
+    """
+    if workers is None:
+        workers = config.getint('Torrent', 'HASH_WORKERS', fallback=HASH_WORKERS)
+    if cache_friendly is None:
+        cache_friendly = use_cache_friendly_hashing()
+    if throttle is None:
+        throttle = ReadThrottle()
+    total_size = sum(sizes)
+    piece_total = max(1, -(-total_size // piece_length))
+    digests = [None] * piece_total
+
+    resumed = checkpoint.load() if checkpoint else b''
+    start_piece = min(len(resumed) // 20, piece_total - 1)
+    for index in range(start_piece):
+        digests[index] = resumed[index * 20:index * 20 + 20]
+    start_file, start_offset = resume_position(sizes, start_piece * piece_length)
+
+    # Two buffers per worker: one being hashed, one being filled
+    free = queue.Queue()
+    for _ in range(max(workers, 1) * 2):
+        free.put(bytearray(piece_length))
+
+    def hash_piece(index, buffer, length):
+        digests[index] = hashlib.sha1(memoryview(buffer)[:length]).digest()
+        free.put(buffer)
+
+    prefetcher = Prefetcher(paths[start_file:], sizes[start_file:], workers,
+                            CACHE_FRIENDLY_PREFETCH_BYTES if cache_friendly else PREFETCH_BYTES)
+    hashers = ThreadPoolExecutor(max_workers=max(workers, 1))
+    futures = deque()
+    index = start_piece
+    saved_at = time.monotonic()
+
+    def save_checkpoint():
+        nonlocal saved_at
+        # Every piece before `index` has to be hashed before it can be saved
+        while futures:
+            futures.popleft().result()
+        checkpoint.save(b''.join(digests[:index]))
+        saved_at = time.monotonic()
+
+    try:
+        buffer = free.get()
+        view = memoryview(buffer)
+        filled = 0
+        for path, size in zip(paths[start_file:], sizes[start_file:]):
+            fd = prefetcher.next_fd()
+            with open(fd, 'rb', buffering=0, closefd=True) as f:
+                remaining = size
+                dropped = 0
+                if start_offset:
+                    f.seek(start_offset)
+                    remaining -= start_offset
+                    dropped = start_offset
+                    start_offset = 0
+                while remaining:
+                    count = f.readinto(view[filled:filled + min(remaining, piece_length - filled)])
+                    if not count:
+                        raise HashError(f"{path} is shorter than {size} bytes")
+                    filled += count
+                    remaining -= count
+                    throttle.consume(count)
+                    # The data is in our buffer now, the cached pages behind the cursor are only in the way
+                    if cache_friendly and size - remaining - dropped >= DROP_BYTES:
+                        drop_cached(fd, dropped, size - remaining - dropped)
+                        dropped = size - remaining
+                    if filled == piece_length:
+                        futures.append(hashers.submit(hash_piece, index, buffer, filled))
+                        index += 1
+                        buffer = free.get()
+                        view = memoryview(buffer)
+                        filled = 0
+                        if progress:
+                            progress(index, piece_total)
+                        if checkpoint and time.monotonic() - saved_at >= CHECKPOINT_INTERVAL:
+                            save_checkpoint()
+                        if pause_point:
+                            pause_point(save_checkpoint if checkpoint else None)
+                if f.read(1):
+                    raise HashError(f"{path} is longer than {size} bytes")
+                if cache_friendly:
+                    drop_cached(fd, dropped, 0)
+            # Drop finished hashes so the deque doesn't grow with the piece count
+            while futures and futures[0].done():
+                futures.popleft().result()
+        if filled or total_size == 0:
+            futures.append(hashers.submit(hash_piece, index, buffer, filled))
+            index += 1
+        for future in futures:
+            future.result()
+        if progress:
+            progress(index, piece_total)
+    finally:
+        prefetcher.close()
+        hashers.shutdown(wait=True)
+    if checkpoint:
+        checkpoint.remove()
+    return b''.join(digests)
+
+
+def benchmark(file_count=20000, file_size=16 * 1024, piece_length=2 ** 20):
+    """Hash a pack of small files with torf and with hash_pieces(), and check that both give the same pieces.
+
+    The files are written right before, so both runs read from the page cache. That isolates the per-file overhead
+    this engine is about, the part the disk can't hide.
+    """
+    import tempfile
+
+    from torf import Torrent
+
+    with tempfile.TemporaryDirectory() as tmp:
+        release = Path(tmp) / 'Small.File.Pack'
+        paths = []
+        for index in range(file_count):
+            folder = release / f"Disc{index // 1000:02d}"
+            if index % 1000 == 0:
+                folder.mkdir(parents=True)
+            path = folder / f"{index:06d}.flac"
+            path.write_bytes(os.urandom(file_size))
+            paths.append(path)
+        total = file_count * file_size
+        print(f"{file_count} files of {file_size // 1024} KiB, {total / 2 ** 20:.0f} MiB, "
+              f"{piece_length // 1024} KiB pieces")
+
+        start = time.perf_counter()
+        torrent = Torrent(path=release, piece_size=piece_length, private=True)
+        torrent.generate()
+        torf_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        pieces = hash_pieces(paths, [file_size] * file_count, piece_length)
+        native_seconds = time.perf_counter() - start
+
+        for name, seconds in (('torf', torf_seconds), ('native', native_seconds)):
+            print(f"{name:>7}: {seconds:.2f}s, {total / seconds / 2 ** 20:.0f} MiB/s, {file_count / seconds:.0f} files/s")
+        if pieces != torrent.metainfo['info']['pieces']:
+            print("Pieces differ from torf's")
+            sys.exit(1)
+        print("Pieces match torf's")
+
+
+def resident_fraction(path):
+    """Fraction of a file's pages in the page cache, from mincore(2) on a read-only mapping of it."""
+    import ctypes
+    import mmap
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.mmap.restype = ctypes.c_void_p
+    libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+    libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
+    libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+
+    size = os.path.getsize(path)
+    if size == 0:
+        return 1.0
+    pages = -(-size // mmap.PAGESIZE)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        address = libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+        if address in (None, ctypes.c_void_p(-1).value):
+            raise OSError(ctypes.get_errno(), "mmap failed")
+        try:
+            vector = ctypes.create_string_buffer(pages)
+            if libc.mincore(address, size, vector) != 0:
+                raise OSError(ctypes.get_errno(), "mincore failed")
+        finally:
+            libc.munmap(address, size)
+    finally:
+        os.close(fd)
+    return sum(byte & 1 for byte in vector.raw) / pages
+
+
+def cache_benchmark(release_mib=1024, seeding_mib=256, piece_length=2 ** 22):
+    """Hash a release next to a "seeding" reader and compare the page cache damage of both modes.
+
+    A reader thread keeps reading random 16 KiB blocks of a hot file, like a torrent client serving requests, and
+    counts how many of its blocks were still cached. The release's own footprint in the cache after hashing is
+    reported too: that is what pushes the seeding working set out once memory runs short, so on a box with plenty of
+    free memory the hit rate stays high in both modes and the footprint is the number to look at.
+    """
+    import random
+    import tempfile
+    import threading
+
+    block = 16 * 1024
+    with tempfile.TemporaryDirectory(dir='.') as tmp:
+        seeding = Path(tmp) / 'seeding.bin'
+        with open(seeding, 'wb') as f:
+            for _ in range(seeding_mib):
+                f.write(os.urandom(2 ** 20))
+        paths = []
+        for index in range(max(1, release_mib // 64)):
+            path = Path(tmp) / f"release.{index:03d}.rar"
+            with open(path, 'wb') as f:
+                for _ in range(min(64, release_mib)):
+                    f.write(os.urandom(2 ** 20))
+                f.flush()
+                os.fsync(f.fileno())
+            paths.append(path)
+        sizes = [path.stat().st_size for path in paths]
+        print(f"{sum(sizes) / 2 ** 20:.0f} MiB release, {seeding_mib} MiB seeding working set")
+        print(f"{'mode':>15} {'seconds':>8} {'MiB/s':>7} {'seeding hits':>13} {'release cached after':>21}")
+
+        for cache_friendly in (False, True):
+            # Cold release, hot working set
+            for path in paths:
+                fd = os.open(path, os.O_RDONLY)
+                drop_cached(fd, 0, 0)
+                os.close(fd)
+            with open(seeding, 'rb') as f:
+                while f.read(2 ** 24):
+                    pass
+
+            stop = threading.Event()
+            hits = [0, 0]
+
+            def seed():
+                rng = random.Random(0)
+                blocks = seeding_mib * 2 ** 20 // block
+                with open(seeding, 'rb', buffering=0) as f:
+                    while not stop.is_set():
+                        offset = rng.randrange(blocks) * block
+                        # preadv2 with RWF_NOWAIT only succeeds if the data is cached, a cheap hit test
+                        try:
+                            os.preadv(f.fileno(), [bytearray(block)], offset, os.RWF_NOWAIT)
+                            hits[0] += 1
+                        except BlockingIOError:
+                            os.pread(f.fileno(), block, offset)
+                        hits[1] += 1
+
+            reader = threading.Thread(target=seed)
+            reader.start()
+            start = time.perf_counter()
+            hash_pieces(paths, sizes, piece_length, cache_friendly=cache_friendly)
+            seconds = time.perf_counter() - start
+            stop.set()
+            reader.join()
+
+            cached = sum(resident_fraction(path) * size for path, size in zip(paths, sizes)) / sum(sizes)
+            name = 'cache friendly' if cache_friendly else 'normal'
+            print(f"{name:>15} {seconds:>8.2f} {sum(sizes) / seconds / 2 ** 20:>7.0f} "
+                  f"{hits[0] / max(hits[1], 1):>12.1%} {cached:>20.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hashing engine benchmarks")
+    parser.add_argument('benchmark', nargs='?', choices=('small-files', 'cache'), default='small-files',
+                        help="small-files: against torf, cache: page cache impact of both hashing modes")
+    parser.add_argument('--files', type=int, default=20000)
+    parser.add_argument('--size', type=int, default=16 * 1024, help="Bytes per file")
+    parser.add_argument('--piece-length', type=int, default=2 ** 20)
+    parser.add_argument('--release-mib', type=int, default=1024)
+    parser.add_argument('--seeding-mib', type=int, default=256)
+    args = parser.parse_args()
+    if args.benchmark == 'cache':
+        cache_benchmark(args.release_mib, args.seeding_mib, args.piece_length)
+    else:
+        benchmark(args.files, args.size, args.piece_length)
+
+
+if __name__ == '__main__':
+    main()
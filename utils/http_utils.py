@@ -0,0 +1,134 @@
+import asyncio
+import threading
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils.config_loader import ConfigLoader
+
+# Load configuration
+config = ConfigLoader().get_config()
+
+# Defaults per external service: (connect timeout, read timeout) in seconds and max requests in flight.
+# Read timeouts can be overridden in the [Network] section of config.ini, e.g. SITE_TIMEOUT = 120
+SERVICES = {
+    'site': {'timeout': (10, 120), 'concurrency': 2},
+    'imagehost': {'timeout': (10, 60), 'concurrency': 4},
+    'tmdb': {'timeout': (10, 20), 'concurrency': 4},
+    'igdb': {'timeout': (10, 20), 'concurrency': 4},
+    'github': {'timeout': (3, 5), 'concurrency': 1},
+}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+# Bytes of every request sent through the sessions, for accounting_utils
+_sent_bytes = 0
+_sent_lock = threading.Lock()
+# One semaphore per service per event loop, asyncio primitives can't be shared between loops
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def get_timeout(service):
+    """Get the (connect, read) timeout tuple for a service, honoring overrides in config.ini."""
+    connect_timeout, read_timeout = SERVICES[service]['timeout']
+    connect_timeout = config.getfloat('Network', 'CONNECT_TIMEOUT', fallback=connect_timeout)
+    read_timeout = config.getfloat('Network', f'{service.upper()}_TIMEOUT', fallback=read_timeout)
+    return connect_timeout, read_timeout
+
+
+def get_concurrency(service):
+    """Get the maximum number of concurrent requests allowed for a service."""
+    return config.getint('Network', f'{service.upper()}_CONCURRENCY', fallback=SERVICES[service]['concurrency'])
+
+
+def count_sent(response, *args, **kwargs):
+    """Response hook adding the size of the request that got `response`, headers included, to sent_bytes()."""
+    global _sent_bytes
+    prepared = response.request
+    body = prepared.body
+    if isinstance(body, (bytes, str)):
+        size = len(body.encode() if isinstance(body, str) else body)
+    else:
+        # A streamed body, e.g. an open file, is only known by its header
+        size = int(prepared.headers.get('Content-Length', 0))
+    size += len(prepared.method) + len(prepared.url) + sum(len(k) + len(v) + 4 for k, v in prepared.headers.items())
+    with _sent_lock:
+        _sent_bytes += size
+
+
+def sent_bytes():
+    """Bytes sent through the sessions of this process so far."""
+    return _sent_bytes
+
+
+def get_session(service):
+    """Get the shared session for a service, creating it on first use.
+
+    Each session keeps its own connection pool per host, so repeated calls to the same endpoint reuse
+    connections instead of doing a new TCP/TLS handshake every time.
+    """
+    with _sessions_lock:
+        session = _sessions.get(service)
+        if session is None:
+            pool_size = max(get_concurrency(service), 1)
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session = requests.Session()
+            session.hooks['response'].append(count_sent)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[service] = session
+        return session
+
+
+def request(service, method, url, **kwargs):
+    """Perform a blocking HTTP request through the service's session with the service's default timeout.
+
+    Args:
+        service (str): Key into SERVICES, e.g. 'site' or 'tmdb'
+        method (str): HTTP method
+        url (str): URL to request
+        **kwargs: Passed through to requests. Pass timeout explicitly to override the service default.
+
+    Returns:
+        requests.Response: The response. Raises requests.RequestException (including Timeout) on failure.
+    """
+    kwargs.setdefault('timeout', get_timeout(service))
+    return get_session(service).request(method, url, **kwargs)
+
+
+def get(service, url, **kwargs):
+    return request(service, 'GET', url, **kwargs)
+
+
+def post(service, url, **kwargs):
+    return request(service, 'POST', url, **kwargs)
+
+
+def _get_semaphore(service):
+    """Get the semaphore limiting concurrent requests for a service in the running event loop."""
+    loop = asyncio.get_running_loop()
+    loop_semaphores = _semaphores.setdefault(loop, {})
+    if service not in loop_semaphores:
+        loop_semaphores[service] = asyncio.Semaphore(max(get_concurrency(service), 1))
+    return loop_semaphores[service]
+
+
+async def arequest(service, method, url, **kwargs):
+    """Async version of request(). Waits for a free slot in the service's semaphore, then runs the request in a
+    worker thread so other requests and stages can progress in the same event loop."""
+    async with _get_semaphore(service):
+        return await asyncio.to_thread(request, service, method, url, **kwargs)
+
+
+async def aget(service, url, **kwargs):
+    return await arequest(service, 'GET', url, **kwargs)
+
+
+async def apost(service, url, **kwargs):
+    return await arequest(service, 'POST', url, **kwargs)
+
+
+def run(coro):
+    """Run a coroutine to completion from synchronous code."""
+    return asyncio.run(coro)
@@ -4,8 +4,8 @@ import re
 from pathlib import Path
 
 import requests
-from guessit import guessit
 
+from utils import http_utils
 from utils.bcolors import bcolors
 from utils.config_loader import ConfigLoader
 
@@ -13,7 +13,7 @@ from utils.config_loader import ConfigLoader
 config = ConfigLoader().get_config()
 
 def contact_tmdb_api(url):
-    response = requests.get(url)
+    response = http_utils.get('tmdb', url)
     response.raise_for_status()  # Raise an exception for HTTP errors
     return response
 
@@ -23,6 +23,9 @@ def extract_media_details(directory_name, media_type):
         directory_name (str): The directory name to extract details from.
         media_type (str): The type of media ('movie' or 'tv').
         """
+    # guessit is slow to import, only load it when an IMDb lookup actually needs it
+    from guessit import guessit
+
     if media_type == 'tv':
         # See if it's an episode or not via presence of SxxExx format.
         # Probably will fail to match for anime absolute numbering
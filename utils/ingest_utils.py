@@ -0,0 +1,265 @@
+import argparse
+import errno
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from utils.bcolors import bcolors
+
+try:
+    from fcntl import ioctl
+except ImportError:  # Not on Linux, reflinks are never attempted
+    ioctl = None
+
+# From linux/fs.h, clone the extents of one file into another on btrfs/XFS/bcachefs
+FICLONE = 0x40049409
+# Bytes per copy_file_range/sendfile call, large enough to keep syscall overhead negligible
+CHUNK_SIZE = 64 * 1024 * 1024
+DEFAULT_WORKERS = 4
+
+
+class IngestError(Exception):
+    pass
+
+
+def reflink_file(src_fd, dst_fd):
+    """Clone src into dst without copying data. Raises OSError if the filesystem can't do it."""
+    if ioctl is None:
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported on this platform")
+    ioctl(dst_fd, FICLONE, src_fd)
+
+
+def copy_range_file(src_fd, dst_fd, size):
+    """Copy inside the kernel with copy_file_range, which servers like NFS can even offload entirely."""
+    copied = 0
+    while copied < size:
+        sent = os.copy_file_range(src_fd, dst_fd, min(CHUNK_SIZE, size - copied))
+        if sent == 0:
+            break
+        copied += sent
+    return copied
+
+
+def sendfile_file(src_fd, dst_fd, size):
+    """Copy inside the kernel with sendfile, for kernels/filesystems where copy_file_range isn't available."""
+    copied = 0
+    while copied < size:
+        sent = os.sendfile(dst_fd, src_fd, copied, min(CHUNK_SIZE, size - copied))
+        if sent == 0:
+            break
+        copied += sent
+    return copied
+
+
+def copy_file(src, dst):
+    """Copy one file, trying the cheapest method first: reflink, copy_file_range, sendfile, then plain read/write.
+
+    Args:
+        src (Path): File to copy
+        dst (Path): Destination file, must not exist yet
+
+    Returns:
+        str: The method that did the copy
+    """
+    size = src.stat().st_size
+    with open(src, 'rb') as src_file, open(dst, 'xb') as dst_file:
+        src_fd, dst_fd = src_file.fileno(), dst_file.fileno()
+        try:
+            reflink_file(src_fd, dst_fd)
+            return 'reflink'
+        except OSError:
+            pass
+
+        for method, copier in (('copy_file_range', copy_range_file), ('sendfile', sendfile_file)):
+            if method == 'copy_file_range' and not hasattr(os, 'copy_file_range'):
+                continue
+            try:
+                copied = copier(src_fd, dst_fd, size)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+                    raise
+                # Nothing is written when these fail, start over with the next method
+                os.lseek(src_fd, 0, os.SEEK_SET)
+                os.ftruncate(dst_fd, 0)
+                os.lseek(dst_fd, 0, os.SEEK_SET)
+                continue
+            if copied == size:
+                return method
+            raise IngestError(f"Short copy of {src}: {copied} of {size} bytes")
+
+        shutil.copyfileobj(src_file, dst_file, CHUNK_SIZE)
+        return 'read/write'
+
+
+def plan_tree(source, destination):
+    """Create the directory tree of source under destination and list what is left to do per file.
+
+    Returns:
+        tuple: (files, symlinks) where files is a list of (src, dst, size) and symlinks a list of (target, dst)
+    """
+    files = []
+    symlinks = []
+    for dirpath, dirnames, filenames in os.walk(source):
+        rel_dir = Path(dirpath).relative_to(source)
+        (destination / rel_dir).mkdir(parents=True, exist_ok=True)
+        # os.walk doesn't descend into symlinked directories, keep them as links like cp -a does
+        for name in dirnames + filenames:
+            src = Path(dirpath) / name
+            dst = destination / rel_dir / name
+            if src.is_symlink():
+                symlinks.append((os.readlink(src), dst))
+            elif name in filenames:
+                files.append((src, dst, src.stat().st_size))
+    return files, symlinks
+
+
+def finish_tree(source, destination, symlinks):
+    """Recreate symlinks and copy permissions and timestamps of directories, deepest first."""
+    for target, dst in symlinks:
+        os.symlink(target, dst)
+    for dirpath, _, _ in sorted(os.walk(source), key=lambda entry: entry[0].count(os.sep), reverse=True):
+        rel_dir = Path(dirpath).relative_to(source)
+        shutil.copystat(dirpath, destination / rel_dir)
+
+
+def verify_sizes(files):
+    """Make sure every destination file ended up with the size of its source."""
+    for src, dst, size in files:
+        dst_size = dst.stat().st_size
+        if dst_size != size:
+            raise IngestError(f"Size mismatch for {dst}: expected {size} bytes, got {dst_size}")
+
+
+def report(action, total_bytes, elapsed, methods):
+    """Print how much was ingested and how fast."""
+    speed = total_bytes / elapsed / (1024 * 1024) if elapsed > 0 else 0
+    used = ', '.join(f"{count} {method}" for method, count in sorted(methods.items()))
+    print(f"{bcolors.OKGREEN}{action} {total_bytes / (1024 ** 3):.2f} GiB in {elapsed:.2f}s "
+          f"({speed:.2f} MiB/s) [{used}]{bcolors.ENDC}")
+
+
+def copy_tree(source, destination, workers=DEFAULT_WORKERS):
+    """Copy a directory tree with one worker per file, up to `workers` at a time.
+
+    Args:
+        source (Path): Directory to copy
+        destination (Path): Directory to create, must not exist yet
+        workers (int): Number of files copied in parallel
+
+    Returns:
+        int: Number of bytes copied
+    """
+    start = time.perf_counter()
+    files, symlinks = plan_tree(source, destination)
+
+    def copy_one(entry):
+        src, dst, _ = entry
+        method = copy_file(src, dst)
+        shutil.copystat(src, dst)
+        return method
+
+    methods = {}
+    # Biggest files first so one huge file doesn't start last and leave the other workers idle
+    files.sort(key=lambda entry: entry[2], reverse=True)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for method in executor.map(copy_one, files):
+            methods[method] = methods.get(method, 0) + 1
+
+    finish_tree(source, destination, symlinks)
+    verify_sizes(files)
+    total_bytes = sum(size for _, _, size in files)
+    report("Copied", total_bytes, time.perf_counter() - start, methods)
+    return total_bytes
+
+
+def link_tree(source, destination):
+    """Hardlink every file of a directory tree, like cp -al.
+
+    Raises:
+        OSError: If a file can't be hardlinked, e.g. EXDEV when source and destination are on different filesystems
+    """
+    start = time.perf_counter()
+    files, symlinks = plan_tree(source, destination)
+    for src, dst, _ in files:
+        os.link(src, dst)
+    finish_tree(source, destination, symlinks)
+    verify_sizes(files)
+    report("Hardlinked", sum(size for _, _, size in files), time.perf_counter() - start, {'hardlink': len(files)})
+
+
+def ingest(source, data_dir, mode, workers=DEFAULT_WORKERS):
+    """Recreate a directory inside DATADIR.
+
+    Args:
+        source (Path): Directory to ingest
+        data_dir (Path): DATADIR
+        mode (str): 'ln' to hardlink (falls back to a symlink if hardlinking fails), 'cp' to copy, 'mv' to move
+        workers (int): Number of files copied in parallel when data has to be copied
+
+    Returns:
+        Path: The directory inside DATADIR
+    """
+    source = Path(source)
+    destination = Path(data_dir) / source.name
+    if destination.exists() or destination.is_symlink():
+        raise IngestError(f"{destination} already exists")
+
+    if mode == 'ln':
+        try:
+            link_tree(source, destination)
+        except OSError as e:
+            print(f"{bcolors.WARNING}Could not hardlink ({e.strerror}), falling back to symlink{bcolors.ENDC}")
+            shutil.rmtree(destination, ignore_errors=True)
+            destination.symlink_to(source.absolute(), target_is_directory=True)
+            print(f"'{destination}' -> '{source.absolute()}'")
+    elif mode == 'cp':
+        try:
+            copy_tree(source, destination, workers)
+        except BaseException:
+            # Never leave a half copied directory behind for backend.py to pick up
+            shutil.rmtree(destination, ignore_errors=True)
+            raise
+    elif mode == 'mv':
+        try:
+            start = time.perf_counter()
+            os.rename(source, destination)
+            print(f"{bcolors.OKGREEN}Moved {source} to {destination} in {time.perf_counter() - start:.2f}s"
+                  f"{bcolors.ENDC}")
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # Different filesystem, copy then remove the source only once the copy is verified
+            try:
+                copy_tree(source, destination, workers)
+            except BaseException:
+                shutil.rmtree(destination, ignore_errors=True)
+                raise
+            shutil.rmtree(source)
+    else:
+        raise ValueError(f"Unknown ingest mode: {mode}")
+    return destination
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hardlink, copy or move a directory into DATADIR")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--ln', dest='mode', action='store_const', const='ln')
+    group.add_argument('--cp', dest='mode', action='store_const', const='cp')
+    group.add_argument('--mv', dest='mode', action='store_const', const='mv')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="Files copied in parallel")
+    parser.add_argument('source', help="Directory to ingest")
+    parser.add_argument('data_dir', help="DATADIR")
+    args = parser.parse_args()
+
+    try:
+        ingest(args.source, args.data_dir, args.mode, args.workers)
+    except (OSError, IngestError) as e:
+        print(f"{bcolors.FAIL}ERROR: Ingest failed: {e}{bcolors.ENDC}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,44 +1,271 @@
+import atexit
+import json
+import os
+import threading
 import time
 from pathlib import Path
 
-def log_to_file(log_file_path, message):
-    """Append a log message to the specified log file.
+from utils.config_loader import ConfigLoader
+
+# Load configuration
+config = ConfigLoader().get_config()
+
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+# Events of an upload go to one JSON-lines file in its TMP_DIR/<pid>/ directory
+JOB_LOG_NAME = 'upload.jsonl'
+# Bytes buffered per file before they are written, and the longest a record waits in the buffer
+BUFFER_BYTES = 64 * 1024
+FLUSH_INTERVAL = 2
+
+_writers = {}
+_writers_lock = threading.Lock()
+_flusher = None
+
+
+# Lowest level written to job logs, and the longest string in a record, read from config.ini once
+JOB_LEVEL = LEVELS.get(config.get('LOG', 'JOB_LEVEL', fallback='info').strip().lower(), LEVELS['info'])
+MAX_FIELD_CHARS = config.getint('LOG', 'MAX_FIELD_CHARS', fallback=2000)
+
+
+def truncate(text, limit=MAX_FIELD_CHARS):
+    """Cut a long payload (a response body, an NFO) down to `limit` characters, saying how much was left out."""
+    if limit <= 0 or len(text) <= limit:
+        return text
+    return f"{text[:limit]}... [{len(text) - limit} more characters]"
+
+
+class RotatingWriter:
+    """Buffered appends to one log file, rotated to .1, .2, ... once it would grow past max_bytes.
+
+    Records are buffered whole and written with a single write() to a file opened with O_APPEND, so concurrent
+    uploads sharing a file (upload.log) never interleave within a line. A process that finds the file rotated by
+    another one reopens it.
+    """
+
+    def __init__(self, path, max_bytes, backups):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_bytes = 0
+        self.fd = None
+        self.opened = False
+
+    def open(self):
+        # Only create the directory once, a job directory removed by cleanup must stay removed
+        if not self.opened:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.opened = True
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def write(self, text, flush=False):
+        data = text.encode('utf-8', errors='replace')
+        with self.lock:
+            self.pending.append(data)
+            self.pending_bytes += len(data)
+            if flush or self.pending_bytes >= BUFFER_BYTES:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.pending:
+            return
+        data = b''.join(self.pending)
+        self.pending = []
+        self.pending_bytes = 0
+        try:
+            if self.fd is None or self._rotated_elsewhere():
+                self.close_fd()
+                if self.opened and not self.path.parent.is_dir():
+                    return
+                self.open()
+            size = os.fstat(self.fd).st_size
+            if self.max_bytes and size and size + len(data) > self.max_bytes:
+                self.rotate()
+            os.write(self.fd, data)
+        except OSError as e:
+            # Losing log lines must never fail an upload
+            print(f"Could not write {self.path}: {e}")
+
+    def _rotated_elsewhere(self):
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self.fd).st_ino
+        except FileNotFoundError:
+            return True
+
+    def rotate(self):
+        self.close_fd()
+        for number in range(self.backups - 1, 0, -1):
+            older = self.path.with_name(f'{self.path.name}.{number}')
+            if older.exists():
+                os.replace(older, self.path.with_name(f'{self.path.name}.{number + 1}'))
+        if self.backups:
+            os.replace(self.path, self.path.with_name(f'{self.path.name}.1'))
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def close_fd(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def get_writer(path):
+    """Get the shared writer of a log file, starting the background flusher on first use."""
+    global _flusher
+    writer = _writers.get(path)
+    if writer is not None:
+        return writer
+    path = Path(path)
+    with _writers_lock:
+        writer = _writers.get(path)
+        if writer is None:
+            writer = RotatingWriter(path, int(config.getfloat('LOG', 'MAX_MB', fallback=10) * 2 ** 20),
+                                    config.getint('LOG', 'BACKUPS', fallback=3))
+            _writers[path] = writer
+            _writers[str(path)] = writer
+        if _flusher is None:
+            _flusher = threading.Thread(target=flush_periodically, name='log-flusher', daemon=True)
+            _flusher.start()
+            atexit.register(flush_logs)
+        return writer
+
+
+def flush_logs():
+    """Write out everything buffered, e.g. before the process exits."""
+    with _writers_lock:
+        writers = set(_writers.values())
+    for writer in writers:
+        writer.flush()
+
+
+def close_logs(directory):
+    """Write out and close the logs in `directory`, before it is removed."""
+    directory = Path(directory)
+    with _writers_lock:
+        writers = {writer for writer in _writers.values() if directory in writer.path.parents}
+    for writer in writers:
+        with writer.lock:
+            writer._flush()
+            writer.close_fd()
+
+
+def flush_periodically():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        flush_logs()
+
+
+def job_log_path():
+    """The JSON-lines log of the upload running in this process."""
+    return str(Path(config.get('Paths', 'TMP_DIR')) / str(os.getpid()) / JOB_LOG_NAME)
+
+
+_job_log = job_log_path()
+
+
+def log_event(event, message=None, level='info', path=None, **fields):
+    """Append one JSON record to the upload's log.
+
+    Strings, and values that aren't plain JSON, are truncated to [LOG] MAX_FIELD_CHARS, so a whole NFO or response
+    body never ends up in the log. Errors are written right away, the rest within FLUSH_INTERVAL seconds.
+
     Args:
-        log_file_path (Path): Path to the log file (as a Path object).
-        message (str): Message to be logged
+        event (str): What happened, e.g. 'torrent_upload'. Records of one kind share it
+        message (str): Human readable description
+        level (str): One of LEVELS, records below [LOG] JOB_LEVEL are dropped
+        path (Path): Log file, defaults to job_log_path()
+        **fields: Structured details, e.g. status=200
+    """
+    if LEVELS[level] < JOB_LEVEL:
+        return
+    record = {'time': round(time.time(), 3), 'level': level, 'event': event}
+    if message is not None:
+        record['message'] = truncate(str(message))
+    for key, value in fields.items():
+        if not isinstance(value, (bool, int, float, type(None))):
+            value = truncate(value if isinstance(value, str) else str(value))
+        record[key] = value
+    get_writer(path or _job_log).write(json.dumps(record, ensure_ascii=False) + '\n',
+                                       flush=LEVELS[level] >= LEVELS['error'])
+
+
+def log_to_file(log_file_path, message):
+    """Log a message as an info event named after `log_file_path`, into the job log in the same directory.
+
+    Kept for scripts written against the old one-file-per-message logger, use log_event() instead.
     """
-    with open(log_file_path, 'a', encoding='utf-8') as log_file:
-        log_file.write(f"{message}\n")
+    log_file_path = Path(log_file_path)
+    log_event(log_file_path.stem, message, path=log_file_path.with_name(JOB_LOG_NAME))
+
 
 def log_upload_details(upload_details, log_file_path: Path, duplicate_found=False):
     """Log detailed upload information to the upload.log file.
-    
+
+    upload.log stays human readable, but is written in one go and rotated like the job logs.
+
     Args:
         upload_details (dict): Dictionary containing upload details.
         log_file_path (Path): Path to the log file (as a Path object).
         duplicate_found (bool): Flag indicating if a duplicate was found.
     """
-    with open(log_file_path, 'a', encoding='utf-8') as log_file:
-        log_file.write("\n########################################################\n")
-        log_file.write(f"### auto upload started at: {time.strftime('%a %b %d %H:%M:%S %Z %Y')}\n")
-        
-        if duplicate_found:
-            log_file.write(f"### Dupe: Torrent already uploaded.\n")
-            # Log reduced details for duplicate
-            log_file.write(f"### name: {upload_details.get('name', 'N/A')}\n")
-            log_file.write(f"### path: {upload_details.get('path', 'N/A')}\n")
-            log_file.write(f"### size: {upload_details.get('size', 'N/A')}\n")
-            log_file.write(f"### nfo: {upload_details.get('nfo', 'N/A')}\n")
-        else:
-            # Log all details for a full upload
-            log_file.write(f"### name: {upload_details.get('name', 'N/A')}\n")
-            log_file.write(f"### path: {upload_details.get('path', 'N/A')}\n")
-            log_file.write(f"### size: {upload_details.get('size', 'N/A')}\n")
-            log_file.write(f"### category: {upload_details.get('category', 'N/A')}\n")
-            log_file.write(f"### piece size: {upload_details.get('piece_size', 'N/A')}\n")
-            log_file.write(f"### etor started: {upload_details.get('etor_started', 'N/A')}\n")
-            log_file.write(f"### Create torrent file.. {upload_details.get('torrent_file', 'N/A')}\n")
-            log_file.write(f"### nfo: {upload_details.get('nfo', 'N/A')}\n")
-            log_file.write(f"### etor completed: {upload_details.get('etor_completed', 'N/A')}\n")        
-            log_file.write(f"### auto upload completed at: {time.strftime('%a %b %d %H:%M:%S %Z %Y')}\n")
-            log_file.write("\n")
+    lines = ["", "########################################################",
+             f"### auto upload started at: {time.strftime('%a %b %d %H:%M:%S %Z %Y')}"]
+
+    if duplicate_found:
+        lines.append("### Dupe: Torrent already uploaded.")
+        # Log reduced details for duplicate
+        lines.append(f"### name: {upload_details.get('name', 'N/A')}")
+        lines.append(f"### path: {upload_details.get('path', 'N/A')}")
+        lines.append(f"### size: {upload_details.get('size', 'N/A')}")
+        lines.append(f"### nfo: {upload_details.get('nfo', 'N/A')}")
+    else:
+        # Log all details for a full upload
+        lines.append(f"### name: {upload_details.get('name', 'N/A')}")
+        lines.append(f"### path: {upload_details.get('path', 'N/A')}")
+        lines.append(f"### size: {upload_details.get('size', 'N/A')}")
+        lines.append(f"### category: {upload_details.get('category', 'N/A')}")
+        lines.append(f"### piece size: {upload_details.get('piece_size', 'N/A')}")
+        lines.append(f"### etor started: {upload_details.get('etor_started', 'N/A')}")
+        lines.append(f"### Create torrent file.. {upload_details.get('torrent_file', 'N/A')}")
+        lines.append(f"### nfo: {upload_details.get('nfo', 'N/A')}")
+        lines.append(f"### etor completed: {upload_details.get('etor_completed', 'N/A')}")
+        lines.append(f"### auto upload completed at: {time.strftime('%a %b %d %H:%M:%S %Z %Y')}")
+        lines.append("")
+    get_writer(log_file_path).write('\n'.join(lines) + '\n', flush=True)
+
+
+def benchmark(messages=20000, nfo_bytes=64 * 1024):
+    """Compare logging `messages` lines and an NFO sized form the old way (open, write, close) and buffered."""
+    import tempfile
+    nfo = 'x' * nfo_bytes
+    with tempfile.TemporaryDirectory() as directory:
+        old_path = Path(directory) / 'old.log'
+        start = time.perf_counter()
+        for number in range(messages):
+            with open(old_path, 'a', encoding='utf-8') as log_file:
+                log_file.write(f"Attempting to upload image: {number}.png\n")
+        with open(old_path, 'a', encoding='utf-8') as log_file:
+            log_file.write(f"Data: {{'nfo': {nfo!r}}}\n")
+        old = time.perf_counter() - start
+
+        new_path = Path(directory) / JOB_LOG_NAME
+        start = time.perf_counter()
+        for number in range(messages):
+            log_event('image_upload', f"Attempting to upload image: {number}.png", path=new_path)
+        log_event('torrent_upload', 'Uploading', path=new_path, nfo=nfo)
+        flush_logs()
+        new = time.perf_counter() - start
+        nfo_record = len(new_path.read_text(encoding='utf-8').splitlines()[-1])
+        print(f"{messages} messages: {old:.2f}s and {messages + 1} opens opening the file each time, {new:.2f}s and "
+              f"{new_path.stat().st_size // BUFFER_BYTES + 1} writes buffered. A {nfo_bytes} byte NFO is logged as "
+              f"{nfo_record} bytes")
+
+
+if __name__ == '__main__':
+    benchmark()
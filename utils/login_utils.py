@@ -1,13 +1,13 @@
-import os
 import pickle
 import warnings
 from pathlib import Path
 
 import requests
 
+from utils import http_utils
 from utils.bcolors import bcolors
 from utils.config_loader import ConfigLoader
-from utils.logging_utils import log_to_file
+from utils.logging_utils import log_event
 
 # Suppress InsecureRequestWarning (not recommended for production)
 warnings.simplefilter('ignore', requests.packages.urllib3.exceptions.InsecureRequestWarning)
@@ -15,14 +15,8 @@ warnings.simplefilter('ignore', requests.packages.urllib3.exceptions.InsecureReq
 # Load the configuration
 config = ConfigLoader().get_config()
 
-# Create a unique process directory
-process_id = os.getpid()
-TMP_DIR = Path(config.get('Paths', 'TMP_DIR')) / str(process_id)
 COOKIE_PATH = Path(config.get('Paths', 'COOKIE_PATH'))
 
-# Ensure the TMP_DIR exists
-TMP_DIR.mkdir(parents=True, exist_ok=True)
-
 # Captcha Passkey and other credentials from config
 CAPTCHA_PASSKEY = config.get('Website', 'CAPTCHA_PASSKEY')
 SITEURL = config.get('Website', 'SITEURL')
@@ -47,7 +41,7 @@ def load_cookies(path):
 
 def login():
     """Perform login to the website and return cookies for subsequent requests."""
-    session = requests.Session()  # Use a session to persist cookies and headers
+    session = http_utils.get_session('site')  # Use the shared site session to persist cookies and headers
     user_agent = 'Mozilla/5.0'
     
     # Try to load existing cookies
@@ -59,14 +53,15 @@ def login():
     
     try:
         # Perform the login request
-        response = session.get(LOGINURL, headers={'User-Agent': user_agent}, verify=False)
+        response = session.get(LOGINURL, headers={'User-Agent': user_agent}, verify=False,
+                               timeout=http_utils.get_timeout('site'))
         
         # Save cookies to a file
         save_cookies(session.cookies, COOKIE_PATH)
         
-        # Log the request and response details
-        log_to_file(TMP_DIR / 'login_request.log', f"Login URL: {LOGINURL}\nHeaders: {{'User-Agent': user_agent}}")
-        log_to_file(TMP_DIR / 'login_response.log', f"Response Status: {response.status_code}\nResponse Text: {response.text}")
+        # Log the response, not the request: the login URL carries the password
+        log_event('login', "Login response", status=response.status_code, user_agent=user_agent)
+        log_event('login', "Login response body", 'debug', body=response.text)
         
         # Check if login was successful
         if response.status_code == 200 and LOGINTXT in response.text:
@@ -77,6 +72,6 @@ def login():
             return None
     except requests.RequestException as e:
         # Log any request exceptions
-        log_to_file(TMP_DIR / 'login_error.log', f"Login request failed: {str(e)}")
+        log_event('login', f"Login request failed: {str(e)}", 'error')
         print(f"{bcolors.FAIL}Login request failed: {str(e)}{bcolors.ENDC}")
         return None
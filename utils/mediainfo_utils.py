@@ -4,6 +4,7 @@ import subprocess
 from pathlib import Path
 
 from utils.bcolors import bcolors
+from utils.governor_utils import spawn_priority
 
 
 def generate_mediainfo(directory, tmp_dir):
@@ -35,7 +36,8 @@ def generate_mediainfo(directory, tmp_dir):
                 ['mediainfo', str(media_file)],
                 text=True,
                 capture_output=True,
-                check=True
+                check=True,
+                preexec_fn=spawn_priority()
             )
         except subprocess.CalledProcessError as e:
             # Handle errors in running mediainfo
@@ -5,16 +5,13 @@ from tempfile import NamedTemporaryFile
 
 from utils.bcolors import bcolors
 from utils.config_loader import ConfigLoader
-from utils.logging_utils import log_to_file
+from utils.logging_utils import log_event
 
 # Load configuration
 config = ConfigLoader().get_config()
 TMP_DIR = Path(config.get('Paths', 'TMP_DIR')) / str(os.getpid())
 TEMPLATE_PATH = Path(config.get('Paths', 'TEMPLATE_PATH'))
 
-# Ensure TMP_DIR exists
-TMP_DIR.mkdir(parents=True, exist_ok=True)
-
 def find_nfo_file(directory):
     """
     Find the first .nfo file in the specified directory.
@@ -71,14 +68,13 @@ def read_nfo_content(nfo_file: Path, tmp_dir: Path, from_encoding: str = 'cp437'
         if Path(temp_file_path).exists():
             Path(temp_file_path).unlink()
 
-def process_nfo(directory, replacements, log_file_path):
+def process_nfo(directory, replacements):
     """
     Find a .nfo file in the specified directory, read its content, and update the replacements dictionary.
 
     Args:
         directory (Path): The directory to search for .nfo files.
         replacements (dict): The dictionary to update with the .nfo content.
-        log_file_path (Path): The path to the log file for logging errors.
     """
     try:
         nfo_file = find_nfo_file(directory)
@@ -90,11 +86,11 @@ def process_nfo(directory, replacements, log_file_path):
             replacements['!nfo!'] = f"[nfo]\n{nfo_content}\n[/nfo]"
             
             print(f"{bcolors.YELLOW}Found NFO data...\n{bcolors.ENDC}")
-            log_to_file(log_file_path, f"NFO file processed successfully: {nfo_file.name}")
+            log_event('nfo', f"NFO file processed successfully: {nfo_file.name}", length=len(nfo_content))
         else:
             replacements['!nfo!'] = ''
-            log_to_file(log_file_path, "No .nfo file found in the directory.")
+            log_event('nfo', "No .nfo file found in the directory.", 'warning')
             print(f"{bcolors.RED}Did not find NFO data...\n{bcolors.ENDC}")
     except Exception as e:
-        log_to_file(log_file_path, f"Error processing .nfo file: {str(e)}")
+        log_event('nfo', f"Error processing .nfo file: {str(e)}", 'error')
         replacements['!nfo!'] = ''
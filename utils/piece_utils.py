@@ -0,0 +1,369 @@
+import bisect
+import math
+import os
+import sys
+from array import array
+from pathlib import Path
+
+from utils.config_loader import ConfigLoader
+
+# Load configuration
+config = ConfigLoader().get_config()
+
+# Piece sizes each hasher can produce, as powers of two
+HASHER_LIMITS = {
+    'torf': (14, 27),
+    'mkbrr': (16, 27),
+}
+
+# Defaults for the [Torrent] options, see config.ini
+PIECE_COUNT_MIN = 1024
+PIECE_COUNT_MAX = 8192
+PIECE_SIZE_MIN_KIB = 64
+PIECE_SIZE_MAX_KIB = 16384
+
+
+class FileList:
+    """A torrent's file list as parallel arrays, for releases with hundreds of thousands of files.
+
+    Every path component is stored once, bencoded, and a file's path is a run of component ids. Beyond its unique
+    path components a file costs about 30 bytes, instead of a tuple of strings plus a Path object. Iterating yields (parts, size, mtime) tuples like a
+    plain list of files would, built on the fly.
+    """
+
+    def __init__(self):
+        self.sizes = array('q')
+        self.mtimes = array('q')
+        self.components = []  # Unique path components, bencoded, e.g. b'8:file.rar'
+        self.component_ids = {}  # Bencoded component to its index in components
+        self.path_ids = array('I')  # Component ids of all paths, one after the other
+        self.path_ends = array('Q')  # End of each file's path in path_ids
+
+    def append(self, parts, size, mtime=0):
+        for part in parts:
+            encoded = part.encode('utf-8', 'surrogateescape')
+            component = b'%d:%s' % (len(encoded), encoded)
+            component_id = self.component_ids.get(component)
+            if component_id is None:
+                # The dict key and the list entry are the same bytes object
+                component_id = self.component_ids[component] = len(self.components)
+                self.components.append(component)
+            self.path_ids.append(component_id)
+        self.path_ends.append(len(self.path_ids))
+        self.sizes.append(size)
+        self.mtimes.append(mtime)
+
+    def path_range(self, index):
+        return self.path_ends[index - 1] if index else 0, self.path_ends[index]
+
+    def parts(self, index):
+        start, end = self.path_range(index)
+        return tuple(self.components[component_id].split(b':', 1)[1].decode('utf-8', 'surrogateescape')
+                     for component_id in self.path_ids[start:end])
+
+    def total_size(self):
+        return sum(self.sizes)
+
+    def without_empty(self):
+        """A copy without the empty files, which torrents leave out."""
+        if all(self.sizes):
+            return self
+        files = FileList()
+        for index in range(len(self)):
+            if self.sizes[index]:
+                files.append(self.parts(index), self.sizes[index], self.mtimes[index])
+        return files
+
+    def bencoded_entries(self):
+        """Yield each file's entry of the info dictionary's files list, bencoded."""
+        components = self.components
+        path_ids = self.path_ids
+        start = 0
+        for size, end in zip(self.sizes, self.path_ends):
+            yield b'd6:lengthi%de4:pathl%see' % (size, b''.join([components[i] for i in path_ids[start:end]]))
+            start = end
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        return self.parts(index), self.sizes[index], self.mtimes[index]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+def list_files(directory):
+    """List the files of a directory the way they end up in a torrent: sorted by path, symlinks followed.
+
+    Args:
+        directory (Path): Directory to list
+
+    Returns:
+        FileList: (relative path parts, size in bytes, mtime in whole seconds) per file
+    """
+    files = FileList()
+    if os.path.isfile(directory):
+        stat = os.stat(directory)
+        files.append((os.path.basename(directory),), stat.st_size, int(stat.st_mtime))
+        return files
+
+    # Sorting each directory's entries and walking depth first gives the same order as sorting the full paths
+    def walk(path, parts):
+        with os.scandir(path) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                if entry.is_dir():
+                    walk(entry.path, parts + (entry.name,))
+                elif entry.is_file():
+                    stat = entry.stat()
+                    files.append(parts + (entry.name,), stat.st_size, int(stat.st_mtime))
+
+    walk(directory, ())
+    return files
+
+
+def get_piece_size_limits():
+    """Get the smallest and largest allowed piece size exponents.
+
+    The result is the intersection of the tracker limits from config.ini and the limits of every hasher, so the
+    same content always gets the same piece size whichever hasher is configured.
+    """
+    min_kib = config.getint('Torrent', 'PIECE_SIZE_MIN_KIB', fallback=PIECE_SIZE_MIN_KIB)
+    max_kib = config.getint('Torrent', 'PIECE_SIZE_MAX_KIB', fallback=PIECE_SIZE_MAX_KIB)
+    min_exponent = max([math.ceil(math.log2(min_kib * 1024))] + [low for low, _ in HASHER_LIMITS.values()])
+    max_exponent = min([math.floor(math.log2(max_kib * 1024))] + [high for _, high in HASHER_LIMITS.values()])
+    if min_exponent > max_exponent:
+        raise ValueError(f"No piece size fits both PIECE_SIZE_MIN_KIB = {min_kib} and PIECE_SIZE_MAX_KIB = {max_kib} "
+                         f"and the hasher limits")
+    return min_exponent, max_exponent
+
+
+def choose_piece_exponent(total_size, min_pieces=None, max_pieces=None, min_exponent=None, max_exponent=None):
+    """Pick the piece size for a torrent of total_size bytes.
+
+    Picks the smallest power of two that keeps the piece count at or below max_pieces, within the allowed piece
+    sizes. As long as min_pieces is at most half of max_pieces, that also keeps the count at or above min_pieces,
+    unless the torrent is too small or too big for the allowed piece sizes.
+
+    Args:
+        total_size (int): Total size of the files in bytes
+        min_pieces (int): Lower end of the target piece count, defaults to PIECE_COUNT_MIN in config.ini
+        max_pieces (int): Upper end of the target piece count, defaults to PIECE_COUNT_MAX in config.ini
+        min_exponent (int): Smallest allowed piece size as a power of two, defaults to get_piece_size_limits()
+        max_exponent (int): Largest allowed piece size as a power of two, defaults to get_piece_size_limits()
+
+    Returns:
+        int: The piece size as a power of two, e.g. 20 for 1 MiB pieces
+    """
+    if min_pieces is None:
+        min_pieces = config.getint('Torrent', 'PIECE_COUNT_MIN', fallback=PIECE_COUNT_MIN)
+    if max_pieces is None:
+        max_pieces = config.getint('Torrent', 'PIECE_COUNT_MAX', fallback=PIECE_COUNT_MAX)
+    if min_exponent is None or max_exponent is None:
+        limit_min, limit_max = get_piece_size_limits()
+        min_exponent = limit_min if min_exponent is None else min_exponent
+        max_exponent = limit_max if max_exponent is None else max_exponent
+    if min_pieces > max_pieces:
+        raise ValueError(f"PIECE_COUNT_MIN ({min_pieces}) is larger than PIECE_COUNT_MAX ({max_pieces})")
+
+    # Pieces needed for total_size never exceed max_pieces when 2^exponent >= total_size / max_pieces
+    exponent = math.ceil(math.log2(max(total_size / max_pieces, 1)))
+    return min(max(exponent, min_exponent), max_exponent)
+
+
+def piece_count(total_size, exponent):
+    """Number of pieces of a torrent with total_size bytes and 2^exponent byte pieces."""
+    return max(1, -(-total_size // (1 << exponent)))
+
+
+def file_offsets(sizes):
+    """Offset of every file in the torrent's concatenated data, given the file sizes in torrent order."""
+    offsets = []
+    offset = 0
+    for size in sizes:
+        offsets.append(offset)
+        offset += size
+    return offsets
+
+
+def piece_spans(offsets, sizes, index, piece_length):
+    """Work out which parts of which files make up a piece.
+
+    Args:
+        offsets (list): file_offsets() of the torrent
+        sizes (list): File sizes in torrent order
+        index (int): Piece index
+        piece_length (int): Piece length in bytes
+
+    Returns:
+        list: (file index, offset in that file, length) per file the piece touches, in order
+    """
+    total_size = offsets[-1] + sizes[-1] if sizes else 0
+    start = index * piece_length
+    end = min(start + piece_length, total_size)
+    spans = []
+    # Last file starting at or before the piece, skipping back over empty files that share its offset
+    file_index = max(bisect.bisect_right(offsets, start) - 1, 0)
+    while start < end:
+        file_end = offsets[file_index] + sizes[file_index]
+        if file_end > start:
+            length = min(end, file_end) - start
+            spans.append((file_index, start - offsets[file_index], length))
+            start += length
+        file_index += 1
+    return spans
+
+
+def edge_pieces(offsets, sizes, piece_length):
+    """First and last piece of every non-empty file, where truncated or misaligned files show up first."""
+    pieces = set()
+    for offset, size in zip(offsets, sizes):
+        if size:
+            pieces.add(offset // piece_length)
+            pieces.add((offset + size - 1) // piece_length)
+    return pieces
+
+
+# (total size, min pieces, max pieces, min exponent, max exponent, expected exponent)
+CASES = [
+    (0, 1024, 8192, 16, 27, 16),                    # Empty torrent, smallest allowed
+    (10 * 2 ** 20, 1024, 8192, 16, 27, 16),         # 10 MiB is below the target range even at 64 KiB
+    (512 * 2 ** 20, 1024, 8192, 16, 27, 16),        # 512 MiB at 64 KiB is exactly 8192 pieces
+    (512 * 2 ** 20 + 1, 1024, 8192, 16, 27, 17),    # One byte more needs the next size up
+    (4 * 2 ** 30, 1024, 8192, 16, 27, 19),          # 4 GiB -> 512 KiB, 8192 pieces
+    (45 * 2 ** 30, 1024, 8192, 16, 27, 23),         # 45 GiB -> 8 MiB, 5760 pieces
+    (2 * 2 ** 40, 1024, 8192, 16, 24, 24),          # 2 TiB is capped by a 16 MiB tracker maximum
+    (2 * 2 ** 40, 1024, 8192, 16, 27, 27),          # ... and by mkbrr's 128 MiB otherwise
+    (4 * 2 ** 30, 1000, 2000, 16, 27, 22),          # A narrower range means bigger pieces
+]
+
+
+def self_check():
+    """Run the table of known inputs through choose_piece_exponent() and report mismatches."""
+    failures = 0
+    for total_size, min_pieces, max_pieces, min_exponent, max_exponent, expected in CASES:
+        exponent = choose_piece_exponent(total_size, min_pieces, max_pieces, min_exponent, max_exponent)
+        if exponent != expected:
+            failures += 1
+            print(f"FAIL: {total_size} bytes, {min_pieces}-{max_pieces} pieces, 2^{min_exponent}-2^{max_exponent}: "
+                  f"got 2^{exponent}, expected 2^{expected}")
+    print(f"{len(CASES) - failures}/{len(CASES)} piece size cases passed")
+    return failures == 0
+
+
+def benchmark(sample_mib=256):
+    """Print the .torrent pieces size and the SHA1 hashing throughput of every piece size for common total sizes."""
+    import hashlib
+    import time
+
+    data = os.urandom(sample_mib * 2 ** 20)
+    view = memoryview(data)
+    throughput = {}
+    for exponent in range(14, 28):
+        piece = 1 << exponent
+        start = time.perf_counter()
+        for offset in range(0, len(data), piece):
+            hashlib.sha1(view[offset:offset + piece]).digest()
+        throughput[exponent] = len(data) / (time.perf_counter() - start) / 2 ** 20
+
+    print(f"{'piece size':>10} {'SHA1 MiB/s':>11}")
+    for exponent, speed in throughput.items():
+        print(f"{(1 << exponent) // 1024:>7} KiB {speed:>11.0f}")
+    print()
+    print(f"{'total':>8} {'piece size':>10} {'pieces':>8} {'pieces field':>12}")
+    for total_size in (2 ** 30, 8 * 2 ** 30, 50 * 2 ** 30, 200 * 2 ** 30, 2 ** 40):
+        exponent = choose_piece_exponent(total_size)
+        pieces = piece_count(total_size, exponent)
+        print(f"{total_size / 2 ** 30:>6.0f} G {(1 << exponent) // 1024:>6} KiB {pieces:>8} "
+              f"{pieces * 20 / 1024:>8.0f} KiB")
+
+
+def synthetic_files(count):
+    """Yield (parts, size, mtime) for a release of `count` files, shaped like a music collection."""
+    for index in range(count):
+        yield (f"Artist {index // 2000:03d}", f"Album {index // 20:05d}", f"{index % 20 + 1:02d} - Track {index}.flac"), \
+            30 * 2 ** 20 + index, 1700000000
+
+
+def stream_child(count, mode):
+    """Build and write a torrent of `count` synthetic files, print peak RSS in KiB and seconds as JSON."""
+    import hashlib
+    import json
+    import resource
+    import time
+
+    from utils import bencode_utils
+
+    start = time.perf_counter()
+    pieces = bytes(20 * 10000)  # Same for every count, only the file list grows
+    listed_kib = None
+    with open(os.devnull, 'wb') as output:
+        if mode == 'stream':
+            files = FileList()
+            for parts, size, mtime in synthetic_files(count):
+                files.append(parts, size, mtime)
+            listed_kib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            bencode_utils.write_torrent(output, {b'announce': 'https://tracker.example/announce'},
+                                        {b'name': 'Release', b'piece length': 2 ** 24, b'pieces': pieces,
+                                         b'private': 1}, files.bencoded_entries())
+        else:
+            # What a torrent library does: Path objects for every file, then one dict encoded in memory
+            paths = [(Path(*parts), size) for parts, size, _ in synthetic_files(count)]
+            metainfo = {b'announce': 'https://tracker.example/announce',
+                        b'info': {b'name': 'Release', b'piece length': 2 ** 24, b'pieces': pieces, b'private': 1,
+                                  b'files': [{b'length': size, b'path': list(path.parts)} for path, size in paths]}}
+            output.write(bencode_utils.encode(metainfo))
+            hashlib.sha1(bencode_utils.encode(metainfo[b'info'])).hexdigest()
+    print(json.dumps({'rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 'listed_kib': listed_kib,
+                      'seconds': time.perf_counter() - start}))
+
+
+def stream_benchmark(counts=(10000, 100000, 500000)):
+    """Peak RSS of writing a torrent with a growing file count, each run in a fresh interpreter.
+
+    'write' is what streaming the torrent adds on top of the FileList, which is what should stay flat.
+    """
+    import json
+    import subprocess
+
+    def run(count, mode):
+        output = subprocess.run([sys.executable, '-m', 'utils.piece_utils', 'stream-child', str(count), mode],
+                                capture_output=True, text=True, check=True).stdout
+        return json.loads(output.strip().splitlines()[-1])
+
+    baseline = run(0, 'stream')['rss_kib']
+    print(f"Interpreter baseline: {baseline / 1024:.1f} MiB RSS")
+    print(f"{'files':>8} {'mode':>8} {'peak RSS MiB':>13} {'above baseline':>15} {'write MiB':>10} {'seconds':>8}")
+    for count in counts:
+        for mode in ('stream', 'dict'):
+            result = run(count, mode)
+            write = f"{(result['rss_kib'] - result['listed_kib']) / 1024:.1f}" if result['listed_kib'] else '-'
+            print(f"{count:>8} {mode:>8} {result['rss_kib'] / 1024:>13.1f} "
+                  f"{(result['rss_kib'] - baseline) / 1024:>15.1f} {write:>10} {result['seconds']:>8.2f}")
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else 'check'
+    if command == 'check':
+        sys.exit(0 if self_check() else 1)
+    elif command == 'benchmark':
+        benchmark()
+    elif command == 'stream-benchmark':
+        stream_benchmark()
+    elif command == 'stream-child':
+        stream_child(int(sys.argv[2]), sys.argv[3])
+    elif command == 'size' and len(sys.argv) > 2:
+        files = list_files(Path(sys.argv[2]))
+        total_size = sum(size for _, size, _ in files)
+        exponent = choose_piece_exponent(total_size)
+        print(f"{len(files)} files, {total_size} bytes: {(1 << exponent) // 1024} KiB pieces, "
+              f"{piece_count(total_size, exponent)} pieces")
+    else:
+        print("Usage: python -m utils.piece_utils check|benchmark|stream-benchmark|size <directory>")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+import cProfile
+import io
+import pstats
+import re
+from datetime import datetime
+from pathlib import Path
+
+from utils.bcolors import bcolors
+
+PROFILE_DIR = Path('data/profiles')
+
+
+def start_profiler():
+    """Create and enable a cProfile profiler for the current thread."""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def save_profile(profiler, name, top=15):
+    """Stop the profiler and save its stats to data/profiles/.
+
+    Args:
+        profiler (cProfile.Profile): Profiler returned by start_profiler()
+        name (str): Name of the upload, used in the filename
+        top (int): Number of functions by cumulative time to print as a quick summary
+
+    Returns:
+        str: Filename of the .pstats file inside PROFILE_DIR
+    """
+    profiler.disable()
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+
+    # Keep the filename safe to serve from the web UI
+    safe_name = re.sub(r'[^A-Za-z0-9._-]+', '_', name)[:100]
+    filename = f"{safe_name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.pstats"
+    profiler.dump_stats(PROFILE_DIR / filename)
+
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(top)
+    print(f"{bcolors.OKBLUE}Profile saved to {PROFILE_DIR / filename}. Top {top} by cumulative time:{bcolors.ENDC}")
+    print(stream.getvalue())
+    return filename
@@ -0,0 +1,76 @@
+import os
+import sqlite3
+import time
+
+from utils.database_utils import save_progress
+
+# Seconds between progress rows written to the database, and between progress lines printed to the terminal
+# (every printed line also ends up in terminal_logs)
+DB_INTERVAL = 0.25
+PRINT_INTERVAL = 5
+
+
+def job_id(directory_name):
+    """Get the id of this process's upload job, as used for terminal_logs sources and upload_progress rows."""
+    return f"{os.getpid()}:{directory_name}"
+
+
+class ProgressReporter:
+    """Report the progress of a long running stage, e.g. hashing, without flooding the terminal or the database.
+
+    Progress goes to one upload_progress row per job, overwritten at most every DB_INTERVAL seconds, which the web UI
+    reads directly. The terminal only gets a progress line every PRINT_INTERVAL seconds.
+    """
+
+    def __init__(self, job, stage, total=None, unit_bytes=None):
+        """
+        Args:
+            job (str): Job id, see job_id()
+            stage (str): Name of the stage shown in the UI
+            total (int): Number of units of work, can also be passed later to update()
+            unit_bytes (int): Bytes per unit of work, e.g. the piece size, used to calculate the speed
+        """
+        self.job = job
+        self.stage = stage
+        self.total = total
+        self.unit_bytes = unit_bytes
+        self.started = time.monotonic()
+        self.last_saved = 0
+        self.last_printed = self.started
+
+    def update(self, done, total=None):
+        """Record that `done` units are finished. Cheap enough to call for every piece."""
+        if total is not None:
+            self.total = total
+        now = time.monotonic()
+        finished = self.total is not None and done >= self.total
+        if now - self.last_saved < DB_INTERVAL and not finished:
+            return
+
+        self.last_saved = now
+        elapsed = now - self.started
+        bytes_per_second = None
+        eta_seconds = None
+        if done > 0 and elapsed > 0:
+            if self.unit_bytes:
+                bytes_per_second = done * self.unit_bytes / elapsed
+            if self.total:
+                eta_seconds = max(0.0, elapsed / (done / self.total) - elapsed)
+
+        try:
+            save_progress(self.job, self.stage, done, self.total, bytes_per_second, eta_seconds)
+        except sqlite3.Error:
+            pass  # Progress is best effort, never fail a stage over it
+
+        if now - self.last_printed >= PRINT_INTERVAL or finished:
+            self.last_printed = now
+            self.print_progress(done, bytes_per_second, eta_seconds)
+
+    def print_progress(self, done, bytes_per_second, eta_seconds):
+        """Print one progress line to the terminal."""
+        import cli_ui
+
+        speed = f"{bytes_per_second / (1024 * 1024):.2f} MiB/s" if bytes_per_second else "-- MiB/s"
+        eta = time.strftime("%M:%S", time.gmtime(eta_seconds)) if eta_seconds is not None else "--:--"
+        total = self.total or 100
+        cli_ui.info_progress(f"{self.stage}... {speed} | ETA: {eta}", min(done, total), total)
@@ -1,47 +1,32 @@
-import sqlite3
 import time
 
 import psutil
 
-DB_PATH = 'data/upload_queue.db'
+from utils.database_utils import get_connection
 
 def init_db():
     """Initialize the SQLite database to store the queue."""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS upload_queue (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            pid INTEGER,
-            directory_name TEXT,
-            status TEXT,  -- queued, running, completed, failed
-            timestamp TEXT
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    get_connection()
 
 def add_to_queue(pid, directory_name):
     """Add a task (process) to the upload queue."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     c = conn.cursor()
     c.execute('''
         INSERT INTO upload_queue (pid, directory_name, status, timestamp)
         VALUES (?, ?, 'running', ?)
     ''', (pid, directory_name, time.strftime('%Y-%m-%d %H:%M:%S')))
     conn.commit()
-    conn.close()
     
     # Debug: Print added tasks
     print(f"Task for directory '{directory_name}' (PID {pid}) added to queue as running.")
 
 def get_running_tasks():
     """Get tasks that are in the 'running' state."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     c = conn.cursor()
     c.execute("SELECT pid, directory_name FROM upload_queue WHERE status = 'running'")
     tasks = c.fetchall()
-    conn.close()
     
     # Debug: Print running tasks
     if tasks:
@@ -53,12 +38,11 @@ def get_running_tasks():
 
 def update_task_status(pid, status):
     """Update the status of a task in the queue."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     c = conn.cursor()
     c.execute("UPDATE upload_queue SET status = ?, timestamp = ? WHERE pid = ?",
               (status, time.strftime('%Y-%m-%d %H:%M:%S'), pid))
     conn.commit()
-    conn.close()
 
     # Debug: Print task status update
     print(f"Task for PID {pid} status updated to '{status}'.")
@@ -84,11 +68,10 @@ def detect_running_processes():
 
 def task_in_queue(pid):
     """Check if a task with a given PID is already in the queue."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     c = conn.cursor()
     c.execute("SELECT COUNT(*) FROM upload_queue WHERE pid = ?", (pid,))
     count = c.fetchone()[0]
-    conn.close()
     
     return count > 0
 
@@ -2,8 +2,10 @@ import os
 import subprocess
 from pathlib import Path
 
+from utils.accounting_utils import record_detached
 from utils.bcolors import bcolors
 from utils.config_loader import ConfigLoader
+from utils.governor_utils import spawn_priority
 
 # Load configuration settings
 config = ConfigLoader().get_config()
@@ -46,10 +48,13 @@ def generate_screenshots(directory, category_id):
                 mount_point.mkdir(parents=True, exist_ok=True)
                 try:
                     # Mount RAR file using rar2fs
-                    subprocess.run(['rar2fs', '-o', 'allow_other', '--seek-length=1', str(rar_file), str(mount_point)], check=True)
+                    subprocess.run(['rar2fs', '-o', 'allow_other', '--seek-length=1', str(rar_file), str(mount_point)], check=True,
+                                   preexec_fn=spawn_priority())
                     # Process movie files
                     process_media_files(mount_point, command_opts, screenshots_dir)
                 finally:
+                    # rar2fs runs as a daemon we never wait for, so count what it used before it exits
+                    record_detached(str(mount_point))
                     # Clean up mount point
                     subprocess.run(['fusermount', '-u', str(mount_point)], check=True)
                     mount_point.rmdir()
@@ -129,7 +134,7 @@ def mtn_exec(command_opts, media_file, mtn_path, screenshots_dir):
     command = mtn_path + command_opts.split() + [str(media_file), '-o', '.jpg', '-O', str(screenshots_dir)]
     print(f"Running command: {' '.join(command)}")
     try:
-        result = subprocess.run(command, capture_output=True, text=True)
+        result = subprocess.run(command, capture_output=True, text=True, preexec_fn=spawn_priority())
     except subprocess.CalledProcessError as e:
         print(f"{bcolors.FAIL}Error creating screenshots for {media_file}: {e}{bcolors.ENDC}")  # Red text for errors
     except Exception as e:
@@ -0,0 +1,184 @@
+import hashlib
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+from utils import bencode_utils
+from utils.config_loader import ConfigLoader
+from utils.database_utils import fetch_source_torrent_stats, find_source_torrent, save_source_torrents
+from utils.piece_utils import list_files
+
+# Load configuration
+config = ConfigLoader().get_config()
+
+# Seconds between refreshes of the background indexer in app.py
+REFRESH_INTERVAL = 300
+# Parsed torrents written per transaction, so a first index of a huge folder shows progress and doesn't hold the lock
+BATCH_SIZE = 500
+
+
+def get_source_folder():
+    """Get SOURCEFOLDER, None if it isn't configured."""
+    folder = config.get('Torrent', 'SOURCEFOLDER', fallback='').strip().rstrip('/')
+    return folder or None
+
+
+def files_hash(files):
+    """Hash a file list so two torrents of the same content get the same hash, whatever their file order.
+
+    Args:
+        files (iterable): ('/' separated path relative to the torrent's root, size in bytes) per file
+
+    Returns:
+        str: SHA1 as hex
+    """
+    digest = hashlib.sha1()
+    for path, size in sorted(files):
+        digest.update(f"{path}\0{size}\n".encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest()
+
+
+def parse_source_torrent(data):
+    """Read what the index needs from a .torrent, without decoding its pieces.
+
+    Returns:
+        tuple: (name, total size, files hash, piece length)
+
+    Raises:
+        bencode_utils.BencodeError: If the torrent is malformed
+    """
+    spans, _ = bencode_utils.dict_spans(data)
+    if b'info' not in spans:
+        raise bencode_utils.BencodeError("Torrent has no info dictionary")
+    info_spans, _ = bencode_utils.dict_spans(data, spans[b'info'][0])
+
+    def value(key):
+        if key not in info_spans:
+            raise bencode_utils.BencodeError(f"Info dictionary has no {key.decode()}")
+        start, end = info_spans[key]
+        return bencode_utils.decode(data[start:end])
+
+    try:
+        name = value(b'name').decode()
+        if b'files' in info_spans:
+            files = [('/'.join(part.decode() for part in entry[b'path']), entry[b'length'])
+                     for entry in value(b'files')]
+        else:
+            files = [(name, value(b'length'))]
+        piece_length = value(b'piece length')
+    except (AttributeError, KeyError, TypeError, UnicodeDecodeError) as e:
+        raise bencode_utils.BencodeError(f"Unexpected info dictionary: {e}") from e
+    return name, sum(size for _, size in files), files_hash(files), piece_length
+
+
+def refresh_index(folder=None):
+    """Bring the source torrent index up to date with SOURCEFOLDER.
+
+    Only .torrent files that are new or whose mtime or size changed are parsed, so a refresh of an unchanged folder
+    costs one directory listing.
+
+    Args:
+        folder (str): Folder to index, defaults to SOURCEFOLDER
+
+    Returns:
+        tuple: (torrents parsed, torrents removed from the index)
+    """
+    folder = (folder or get_source_folder() or '').rstrip('/')
+    if not folder or not os.path.isdir(folder):
+        return 0, 0
+
+    indexed = fetch_source_torrent_stats()
+    seen = set()
+    rows = []
+    parsed = 0
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.torrent') or not entry.is_file():
+                continue
+            stat = entry.stat()
+            seen.add(entry.path)
+            if indexed.get(entry.path) == (stat.st_mtime_ns, stat.st_size):
+                continue
+
+            try:
+                with open(entry.path, 'rb') as f:
+                    name, total_size, content_hash, piece_length = parse_source_torrent(f.read())
+            except (OSError, bencode_utils.BencodeError):
+                # Keep the row anyway so a broken file is only tried again once it changes
+                name = total_size = content_hash = piece_length = None
+            rows.append((entry.path, stat.st_mtime_ns, stat.st_size, name, total_size, content_hash, piece_length))
+            parsed += 1
+            if len(rows) >= BATCH_SIZE:
+                save_source_torrents(rows)
+                rows = []
+
+    # Rows of other folders are left alone, in case SOURCEFOLDER was changed back and forth
+    removed = [path for path in indexed if path not in seen and os.path.dirname(path) == folder]
+    save_source_torrents(rows, removed)
+    return parsed, len(removed)
+
+
+def find_reusable_torrent(directory, files=None):
+    """Find a torrent in SOURCEFOLDER with exactly the content of directory, under any filename.
+
+    The torrent's name has to match the directory name as well, since that is where clients look for the data.
+
+    Args:
+        directory (Path): Directory to find a torrent for
+        files (FileList): list_files() of the directory, if it has been listed already
+
+    Returns:
+        Path: The matching .torrent, None if there is none
+    """
+    directory = Path(directory)
+    if files is None:
+        files = list_files(directory)
+    # Hashers leave empty files out of torrents, and the index only hashes the files a torrent lists
+    content_hash = files_hash(('/'.join(parts), size) for parts, size, _ in files.without_empty())
+
+    path = find_source_torrent(directory.name, content_hash)
+    if path is None:
+        # The background indexer may not have seen a torrent added in the last few minutes
+        refresh_index()
+        path = find_source_torrent(directory.name, content_hash)
+    return Path(path) if path and os.path.isfile(path) else None
+
+
+def index_source_folder():
+    """Keep the index up to date, every REFRESH_INTERVAL seconds."""
+    import logging
+
+    while True:
+        try:
+            start = time.monotonic()
+            parsed, removed = refresh_index()
+            if parsed or removed:
+                logging.info(f"Source torrent index: {parsed} parsed, {removed} removed "
+                             f"in {time.monotonic() - start:.1f}s")
+        except Exception as e:
+            logging.error(f"Source torrent index refresh failed: {e}")
+        time.sleep(REFRESH_INTERVAL)
+
+
+def start_indexer():
+    """Start the background indexer if SOURCEFOLDER is configured."""
+    if get_source_folder():
+        threading.Thread(target=index_source_folder, daemon=True).start()
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else 'refresh'
+    if command == 'refresh':
+        start = time.perf_counter()
+        parsed, removed = refresh_index(sys.argv[2] if len(sys.argv) > 2 else None)
+        print(f"{parsed} torrents parsed, {removed} removed in {time.perf_counter() - start:.2f}s")
+    elif command == 'find' and len(sys.argv) > 2:
+        print(find_reusable_torrent(Path(sys.argv[2])) or "No matching torrent")
+    else:
+        print("Usage: python -m utils.source_index_utils refresh [folder] | find <directory>")
+
+
+if __name__ == '__main__':
+    main()
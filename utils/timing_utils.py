@@ -0,0 +1,116 @@
+import json
+import time
+from contextlib import contextmanager
+
+
+class StageTimer:
+    """Collect wall-clock spans for each stage of an upload."""
+
+    def __init__(self):
+        self.spans = []
+        # Called with the name of each stage as it starts, e.g. to show the stage on the dashboard
+        self.on_stage = None
+
+    @contextmanager
+    def stage(self, name, bytes_processed=None):
+        """Time the enclosed block as one stage.
+
+        Args:
+            name (str): Name of the stage, e.g. 'login' or 'hashing'
+            bytes_processed (int): Bytes the stage worked through, used to report throughput. Can also be set
+                afterwards through the yielded span, e.g. span['bytes'] = total_size
+        """
+        span = {'stage': name, 'started': time.time(), 'duration': None, 'bytes': bytes_processed}
+        if self.on_stage:
+            self.on_stage(name)
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span['duration'] = time.perf_counter() - start
+            self.spans.append(span)
+
+    def summary(self):
+        """Get a printable one line per stage summary of the recorded spans."""
+        lines = []
+        for span in self.spans:
+            line = f"{span['stage']}: {span['duration']:.2f}s"
+            if span['bytes'] and span['duration']:
+                line += f" ({span['bytes'] / span['duration'] / (1024 * 1024):.2f} MiB/s)"
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+# Modules that only some stages need. Importing any of them before the first stage means startup got slower again.
+LAZY_MODULES = ('torf', 'guessit', 'rfr', 'cli_ui', 'psutil')
+
+# Run in a fresh interpreter: everything backend.py does before its first stage, minus the upload itself
+STARTUP_SCRIPT = '''
+import json, sys
+import backend
+backend.version_check("0")
+with open("startup.json", "w") as result_file:
+    json.dump([name for name in %r if name in sys.modules], result_file)
+''' % (LAZY_MODULES,)
+
+
+def benchmark_startup(runs=5, budget=2.0):
+    """Measure the time from interpreter start to the point backend.py is ready for its first stage.
+
+    Each run starts a new interpreter in an empty working directory, so the version check cache is cold and the
+    real terminal log database is left alone.
+
+    Args:
+        runs (int): Number of interpreter starts to measure
+        budget (float): Maximum allowed median startup time in seconds
+
+    Returns:
+        bool: True if the median is within budget and no lazily loaded module was imported at startup
+    """
+    import os
+    import statistics
+    import subprocess
+    import sys
+    import tempfile
+    from pathlib import Path
+
+    root_dir = Path(__file__).resolve().parent.parent
+    env = dict(os.environ, PYTHONPATH=str(root_dir))
+    durations = []
+    eager_modules = []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as work_dir:
+            start = time.perf_counter()
+            result = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], cwd=work_dir, env=env,
+                                    capture_output=True, text=True)
+            durations.append(time.perf_counter() - start)
+            if result.returncode != 0:
+                print(result.stderr)
+                return False
+            eager_modules = json.loads((Path(work_dir) / 'startup.json').read_text())
+
+    median = statistics.median(durations)
+    print(f"Startup to first stage: median {median:.3f}s, min {min(durations):.3f}s, max {max(durations):.3f}s "
+          f"over {runs} runs (budget {budget:.3f}s)")
+    if eager_modules:
+        print(f"Imported at startup but should be lazy: {', '.join(eager_modules)}")
+    return median <= budget and not eager_modules
+
+
+def main():
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Timing benchmarks for dc_uploader")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    startup = subparsers.add_parser('startup', help="Check that backend.py reaches its first stage within budget")
+    startup.add_argument('--runs', type=int, default=5)
+    startup.add_argument('--budget', type=float, default=2.0, help="Maximum median startup time in seconds")
+    args = parser.parse_args()
+
+    if args.command == 'startup':
+        sys.exit(0 if benchmark_startup(args.runs, args.budget) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,30 @@
 import configparser
 import os
 import platform
+import random
 import re
-import shlex
 import shutil
+import signal
 import subprocess
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
-import cli_ui
 import requests
-from torf import Torrent, ReadError, BdecodeError, MetainfoError, VerifyIsDirectoryError, VerifyFileSizeError, \
-    WriteError
 
+from utils import bencode_utils, http_utils
 from utils.bcolors import bcolors
+from utils.concurrency_utils import preemption_point
 from utils.config_loader import ConfigLoader
-from utils.fastresume_utils import add_fastresume
-from utils.logging_utils import log_to_file
+from utils.fastresume_utils import add_fastresume, manifest_path, write_manifest
+from utils.governor_utils import spawn_priority
+from utils.hash_utils import HashCheckpoint, HashError, hash_pieces, use_native_hasher
+from utils.logging_utils import log_event
+from utils.piece_utils import choose_piece_exponent, list_files
+from utils.progress_utils import DB_INTERVAL, ProgressReporter, job_id
+from utils.source_index_utils import find_reusable_torrent
+from utils.verify_utils import verify_torrent
 
 # Load configuration
 config = ConfigLoader().get_config()
@@ -25,46 +33,54 @@ TMP_DIR = os.path.join(config.get('Paths', 'TMP_DIR'), str(os.getpid()))
 WATCHFOLDER = config.get('Paths', 'WATCHFOLDER')
 PREPENDNAME = config.get('Settings', 'PREPENDNAME')
 
-# Ensure TMP_DIR exists
-os.makedirs(TMP_DIR, exist_ok=True)
-torf_start_time = time.time()
+# What EDIT_TORRENT carries over from a reused torrent, everything else is dropped
+EDIT_KEYS = (b'announce', b'comment', b'creation date', b'created by', b'encoding', b'info')
+EDIT_INFO_KEYS = (b'name', b'piece length', b'pieces', b'private', b'source', b'files', b'length')
+
+# mkbrr's progress line, e.g. "Hashing pieces... [1234.56 MiB/s] 60%"
+MKBRR_PROGRESS_RE = re.compile(r"Hashing pieces.*?\[\d+(?:\.\d+)? [GM](?:B|iB)/s]\s+(\d+)%")
 
 def get_root_dir():
     """Use config.ini to get the root directory."""
     return os.path.dirname(os.path.abspath('config.ini'))
 
-def torf_cb(torrent, filepath, pieces_done, pieces_total):
-    global torf_start_time
-
-    if pieces_done == 0:
-        torf_start_time = time.time()  # Reset start time when hashing starts
+def torf_cb(reporter, torrent, filepath, pieces_done, pieces_total):
+    """torf generate() callback, bind the ProgressReporter with functools.partial."""
+    reporter.update(pieces_done, pieces_total)
+    # Blocking here pauses torf, its readers stop once their queues are full
+    preemption_point(reporter.job)
 
-    elapsed_time = time.time() - torf_start_time
-
-    # Calculate percentage done
-    if pieces_total > 0:
-        percentage_done = (pieces_done / pieces_total) * 100
-    else:
-        percentage_done = 0
+def check_reused_info(info):
+    """Sanity check the info dictionary of a torrent reused by EDIT_TORRENT, without decoding the file list.
 
-    # Estimate ETA (if at least one piece is done)
-    if pieces_done > 0:
-        estimated_total_time = elapsed_time / (pieces_done / pieces_total)
-        eta_seconds = max(0, estimated_total_time - elapsed_time)
-        eta = time.strftime("%M:%S", time.gmtime(eta_seconds))
-    else:
-        eta = "--:--"
+    Args:
+        info (dict): Info key to encoded value, as returned by bencode_utils.edit_torrent()
 
-    # Calculate hashing speed (MB/s)
-    if elapsed_time > 0 and pieces_done > 0:
-        piece_size = torrent.piece_size / (1024 * 1024)
-        speed = (pieces_done * piece_size) / elapsed_time
-        speed_str = f"{speed:.2f} MB/s"
-    else:
-        speed_str = "-- MB/s"
+    Returns:
+        int: The piece length in bytes
 
-    # Display progress with percentage, speed, and ETA
-    cli_ui.info_progress(f"Torf hashing... {speed_str} | ETA: {eta}", int(percentage_done), 100)
+    Raises:
+        bencode_utils.BencodeError: If the torrent can't be reused
+    """
+    for key in (b'name', b'piece length', b'pieces'):
+        if key not in info:
+            raise bencode_utils.BencodeError(f"Info dictionary has no {key.decode()}")
+    if b'files' not in info and b'length' not in info:
+        raise bencode_utils.BencodeError("Info dictionary has neither files nor length")
+    if not isinstance(bencode_utils.decode(bytes(info[b'name'])), bytes):
+        raise bencode_utils.BencodeError("Name is not a string")
+
+    piece_length = bencode_utils.decode(bytes(info[b'piece length']))
+    if not isinstance(piece_length, int) or piece_length < 1 or piece_length & (piece_length - 1):
+        raise bencode_utils.BencodeError(f"Piece length {piece_length} is not a power of two")
+    # Only the length prefix of pieces is read, the hashes themselves are never copied
+    prefix = bytes(info[b'pieces'][:21])
+    if not prefix[:1].isdigit():
+        raise bencode_utils.BencodeError("Pieces is not a string")
+    pieces_length = int(prefix[:prefix.index(b':')])
+    if pieces_length == 0 or pieces_length % 20:
+        raise bencode_utils.BencodeError(f"Pieces are {pieces_length} bytes, not a multiple of 20")
+    return piece_length
 
 def create_torrent(directory, temp_dir, edit, hasher):
     """Create a torrent file from the given directory using torf-cli.
@@ -97,69 +113,79 @@ def create_torrent(directory, temp_dir, edit, hasher):
 
     if edit and etorrent_file_path:
         if not etorrent_file_path.exists():
-            print("No existing .torrent found. New torrent will be generated.")
-            # Call itself, but set edit to false
-            return create_torrent(directory, temp_dir, False, hasher)
-
-        # Existing torrent *file* successfully found, try to use it
+            # Saved under another filename, e.g. the infohash? Look it up by content in the index
+            etorrent_file_path = find_reusable_torrent(directory_path)
+            if etorrent_file_path is None:
+                print("No existing .torrent found. New torrent will be generated.")
+                # Call itself, but set edit to false
+                return create_torrent(directory, temp_dir, False, hasher)
+            print(f"Found existing torrent by content: {etorrent_file_path}")
+
+        # Existing torrent *file* successfully found, edit it without decoding it
+        try:
+            data = etorrent_file_path.read_bytes()
+        except OSError as e:
+            log_event('create_torrent', str(e), 'error')
+            print(f"Error reusing torrent: {e}")
+            return None, None
         try:
-            reused_torrent = Torrent.read(f"{shlex.quote(str(etorrent_file_path))}")
-        except MetainfoError as e:
+            chunks, infohash, info = bencode_utils.edit_torrent(
+                data,
+                {b'announce': announceurl, b'comment': ecomment, b'created by': creator},
+                {b'source': esource, b'private': 1},
+                keep=EDIT_KEYS, info_keep=EDIT_INFO_KEYS)
+            piece_length = check_reused_info(info)
+        except bencode_utils.BencodeError as e:
             print(f"Invalid existing torrent. {e}\n"
                   f"New torrent will be generated.")
             # Call itself, but set edit to false
             return create_torrent(directory, temp_dir, False, hasher)
-        except Exception as e:
-            # Catch the rest, the only error that is not treated as fatal is MetainfoError
-            log_to_file(temp_dir_path / 'create_torrent_error.log', str(e))
-            print(f"Error reusing torrent: {e}")
+
+        print(f"### Found existing torrent. {output_torrent}. Saving an edited copy")
+        try:
+            with open(output_torrent, 'wb') as f:
+                f.writelines(chunks)
+        except OSError as e:
+            log_event('create_torrent', str(e), 'error')
+            print(f"Error, could not write torrent to {output_torrent}: {e}")
             return None, None
-        else:
-            print(f"### Found existing torrent. {output_torrent}. Saving an edited copy")
-            # Now edit the torrent as an object
-            reused_torrent.trackers = [announceurl]
-            reused_torrent.comment = ecomment
-            reused_torrent.created_by = creator
-
-            info_dict = reused_torrent.metainfo['info']
-            valid_keys = ['name', 'piece length', 'pieces', 'private', 'source']
-
-            # Add the correct key based on single vs multi file torrent
-            if 'files' in info_dict:
-                valid_keys.append('files')
-            elif 'length' in info_dict:
-                valid_keys.append('length')
-
-            # Remove everything not in the whitelist
-            for each in list(info_dict):
-                if each not in valid_keys:
-                    info_dict.pop(each, None)
-            for each in list(reused_torrent.metainfo):
-                if each not in ('announce', 'comment', 'creation date', 'created by', 'encoding', 'info'):
-                    reused_torrent.metainfo.pop(each, None)
-
-            reused_torrent.source = f"{shlex.quote(esource)}"
-            reused_torrent.private = True
+        log_event('create_torrent', f"Edited torrent written, infohash {infohash}")
+
+        if config.getboolean('Torrent', 'VERIFY_REUSED', fallback=False):
+            # Nothing so far proves the reused torrent describes the data in DATADIR, spot check it
             try:
-                reused_torrent = Torrent.copy(reused_torrent)
-            except Exception as e:
-                log_to_file(temp_dir_path / 'create_torrent_error.log', str(e))
-                print(f"Error when trying to copy torrent: {e}")
-                return None, None
+                _, bad_pieces = verify_torrent(output_torrent, directory_path)
+            except (OSError, KeyError, bencode_utils.BencodeError) as e:
+                bad_pieces = [str(e)]
+            if bad_pieces:
+                log_event('create_torrent', f"Reused torrent doesn't match the data: {bad_pieces[:10]}", 'error')
+                print("Reused torrent doesn't match the data. New torrent will be generated.")
+                return create_torrent(directory, temp_dir, False, hasher)
+        # Same exponent form as a newly generated torrent
+        piece_size = piece_length.bit_length() - 1
+    else:
+        # Imported here so uploads that never reach hashing, or only edit a torrent, don't pay for loading torf
+        from torf import Torrent, ReadError, BdecodeError, MetainfoError, VerifyIsDirectoryError, VerifyFileSizeError
+
+        # One listing of the tree gives both the piece size and the byte count behind mkbrr's percentages
+        files = list_files(directory_path)
+        total_size = sum(size for _, size, _ in files)
+        piece_size = choose_piece_exponent(total_size)
+        print(f"{bcolors.YELLOW}Setting piece length to {(2 ** piece_size) / (1024 * 1024):.2f} MiB{bcolors.ENDC}")
+        if use_native_hasher(files, 2 ** piece_size):
+            # torf and mkbrr open, read and close every file in turn, which is slow for packs of small files
+            print(f"{bcolors.YELLOW}Hashing {len(files)} files with the small-file engine{bcolors.ENDC}")
             try:
-                reused_torrent.write(output_torrent, overwrite=True)
-            except WriteError as e:
-                log_to_file(temp_dir_path / 'create_torrent_error.log', str(e))
-                print(f"Error, could not write torrent to {output_torrent}: {e}")
-                return None, None
-            except MetainfoError as e:
-                log_to_file(temp_dir_path / 'create_torrent_error.log', str(e))
-                print(f"Error with newly copied torrent {directory_path.name}.torrent metainfo: {e}")
+                infohash = create_native_torrent(directory_path, files, piece_size, output_torrent, announceurl,
+                                                 esource, creator, ecomment)
+            except (OSError, HashError) as e:
+                log_event('create_torrent', str(e), 'error')
+                print(f"{bcolors.FAIL}Error generating torrent: {e}{bcolors.ENDC}")
                 return None, None
-    else:
-        piece_size = calculate_piece_size(directory)
-        max_piece_size_bytes = piece_size * 1024 * 1024
-        if hasher == 'torf':
+            log_event('create_torrent', f"New torrent generated, infohash {infohash}")
+            write_manifest(output_torrent, files, 2 ** piece_size)
+
+        elif hasher == 'torf':
             try:
                 new_torrent = Torrent(path=str(directory_path),
                                       name=directory_path.name,
@@ -168,48 +194,48 @@ def create_torrent(directory, temp_dir, edit, hasher):
                                       created_by=creator,
                                       comment=ecomment,
                                       randomize_infohash=True,
-                                      private=True,
-                                      piece_size_max=max_piece_size_bytes)
+                                      private=True)
+                new_torrent.piece_size_max = 2 ** piece_size
+                new_torrent.piece_size = 2 ** piece_size
 
             except Exception as e:
-                log_to_file(temp_dir_path / 'create_torrent_error.log', str(e))
+                log_event('create_torrent', str(e), 'error')
                 print(f"{bcolors.FAIL}Error when writing torrent metainfo to Torrent object: {e}")
                 return None, None
 
+            reporter = ProgressReporter(job_id(directory_path.name), "Torf hashing", unit_bytes=new_torrent.piece_size)
             try:
-                if new_torrent.generate(callback=torf_cb, interval=5):
+                if new_torrent.generate(callback=partial(torf_cb, reporter), interval=DB_INTERVAL):
                     new_torrent.write(output_torrent, overwrite=True)
-                    log_to_file(temp_dir_path / 'create_torrent_output.log',
-                                "New torrent successfully generated. Validating now")
+                    log_event('create_torrent', "New torrent successfully generated. Validating now")
                     print("New torrent successfully generated. Validating now")
                     try:
                         Torrent.read(output_torrent).validate()
                     except (ReadError, BdecodeError, MetainfoError) as e:
-                        log_to_file(temp_dir_path / 'create_torrent_error.log', str(e))
+                        log_event('create_torrent', str(e), 'error')
                         print(f"Could not read output torrent: {e}")
                         return None, None
                     try:
                         validated = new_torrent.verify_filesize(directory_path)
                     except (ReadError, MetainfoError, VerifyIsDirectoryError, VerifyFileSizeError) as e:
-                        log_to_file(temp_dir_path / 'create_torrent_error.log', str(e))
+                        log_event('create_torrent', str(e), 'error')
                         print(f"Could not verify output torrent: {e}")
                     else:
                         if validated:
-                            log_to_file(temp_dir_path / 'create_torrent_output.log',
-                                        "Torrent file successfully validated")
+                            log_event('create_torrent', "Torrent file successfully validated")
                             print("Torrent file successfully validated")
+                            write_manifest(output_torrent, files, 2 ** piece_size)
                         else:
-                            log_to_file(temp_dir_path / 'create_torrent_error.log',
-                                        "Failed to hash all pieces during torrent generation")
+                            log_event('create_torrent', "Failed to hash all pieces during torrent generation", 'error')
                             print("Failed to hash all pieces during torrent generation")
                             return None, None
                 else:
                     # Failed for whatever reason that wasn't raised as an exception
-                    log_to_file(temp_dir_path / 'create_torrent_error.log', "Failed to hash all pieces during torrent generation")
+                    log_event('create_torrent', "Failed to hash all pieces during torrent generation", 'error')
                     print("Failed to hash all pieces during torrent generation")
                     return None, None
             except Exception as e:
-                log_to_file(temp_dir_path / 'create_torrent_error.log', str(e))
+                log_event('create_torrent', str(e), 'error')
                 print(f"{bcolors.FAIL}Error generating torrent: {e}{bcolors.ENDC}")
                 return None, None
 
@@ -217,43 +243,35 @@ def create_torrent(directory, temp_dir, edit, hasher):
             try:
                 mkbrr_path = get_mkbrr_bin()
             except Exception as e:
-                log_to_file(temp_dir_path / 'create_torrent_error.log', str(e))
+                log_event('create_torrent', str(e), 'error')
                 print(f"{bcolors.FAIL}Error getting mkbrr binary: {e}{bcolors.ENDC}")
                 return None, None
 
             # Ensure mkbrr is executable for both owner and group
             os.chmod(mkbrr_path, 0o775)
 
-            if piece_size < 16:
-                # Mkbrr only supports a minimum piece length of 16. If it's lower than 16, set to 16.
-                max_piece_size_bytes = 16 * 1024 * 1024
-
-            # Largest power of 2 that's less than or equal to max piece size in bytes
-            import math
-            power = min(27, max(16, math.floor(math.log2(max_piece_size_bytes))))
-            print(
-                f"{bcolors.YELLOW}Setting mkbrr piece length to {(2 ** power) / (1024 * 1024):.2f} MiB{bcolors.ENDC}")
             cmd = [mkbrr_path,
                    "create",
                    str(directory_path),
                    '-t', f'{announceurl}',
                    '-e',
-                   '-l', str(power),
+                   '-l', str(piece_size),
                    '-o', get_root_dir() + f'/{output_torrent}',
                    '-s', f'{esource}',
                    '-c', f'{ecomment}']
 
             try:
-                process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+                process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1,
+                                           preexec_fn=spawn_priority())
                 print(f"mkbrr PID: {process.pid}")
             except OSError as e:
-                log_to_file(temp_dir_path / 'create_torrent_error.log', str(e))
+                log_event('create_torrent', str(e), 'error')
                 print(f"{bcolors.FAIL}Error starting mkbrr process: {e}")
                 return None, None
 
-            total_pieces = 100  # Default to 100% for scaling progress
-            pieces_done = 0
-            mkbrr_start_time = time.time()
+            # mkbrr only reports a percentage, so each unit of work is 1% of the data
+            reporter = ProgressReporter(job_id(directory_path.name), "mkbrr hashing", total=100,
+                                        unit_bytes=total_size / 100)
             torrent_written = False
 
             error = "Unknown error" # Initialize error to "Unknown error"
@@ -263,28 +281,13 @@ def create_torrent(directory, temp_dir, edit, hasher):
                     if 'error' in line.lower():
                         error = line
                         break
-                    # Detect hashing progress, speed, and percentage
-                    match = re.search(r"Hashing pieces.*?\[(\d+(?:\.\d+)? [GM](?:B|iB)/s)]\s+(\d+)%", line)
+                    # Detect hashing progress
+                    match = MKBRR_PROGRESS_RE.search(line)
                     if match:
-                        speed = match.group(1)  # Extract speed (e.g., "12734.21 MB/s")
-                        pieces_done = int(match.group(2))  # Extract percentage (e.g., "60")
-
-                        # Try to extract the ETA directly if it's in the format [elapsed:remaining]
-                        eta_match = re.search(r'\[(\d+)s:(\d+)s]', line)
-                        if eta_match:
-                            eta_seconds = int(eta_match.group(2))
-                            eta = time.strftime("%M:%S", time.gmtime(eta_seconds))
-                        else:
-                            # Fallback to calculating ETA if not directly available
-                            elapsed_time = time.time() - mkbrr_start_time
-                            if pieces_done > 0:
-                                estimated_total_time = elapsed_time / (pieces_done / 100)
-                                eta_seconds = max(0, estimated_total_time - elapsed_time)
-                                eta = time.strftime("%M:%S", time.gmtime(eta_seconds))
-                            else:
-                                eta = "--:--"  # Placeholder if we can't estimate yet
-
-                        cli_ui.info_progress(f"mkbrr hashing... {speed} | ETA: {eta}", pieces_done, total_pieces)
+                        reporter.update(int(match.group(1)))
+                        preemption_point(reporter.job, on_pause=partial(process.send_signal, signal.SIGSTOP),
+                                         on_resume=partial(process.send_signal, signal.SIGCONT))
+                        continue
 
                     # Detect final output line
                     if "Wrote" in line and ".torrent" in line:
@@ -302,7 +305,7 @@ def create_torrent(directory, temp_dir, edit, hasher):
                 if not torrent_written or not os.path.exists(output_torrent):
                     raise FileNotFoundError(f"Expected torrent file {output_torrent} was not created")
             except Exception as e:
-                log_to_file(temp_dir_path / 'create_torrent_error.log', str(e))
+                log_event('create_torrent', str(e), 'error')
                 print(f"{bcolors.FAIL}Error creating torrent: {e}{bcolors.ENDC}")
 
                 # Ensure process is termianted to prevent orphaned mkbrr processes
@@ -314,14 +317,139 @@ def create_torrent(directory, temp_dir, edit, hasher):
                 test_torrent = Torrent.read(output_torrent)
                 if not test_torrent.metainfo.get('info', {}).get('pieces'):
                     raise ValueError("Generated torrent is missing pieces")
+                write_manifest(output_torrent, files, 2 ** piece_size)
             except Exception as e:
-                log_to_file(temp_dir_path / 'create_torrent_error.log', str(e))
+                log_event('create_torrent', str(e), 'error')
                 print(f"{bcolors.FAIL}Error creating torrent: {e}{bcolors.ENDC}")
                 return None, None
 
     print(f"{bcolors.OKGREEN}Torrent to be uploaded has been created: {output_torrent}\n{bcolors.ENDC}")
+
+    outputs = get_extra_outputs()
+    if outputs:
+        # Same pieces for every destination, only the metainfo around them differs
+        for path in emit_torrents(output_torrent, outputs):
+            print(f"{bcolors.OKGREEN}Extra torrent written: {path}{bcolors.ENDC}")
     return output_torrent, piece_size  # Return the path to the torrent file as a string
 
+def create_native_torrent(directory_path, files, piece_size, output_torrent, announceurl, source, creator, comment):
+    """Hash a release with hash_utils and stream the torrent to disk, with the same metainfo torf would write.
+
+    Args:
+        directory_path (Path): The release, a directory or a single file
+        files (FileList): list_files() of the release
+        piece_size (int): Piece size as a power of two
+
+    Returns:
+        str: The infohash as hex
+    """
+    # Like torf, empty files are left out of the torrent
+    torrent_files = files.without_empty()
+    single_file = directory_path.is_file()
+    if single_file:
+        paths = [directory_path]
+    else:
+        paths = [directory_path.joinpath(*torrent_files.parts(index)) for index in range(len(torrent_files))]
+
+    reporter = ProgressReporter(job_id(directory_path.name), "Native hashing", unit_bytes=2 ** piece_size)
+    pieces = hash_pieces(paths, torrent_files.sizes, 2 ** piece_size, progress=reporter.update,
+                         checkpoint=HashCheckpoint(directory_path, torrent_files, 2 ** piece_size),
+                         pause_point=partial(preemption_point, reporter.job))
+    del paths
+
+    fields = {b'announce': announceurl, b'created by': creator, b'creation date': int(time.time())}
+    if comment:
+        fields[b'comment'] = comment
+    info_fields = {b'name': directory_path.name, b'piece length': 2 ** piece_size, b'pieces': pieces,
+                   b'private': 1, b'source': source, b'entropy': random.randint(int(-2e9), int(2e9))}
+    if single_file:
+        info_fields[b'length'] = torrent_files.sizes[0]
+    with open(output_torrent, 'wb') as f:
+        return bencode_utils.write_torrent(f, fields, info_fields,
+                                           None if single_file else torrent_files.bencoded_entries())
+
+def get_extra_outputs():
+    """Read the [Output.<name>] sections listed in EXTRA_OUTPUTS, one per extra destination of every torrent.
+
+    Returns:
+        list: One dict per output with folder, announce, source, comment, created_by, private and randomize
+    """
+    names = [name.strip() for name in config.get('Torrent', 'EXTRA_OUTPUTS', fallback='').split(',') if name.strip()]
+    outputs = []
+    for name in names:
+        section = f'Output.{name}'
+        if not config.has_section(section):
+            print(f"{bcolors.WARNING}EXTRA_OUTPUTS lists {name} but there is no [{section}] section{bcolors.ENDC}")
+            continue
+        outputs.append({
+            'name': name,
+            'folder': config.get(section, 'FOLDER').strip(),
+            'announce': config.get(section, 'ANNOUNCEURL').strip(),
+            'source': config.get(section, 'SOURCE', fallback='').strip(),
+            'comment': config.get(section, 'COMMENT', fallback='').strip(),
+            'created_by': config.get(section, 'CREATOR', fallback=config.get('Torrent', 'CREATOR')).strip(),
+            'private': config.getboolean(section, 'PRIVATE', fallback=True),
+            'randomize': config.getboolean(section, 'RANDOMIZE_INFOHASH', fallback=True),
+        })
+    return outputs
+
+def emit_torrent(data, output, destination):
+    """Write one extra torrent for an output from the bencoded main torrent, reusing its pieces as they are."""
+    changes = {b'announce': output['announce'], b'created by': output['created_by']}
+    if output['comment']:
+        changes[b'comment'] = output['comment']
+    info_changes = {}
+    info_keep = set(EDIT_INFO_KEYS)
+    if output['source']:
+        info_changes[b'source'] = output['source']
+    else:
+        info_keep.discard(b'source')
+    if output['private']:
+        info_changes[b'private'] = 1
+    else:
+        info_keep.discard(b'private')
+    if output['randomize']:
+        # Same as torf's randomize_infohash, so cross-seeding clients never see the same infohash twice
+        info_changes[b'entropy'] = random.randint(int(-2e9), int(2e9))
+
+    keep = set(EDIT_KEYS) - {b'comment'}
+    chunks, infohash, _ = bencode_utils.edit_torrent(data, changes, info_changes, keep=keep, info_keep=info_keep)
+    with open(destination, 'wb') as f:
+        f.writelines(chunks)
+    return infohash
+
+def emit_torrents(torrent_file, outputs):
+    """Write a torrent for every extra output from one hashed torrent, in parallel. Nothing under DATADIR is read.
+
+    Args:
+        torrent_file (str): The main torrent
+        outputs (list): From get_extra_outputs()
+
+    Returns:
+        list: Paths of the torrents written, outputs that failed are logged and skipped
+    """
+    with open(torrent_file, 'rb') as f:
+        data = f.read()
+    filename = Path(torrent_file).name
+
+    def emit(output):
+        Path(output['folder']).mkdir(parents=True, exist_ok=True)
+        destination = Path(output['folder']) / filename
+        infohash = emit_torrent(data, output, destination)
+        log_event('create_torrent', f"Extra torrent for {output['name']} written to {destination}, infohash {infohash}")
+        return destination
+
+    written = []
+    with ThreadPoolExecutor(max_workers=len(outputs)) as executor:
+        futures = {executor.submit(emit, output): output for output in outputs}
+        for future, output in futures.items():
+            try:
+                written.append(future.result())
+            except (OSError, bencode_utils.BencodeError) as e:
+                log_event('create_torrent', f"Extra torrent for {output['name']}: {e}", 'error')
+                print(f"{bcolors.FAIL}Could not write extra torrent for {output['name']}: {e}{bcolors.ENDC}")
+    return written
+
 def get_mkbrr_bin():
     """Get the path to the mkbrr binary based on the platform."""
     platform_type = platform.machine().lower()
@@ -343,72 +471,29 @@ def get_mkbrr_bin():
             raise FileNotFoundError(f"Unsupported Linux architecture: {platform_type}")
     return mkbrr_path
 
-def calculate_size(directory):
-    """Calculate the directory size."""
-    total_size = sum(
-        os.path.getsize(os.path.join(root, file))
-        for root, _, files in os.walk(directory)
-        for file in files
-    )
-
-    return total_size
-
-def calculate_piece_size(directory):
-    """Calculate the appropriate piece size for the torrent based on directory size."""
-    total_size = sum(
-        os.path.getsize(os.path.join(root, file))
-        for root, _, files in os.walk(directory)
-        for file in files
-    )
-
-    mb = total_size // (1024 * 1024)
-
-    if mb > 484352:
-        pieces = 24
-    elif mb > 194560:
-        pieces = 24
-    elif mb > 73728:
-        pieces = 23
-    elif mb > 16384:
-        pieces = 22
-    elif mb > 8192:
-        pieces = 21
-    elif mb > 4096:
-        pieces = 20
-    elif mb > 2048:
-        pieces = 19
-    elif mb > 1024:
-        pieces = 18
-    elif mb > 512:
-        pieces = 17
-    elif mb > 256:
-        pieces = 16
-    else:
-        pieces = 15
-
-    return pieces
+def download_torrent(url, cookies, release_name, is_dupe=False, dupe_id=None, manifest_file=None):
+    """Download a torrent file, distinguishing between duplicate and regular torrents.
 
-
-def download_torrent(url, cookies, release_name, is_dupe=False, dupe_id=None):
-    """Download a torrent file, distinguishing between duplicate and regular torrents."""
+    manifest_file is the hash manifest of the torrent we created, used to add fast resume without checking the data.
+    """
     try:
         # Determine the temporary file path with appropriate naming
         temp_torrent_path = os.path.join(TMP_DIR, f'{dupe_id}_{release_name}.torrent') if is_dupe and dupe_id else os.path.join(TMP_DIR, f'{release_name}.torrent')
 
         # Download the torrent content
-        response = requests.get(url, cookies=cookies, headers={'User-Agent': 'Mozilla/5.0'})
+        response = http_utils.get('site', url, cookies=cookies, headers={'User-Agent': 'Mozilla/5.0'})
         response.raise_for_status()  # Raise an error for bad responses
-        log_to_file(os.path.join(TMP_DIR, 'response_debug.log'), f"Response status: {response.status_code}\nResponse content: {response.text}")
+        # The body is a binary torrent, only its size is worth logging
+        log_event('torrent_download', "Torrent download response", status=response.status_code,
+                  size=len(response.content))
 
         # Write the torrent content to the temporary file
         with open(temp_torrent_path, 'wb') as f:
             f.write(response.content)
 
-        # Choose the appropriate log file
-        log_file = 'dupe_download.log' if is_dupe else 'torrent_download.log'
-        
         # Log the successful download
-        log_to_file(os.path.join(TMP_DIR, log_file), f"Torrent downloaded successfully: {temp_torrent_path}")
+        log_event('dupe_download' if is_dupe else 'torrent_download',
+                  f"Torrent downloaded successfully: {temp_torrent_path}")
         print(f"{bcolors.OKGREEN}Torrent downloaded successfully: {temp_torrent_path}\n{bcolors.ENDC}")
         
         # Check if fast resume should be added
@@ -421,7 +506,7 @@ def download_torrent(url, cookies, release_name, is_dupe=False, dupe_id=None):
             fastresume_output_path = os.path.join(TMP_DIR, f'dc.{release_name}.torrent')
             
             # Add fast resume data
-            add_fastresume(temp_torrent_path, download_dir, fastresume_output_path)
+            add_fastresume(temp_torrent_path, download_dir, fastresume_output_path, manifest_file)
             
             # Check if the fast resume file exists and move it
             if os.path.exists(fastresume_output_path):
@@ -445,12 +530,13 @@ def download_torrent(url, cookies, release_name, is_dupe=False, dupe_id=None):
 
     except requests.RequestException as e:
         # Log any request exceptions
-        log_to_file(os.path.join(TMP_DIR, 'dupe_download_error.log' if is_dupe else 'torrent_download_error.log'), f"Failed to download torrent: {str(e)}")
+        log_event('dupe_download' if is_dupe else 'torrent_download', f"Failed to download torrent: {str(e)}",
+                  'error')
         print(f"{bcolors.FAIL}Failed to download torrent: {str(e)}{bcolors.ENDC}")
 
     except Exception as e:
         # General exception logging
-        log_to_file(os.path.join(TMP_DIR, 'dupe_general_error.log' if is_dupe else 'torrent_general_error.log'), f"An error occurred: {str(e)}")
+        log_event('dupe_download' if is_dupe else 'torrent_download', f"An error occurred: {str(e)}", 'error')
         print(f"{bcolors.FAIL}An error occurred: {str(e)}{bcolors.ENDC}")
 
 def upload_torrent(torrent_file, template_file, cookies, category_id, imdb_id, mediainfo_text, dupedl_enabled):
@@ -499,15 +585,15 @@ def upload_torrent(torrent_file, template_file, cookies, category_id, imdb_id, m
             # Add in mediainfo if there is any
             data['mediainfo'] = mediainfo_text
         
-        # Log request details for debugging
-        log_to_file(os.path.join(TMP_DIR, 'upload_request.log'), f"Uploading to URL: {upload_url}")
-        log_to_file(os.path.join(TMP_DIR, 'upload_request.log'), f"Headers: {{'User-Agent': '{user_agent}', 'Expect': ''}}")
-        log_to_file(os.path.join(TMP_DIR, 'upload_request.log'), f"Cookies: {cookies}")
-        log_to_file(os.path.join(TMP_DIR, 'upload_request.log'), f"Files: {files}")
-        log_to_file(os.path.join(TMP_DIR, 'upload_request.log'), f"Data: {data}")
+        # Log the form without its payloads, the NFO and mediainfo are only counted
+        form = {key: value for key, value in data.items() if key not in ('nfo', 'mediainfo')}
+        log_event('torrent_upload', f"Uploading to URL: {upload_url}", user_agent=user_agent,
+                  torrent=os.path.basename(torrent_file), form=form, nfo_length=len(nfo_content),
+                  mediainfo_length=len(mediainfo_text))
 
         try:
-            response = requests.post(
+            response = http_utils.post(
+                'site',
                 upload_url,
                 headers={'User-Agent': user_agent, 'Expect': ''},
                 cookies=cookies,
@@ -516,12 +602,13 @@ def upload_torrent(torrent_file, template_file, cookies, category_id, imdb_id, m
                 verify=False
             )
         except requests.RequestException as e:
-            log_to_file(os.path.join(TMP_DIR, 'upload_response.log'), f"Request exception: {e}")
+            log_event('torrent_upload', f"Request exception: {e}", 'error')
             raise requests.RequestException(e)
 
         response_code = response.status_code
         # Log the upload response
-        log_to_file(os.path.join(TMP_DIR, 'upload_response.log'), f"Upload response status: {response_code}\n{response.text}")
+        log_event('torrent_upload', f"Upload response status: {response_code}", status=response_code)
+        log_event('torrent_upload', "Upload response body", 'debug', body=response.text)
 
         if response_code == 200 or (response_code == 409 and dupedl_enabled):
             response_json = response.json()
@@ -536,7 +623,8 @@ def upload_torrent(torrent_file, template_file, cookies, category_id, imdb_id, m
             
             # Download the torrent file using the ID from the response
             torrent_url = f"{config.get('Website', 'SITEURL')}/api/v1/torrents/download/{torrent_id}"
-            download_torrent(torrent_url, cookies, torrent_name, torrent_id)
+            download_torrent(torrent_url, cookies, torrent_name, torrent_id,
+                             manifest_file=manifest_path(torrent_file))
             return response_code
         else:
             raise requests.RequestException(f"Status code: {response_code}\nResponse: {response.text}")
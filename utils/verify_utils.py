@@ -0,0 +1,170 @@
+import argparse
+import hashlib
+import math
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+from utils import bencode_utils
+from utils.bcolors import bcolors
+from utils.config_loader import ConfigLoader
+from utils.governor_utils import ReadThrottle
+from utils.piece_utils import edge_pieces, file_offsets, piece_spans
+
+# Load configuration
+config = ConfigLoader().get_config()
+
+VERIFY_DIR = Path('data/verify')
+# Defaults for the [Torrent] options, see config.ini
+VERIFY_FRACTION = 0.02
+VERIFY_WORKERS = 4
+
+
+class TorrentLayout:
+    """Where the pieces of a torrent live on disk."""
+
+    def __init__(self, torrent_file, data_path):
+        """
+        Args:
+            torrent_file (str): Path of the .torrent
+            data_path (Path): The torrent's data, the directory of a multi-file torrent or the file of a single-file one
+        """
+        with open(torrent_file, 'rb') as f:
+            info = bencode_utils.decode(f.read())[b'info']
+        data_path = Path(data_path)
+        self.piece_length = info[b'piece length']
+        pieces = info[b'pieces']
+        self.hashes = [pieces[i:i + 20] for i in range(0, len(pieces), 20)]
+        if b'files' in info:
+            self.paths = [data_path.joinpath(*(part.decode() for part in entry[b'path'])) for entry in info[b'files']]
+            self.sizes = [entry[b'length'] for entry in info[b'files']]
+        else:
+            self.paths = [data_path]
+            self.sizes = [info[b'length']]
+        self.offsets = file_offsets(self.sizes)
+        # Shared by the verify workers, a full check in the background follows the governor's read limit too
+        self.throttle = ReadThrottle()
+
+    def read_piece(self, index):
+        """Read one piece from the files it spans. Missing or short files give a short piece, which won't match."""
+        chunks = []
+        for file_index, offset, length in piece_spans(self.offsets, self.sizes, index, self.piece_length):
+            try:
+                with open(self.paths[file_index], 'rb') as f:
+                    f.seek(offset)
+                    chunks.append(f.read(length))
+                self.throttle.consume(length)
+            except OSError:
+                break
+        return b''.join(chunks)
+
+    def piece_matches(self, index):
+        return hashlib.sha1(self.read_piece(index)).digest() == self.hashes[index]
+
+
+def sample_pieces(layout, fraction, seed=None):
+    """Pick the pieces of a spot check: the first and last piece of every file, plus `fraction` of all pieces.
+
+    Returns:
+        list: Piece indexes in ascending order, so reads move forward through the files
+    """
+    piece_total = len(layout.hashes)
+    pieces = edge_pieces(layout.offsets, layout.sizes, layout.piece_length)
+    extra = min(piece_total, math.ceil(piece_total * fraction))
+    pieces.update(random.Random(seed).sample(range(piece_total), extra))
+    return sorted(piece for piece in pieces if piece < piece_total)
+
+
+def verify_pieces(layout, pieces, workers=VERIFY_WORKERS):
+    """Hash pieces in parallel. hashlib and file reads release the GIL, so threads scale with the disks.
+
+    Returns:
+        list: Indexes of the pieces that don't match
+    """
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        results = executor.map(layout.piece_matches, pieces)
+        return [piece for piece, matches in zip(pieces, results) if not matches]
+
+
+def verify_torrent(torrent_file, data_path, fraction=None, workers=None):
+    """Check the data of a torrent against its piece hashes, either spot checked or in full.
+
+    Args:
+        torrent_file (str): Path of the .torrent
+        data_path (Path): The torrent's data
+        fraction (float): Fraction of random pieces on top of the per-file edges, 1 or more checks every piece.
+                          Defaults to VERIFY_FRACTION in config.ini
+        workers (int): Pieces hashed in parallel, defaults to VERIFY_WORKERS in config.ini
+
+    Returns:
+        tuple: (pieces checked, indexes of the pieces that don't match)
+    """
+    if fraction is None:
+        fraction = config.getfloat('Torrent', 'VERIFY_FRACTION', fallback=VERIFY_FRACTION)
+    if workers is None:
+        workers = config.getint('Torrent', 'VERIFY_WORKERS', fallback=VERIFY_WORKERS)
+
+    layout = TorrentLayout(torrent_file, data_path)
+    pieces = list(range(len(layout.hashes))) if fraction >= 1 else sample_pieces(layout, fraction)
+    start = time.perf_counter()
+    bad = verify_pieces(layout, pieces, workers)
+    elapsed = time.perf_counter() - start
+    color = bcolors.FAIL if bad else bcolors.OKGREEN
+    print(f"{color}Verified {len(pieces)} of {len(layout.hashes)} pieces in {elapsed:.2f}s, "
+          f"{len(bad)} mismatched{bcolors.ENDC}")
+    return len(pieces), bad
+
+
+def start_background_verify(torrent_file, data_path, name):
+    """Fully verify an uploaded torrent in a detached process, so the upload doesn't wait for it.
+
+    The torrent is copied to VERIFY_DIR first, the temp dir it lives in is about to be cleaned up. The result ends
+    up in VERIFY_DIR/<name>-<timestamp>.log.
+
+    Returns:
+        Path: The log file
+    """
+    VERIFY_DIR.mkdir(parents=True, exist_ok=True)
+    stem = f"{re.sub(r'[^A-Za-z0-9._-]+', '_', name)[:100]}-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    torrent_copy = VERIFY_DIR / f"{stem}.torrent"
+    log_file = VERIFY_DIR / f"{stem}.log"
+    shutil.copyfile(torrent_file, torrent_copy)
+    with open(log_file, 'a') as log:
+        subprocess.Popen([sys.executable, '-m', 'utils.verify_utils', '--full', '--remove-torrent',
+                          str(torrent_copy), str(data_path)],
+                         stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    return log_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check a torrent's data against its piece hashes")
+    parser.add_argument('torrent', help=".torrent file")
+    parser.add_argument('data', help="The torrent's data, directory or file")
+    parser.add_argument('--full', action='store_true', help="Check every piece instead of a sample")
+    parser.add_argument('--fraction', type=float, help="Fraction of random pieces to sample")
+    parser.add_argument('--workers', type=int, help="Pieces hashed in parallel")
+    parser.add_argument('--remove-torrent', action='store_true', help="Delete the .torrent when done")
+    args = parser.parse_args()
+
+    try:
+        checked, bad = verify_torrent(args.torrent, args.data, 1 if args.full else args.fraction, args.workers)
+    except (OSError, KeyError, bencode_utils.BencodeError) as e:
+        print(f"{bcolors.FAIL}ERROR: Could not verify {args.data}: {e}{bcolors.ENDC}")
+        sys.exit(2)
+    finally:
+        if args.remove_torrent:
+            os.remove(args.torrent)
+    if bad:
+        print(f"Mismatched pieces: {', '.join(map(str, bad[:100]))}{' ...' if len(bad) > 100 else ''}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()